@@ -0,0 +1,51 @@
+import os
+import contextvars
+
+# Resource usage of the stage currently running in this context; process.run_command adds to it
+current_usage = contextvars.ContextVar('current_usage', default=None)
+
+USAGE_FIELDS = ['wall_time', 'cpu_user', 'cpu_sys', 'peak_rss_bytes', 'disk_read_bytes', 'disk_write_bytes',
+                'network_bytes', 'commands']
+
+def new_usage():
+    return {
+        'wall_time': 0.0,
+        'cpu_user': 0.0,
+        'cpu_sys': 0.0,
+        'peak_rss_bytes': 0,
+        'disk_read_bytes': 0,
+        'disk_write_bytes': 0,
+        'network_bytes': None,
+        'commands': 0
+    }
+
+def add_usage(**values):
+    usage = current_usage.get()
+    if usage is None:
+        return
+    for key, value in values.items():
+        if value is None:
+            continue
+        if key == 'peak_rss_bytes':
+            usage[key] = max(usage[key], value)
+        else:
+            usage[key] = (usage[key] or 0) + value
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+def format_bytes(value):
+    if value is None:
+        return 'n/a'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if value < 1024:
+            return f"{value:.0f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TB"
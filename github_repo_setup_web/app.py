@@ -1,91 +1,258 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file
 from github_repo_setup import (
     is_valid_github_url,
-    download_repository,
     detect_python_version,
-    search_python_files,
-    setup_virtual_environment,
-    install_dependencies,
-    setup_git_hooks,
-    check_tests_directory,
-    run_tests
+    LFS_MODES
 )
+from job_queue import open_queue, FINAL_STATUSES
+from worker import start_local_workers
+from scheduler import capacity, estimated_duration, QUEUE_SIZE
+from profiling import PROFILE_DIR, PROFILE_MODES
+from webhooks import verify_signature, parse_push, is_registered, schedule_prewarm, WEBHOOK_SECRET, WEBHOOK_DEBOUNCE
+from history import get_history, get_stage_durations, get_test_durations, import_setup
+from logging_config import configure_logging, should_log_payload, current_job_id
+import io
 import os
-import shutil
-import logging
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = Flask(__name__)
 
-# Configure logging
-logging.basicConfig(filename='app.log', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# Logging runs through a queue so file I/O never sits on the request path
+configure_logging()
 
-# Add a StreamHandler to also log to console
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-app.logger.addHandler(console_handler)
+# Shared by every batch request, so the total number of concurrent detections stays bounded
+DETECT_CONCURRENCY = int(os.getenv('DETECT_CONCURRENCY', 8))
+DETECT_BATCH_LIMIT = int(os.getenv('DETECT_BATCH_LIMIT', 500))
+detect_executor = ThreadPoolExecutor(max_workers=DETECT_CONCURRENCY, thread_name_prefix='detect')
+
+# Setups run on workers pulling from this queue (see worker.py); 0 local workers makes the app a pure enqueuer
+job_queue = open_queue()
+LOCAL_WORKERS = int(os.getenv('SETUP_LOCAL_WORKERS', 1))
+
+def parse_job_id(value):
+    try:
+        return str(uuid.UUID(value)) if value else None
+    except ValueError:
+        return None
+
+def log_request_payload(endpoint):
+    if should_log_payload(endpoint):
+        app.logger.info("Request payload", extra={'endpoint': endpoint, 'form': request.form.to_dict(),
+                                                  'data': request.get_data(as_text=True)[:4096]})
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/setup', methods=['POST'])
-def setup_repository():
-    app.logger.info("Received setup request")
-    app.logger.info(f"Request form: {request.form}")
-    app.logger.info(f"Request data: {request.data}")
+def is_checked(value):
+    return (value or '').lower() in ('1', 'true', 'on', 'yes')
+
+def start_setup(endpoint, resume=False):
+    # Clients may choose the job id up front so they can cancel the setup while it runs
+    job_id = parse_job_id(request.form.get('job_id')) or str(uuid.uuid4())
+    current_job_id.set(job_id)
+    log_request_payload(endpoint)
 
     repo_url = request.form.get('repo_url')
     custom_path = request.form.get('custom_path', '')
     python_version = request.form.get('python_version', '')
+    precompile = is_checked(request.form.get('precompile'))
+    monorepo = is_checked(request.form.get('monorepo'))
+    profile = request.form.get('profile') or None
+    test_retries = request.form.get('test_retries', type=int)
+    rerun_failed = is_checked(request.form.get('rerun_failed'))
+    submodules = request.form.get('submodules')
+    clone_options = {
+        'submodules': is_checked(submodules) if submodules else None,
+        'lfs': request.form.get('lfs') or None,
+        'lfs_include': [pattern.strip() for pattern in request.form.get('lfs_include', '').split(',')
+                        if pattern.strip()] or None
+    }
 
-    app.logger.info(f"Repo URL: {repo_url}")
-    app.logger.info(f"Custom path: {custom_path}")
-    app.logger.info(f"Python version: {python_version}")
+    app.logger.info(f"Received {endpoint} request", extra={'repo_url': repo_url, 'custom_path': custom_path,
+                                                          'python_version': python_version})
 
     if not is_valid_github_url(repo_url):
         return jsonify({'error': 'Invalid GitHub URL'}), 400
+    if clone_options['lfs'] not in (None, *LFS_MODES):
+        return jsonify({'error': f"Invalid LFS mode: {clone_options['lfs']}"}), 400
+    if profile not in (None, *PROFILE_MODES):
+        return jsonify({'error': f"Invalid profile mode: {profile}"}), 400
+    if test_retries is not None and test_retries < 0:
+        return jsonify({'error': f"Invalid number of test retries: {test_retries}"}), 400
 
-    try:
-        # Download repository
-        local_repo_path = download_repository(repo_url, custom_path)
+    if job_queue.get(job_id):
+        return jsonify({'error': f"Job {job_id} already exists"}), 409
+    duration = estimated_duration(repo_url)
+    if job_queue.pending() >= QUEUE_SIZE:
+        # Roughly when a worker frees up: one setup of this repository
+        retry_after = max(1, int(duration))
+        app.logger.warning(f"Rejected setup of {repo_url}: queue is full")
+        response = jsonify({'error': f"Setup queue is full, retry in {retry_after}s", 'job_id': job_id,
+                            'retry_after': retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
 
-        # Detect Python version
-        detected_version = detect_python_version(local_repo_path)
-        if not python_version or python_version == "Detection failed":
-            if detected_version:
-                python_version = detected_version
-            else:
-                raise ValueError("Unable to detect Python version. Please specify a version manually.")
+    # The setup runs on a worker; the client follows it at /jobs/<job_id>
+    job_queue.enqueue({'repo_url': repo_url, 'custom_path': custom_path, 'python_version': python_version,
+                       'precompile': precompile, 'clone_options': clone_options, 'monorepo': monorepo,
+                       'resume': resume, 'profile': profile, 'test_retries': test_retries,
+                       'rerun_failed': rerun_failed}, job_id, duration)
+    start_local_workers(LOCAL_WORKERS)
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
 
-        # Setup virtual environment
-        venv_path = setup_virtual_environment(local_repo_path, python_version)
+@app.route('/setup', methods=['POST'])
+def setup_repository():
+    return start_setup('setup')
 
-        # Install dependencies
-        install_dependencies(local_repo_path, venv_path)
+@app.route('/resume', methods=['POST'])
+def resume_setup():
+    # Same form as /setup; stages journaled by the previous attempt are skipped when still valid
+    return start_setup('resume', resume=True)
 
-        # Setup Git hooks
-        setup_git_hooks(local_repo_path)
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    return jsonify({'jobs': job_queue.list_jobs()})
 
-        # Check for tests and run them
-        tests_dir = check_tests_directory(local_repo_path)
-        test_results = run_tests(local_repo_path, venv_path) if tests_dir else None
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
 
-        return jsonify({
-            'success': True,
-            'message': 'Repository setup completed successfully',
-            'local_path': local_repo_path,
-            'detected_version': detected_version,
-            'used_version': python_version,
-            'test_results': test_results
-        })
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel(job_id):
+    app.logger.info(f"Received cancel request for job {job_id}")
+    status = job_queue.cancel(job_id)
+    if status is None or status in FINAL_STATUSES:
+        return jsonify({'error': 'Unknown or finished job'}), 404
+    if status == 'queued':
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'cancelled'})
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'cancelling'}), 202
+
+# Profiles are written by job id, so they stay downloadable after the job is gone
+PROFILE_FORMATS = {
+    'trace': ('trace.json', 'application/json'),
+    'folded': ('folded', 'text/plain'),
+    'python': ('python.folded', 'text/plain'),
+    'pstats': ('pstats', 'application/octet-stream')
+}
+
+@app.route('/jobs/<job_id>/profile', methods=['GET'])
+def job_profile(job_id):
+    job_id = parse_job_id(job_id)
+    profile_format = PROFILE_FORMATS.get(request.args.get('format', 'trace'))
+    if not job_id or not profile_format:
+        return jsonify({'error': 'Invalid job id or profile format'}), 400
+    download_name = f"{job_id}.{profile_format[0]}"
+    # Workers publish profiles to the queue; a CLI run only leaves them in the local profile directory
+    data = job_queue.get_artifact(job_id, profile_format[0])
+    if data is not None:
+        return send_file(io.BytesIO(data), mimetype=profile_format[1], as_attachment=True,
+                         download_name=download_name)
+    path = os.path.join(PROFILE_DIR, download_name)
+    if not os.path.exists(path):
+        return jsonify({'error': 'No profile recorded for this job'}), 404
+    return send_file(path, mimetype=profile_format[1], as_attachment=True)
+
+@app.route('/capacity', methods=['GET'])
+def current_capacity():
+    # Admission is per process: this shows the budgets of the web server's own local workers, not remote ones
+    return jsonify(capacity())
+
+@app.route('/webhook/github', methods=['POST'])
+def github_webhook():
+    delivery = request.headers.get('X-GitHub-Delivery')
+    event = request.headers.get('X-GitHub-Event')
+    if not WEBHOOK_SECRET:
+        return jsonify({'error': 'Webhooks are not configured'}), 503
+    if not verify_signature(request.get_data(), request.headers.get('X-Hub-Signature-256')):
+        app.logger.warning(f"Rejected webhook delivery {delivery}: bad signature")
+        return jsonify({'error': 'Invalid signature'}), 401
+
+    if event == 'ping':
+        return jsonify({'success': True, 'message': 'pong'})
+    if event != 'push':
+        return jsonify({'success': True, 'ignored': f"Event {event} is not handled"})
+    try:
+        push = parse_push(json.loads(request.get_data()))
+    except (ValueError, KeyError, TypeError):
+        return jsonify({'error': 'Malformed push payload'}), 400
+    if not push:
+        return jsonify({'success': True, 'ignored': 'Not a push to the default branch'})
+    if not is_registered(push['full_name']):
+        app.logger.warning(f"Ignoring webhook delivery {delivery} for unregistered {push['full_name']}")
+        return jsonify({'error': f"Repository {push['full_name']} is not registered"}), 403
+
+    pushes = schedule_prewarm(push, job_queue)
+    start_local_workers(LOCAL_WORKERS)
+    app.logger.info(f"Scheduled prewarm of {push['full_name']} at {push['after']} (delivery {delivery})")
+    return jsonify({'success': True, 'repository': push['full_name'], 'commit': push['after'],
+                    'pending_pushes': pushes, 'debounce': WEBHOOK_DEBOUNCE}), 202
+
+def sync_history():
+    # Setups run by workers on other hosts reach this host's history through the queue
+    for record in job_queue.take_history():
+        import_setup(record)
 
+@app.route('/history', methods=['GET'])
+def history():
+    try:
+        sync_history()
+        since = request.args.get('since', type=float)
+        until = request.args.get('until', type=float)
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 50, type=int)
+        return jsonify(get_history(
+            repo_url=request.args.get('repo_url'),
+            status=request.args.get('status'),
+            since=since,
+            until=until,
+            page=page,
+            per_page=per_page
+        ))
+    except Exception as e:
+        app.logger.error(f"Error in history: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/history/stages', methods=['GET'])
+def history_stages():
+    try:
+        sync_history()
+        return jsonify(get_stage_durations(
+            repo_url=request.args.get('repo_url'),
+            stage=request.args.get('stage'),
+            since=request.args.get('since', type=float),
+            limit=request.args.get('limit', 20, type=int)
+        ))
     except Exception as e:
-        app.logger.error(f"Error in setup_repository: {str(e)}")
+        app.logger.error(f"Error in history_stages: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/history/tests', methods=['GET'])
+def history_tests():
+    repo_url = request.args.get('repo_url')
+    if not repo_url:
+        return jsonify({'error': 'repo_url is required'}), 400
+    try:
+        sync_history()
+        return jsonify(get_test_durations(
+            repo_url,
+            test_id=request.args.get('test_id'),
+            since=request.args.get('since', type=float),
+            limit=request.args.get('limit', 20, type=int)
+        ))
+    except Exception as e:
+        app.logger.error(f"Error in history_tests: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/detect_version', methods=['POST'])
 def detect_version():
+    current_job_id.set(str(uuid.uuid4()))
+    log_request_payload('detect_version')
     repo_url = request.form.get('repo_url')
     app.logger.info(f"Received detect_version request for URL: {repo_url}")
 
@@ -119,5 +286,56 @@ def detect_version():
             'message': str(e)
         }), 500
 
+def detect_one(repo_url):
+    try:
+        detected_version = detect_python_version(repo_url)
+        if detected_version:
+            return {'repo_url': repo_url, 'success': True, 'python_version': detected_version}
+        return {'repo_url': repo_url, 'success': False, 'error': 'No Python version detected'}
+    except Exception as e:
+        app.logger.error(f"Error detecting version for {repo_url}: {str(e)}")
+        return {'repo_url': repo_url, 'success': False, 'error': 'Error detecting Python version', 'message': str(e)}
+
+@app.route('/detect_versions', methods=['POST'])
+def detect_versions():
+    current_job_id.set(str(uuid.uuid4()))
+    log_request_payload('detect_versions')
+
+    # A JSON list, {"repo_urls": [...]}, or repeated repo_url form fields
+    payload = request.get_json(silent=True)
+    if isinstance(payload, list):
+        repo_urls = payload
+    elif isinstance(payload, dict):
+        repo_urls = payload.get('repo_urls')
+    else:
+        repo_urls = request.form.getlist('repo_url')
+    if not isinstance(repo_urls, list) or not repo_urls:
+        return jsonify({'error': 'Expected a non-empty list of repo_urls'}), 400
+    if not all(isinstance(repo_url, str) for repo_url in repo_urls):
+        return jsonify({'error': 'Every repo_url must be a string'}), 400
+    if len(repo_urls) > DETECT_BATCH_LIMIT:
+        return jsonify({'error': f'At most {DETECT_BATCH_LIMIT} repositories per batch'}), 400
+
+    repo_urls = list(dict.fromkeys(repo_urls))
+    app.logger.info(f"Received detect_versions request for {len(repo_urls)} repositories")
+
+    def generate():
+        futures = []
+        try:
+            for repo_url in repo_urls:
+                if not is_valid_github_url(repo_url):
+                    yield json.dumps({'repo_url': repo_url, 'success': False, 'error': 'Invalid GitHub URL'}) + '\n'
+                else:
+                    futures.append(detect_executor.submit(detect_one, repo_url))
+            # Results are streamed in completion order, one JSON object per line
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + '\n'
+        finally:
+            # The client went away: don't keep detecting for nobody
+            for future in futures:
+                future.cancel()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
     app.run(debug=True)
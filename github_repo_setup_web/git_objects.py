@@ -0,0 +1,110 @@
+import os
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# Seconds any one git command may take; these run in worker threads that stage deadlines can't stop
+GIT_TIMEOUT = float(os.getenv('SETUP_GIT_OBJECTS_TIMEOUT', 300))
+
+def git(git_dir, *args, **kwargs):
+    return subprocess.run(["git", f"--git-dir={git_dir}"] + list(args), check=True,
+                          capture_output=True, timeout=GIT_TIMEOUT, **kwargs)
+
+def normalize_remote(repo_url):
+    # Shallow and filtered fetches need a real transport; plain local paths bypass it
+    if os.path.isdir(repo_url):
+        return f"file://{os.path.abspath(repo_url)}"
+    return repo_url
+
+@contextmanager
+def fetched_tip(repo_url, ref='HEAD'):
+    git_dir = tempfile.mkdtemp(prefix='repo-setup-objects-')
+    try:
+        git(git_dir, 'init', '--bare', '--quiet')
+        git(git_dir, 'remote', 'add', 'origin', normalize_remote(repo_url))
+        # Blobless, depth 1: one commit plus its trees, blobs are fetched on demand
+        git(git_dir, 'config', 'remote.origin.promisor', 'true')
+        git(git_dir, 'config', 'remote.origin.partialclonefilter', 'blob:none')
+        git(git_dir, 'fetch', '--quiet', '--depth', '1', '--filter=blob:none', '--no-tags', 'origin', ref)
+        commit = git(git_dir, 'rev-parse', 'FETCH_HEAD', text=True).stdout.strip()
+        yield git_dir, commit
+    finally:
+        shutil.rmtree(git_dir, ignore_errors=True)
+
+def list_tree(git_dir, commit, recursive=True):
+    args = ['ls-tree', '-z', '--full-tree']
+    if recursive:
+        args.append('-r')
+    output = git(git_dir, *args, commit).stdout
+    entries = {}
+    for item in output.split(b'\0'):
+        if not item:
+            continue
+        meta, path = item.split(b'\t', 1)
+        mode, obj_type, oid = meta.split()
+        if obj_type == b'blob':
+            entries[path.decode('utf-8', 'replace')] = oid.decode()
+    return entries
+
+def prefetch_blobs(git_dir, oids):
+    # A single fetch for all wanted blobs instead of one lazy fetch per object
+    if not oids:
+        return
+    try:
+        git(git_dir, 'fetch', '--quiet', '--no-tags', '--no-write-fetch-head', '--filter=blob:none', 'origin', *oids)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logging.debug(f"Blob prefetch failed, falling back to lazy fetch: {e.stderr}")
+
+def read_blobs(git_dir, oids):
+    oids = list(dict.fromkeys(oids))
+    if not oids:
+        return {}
+    prefetch_blobs(git_dir, oids)
+
+    process = subprocess.Popen(["git", f"--git-dir={git_dir}", 'cat-file', '--batch'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # Requests are written from a thread so a large batch can't deadlock on full pipes
+    def write_requests():
+        try:
+            process.stdin.write(''.join(f"{oid}\n" for oid in oids).encode())
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    writer = threading.Thread(target=write_requests, daemon=True)
+    writer.start()
+    # Lazy fetches of blobs the prefetch missed go over the network; a hung one is killed
+    watchdog = threading.Timer(GIT_TIMEOUT, process.kill)
+    watchdog.start()
+
+    blobs = {}
+    try:
+        for _ in oids:
+            header = process.stdout.readline().decode().split()
+            if not header:
+                break
+            if len(header) == 2 and header[1] == 'missing':
+                continue
+            oid, _, size = header
+            blobs[oid] = process.stdout.read(int(size))
+            process.stdout.read(1)
+    finally:
+        watchdog.cancel()
+        process.stdout.close()
+        writer.join()
+        process.wait()
+    if process.returncode == -signal.SIGKILL:
+        raise subprocess.TimeoutExpired(process.args, GIT_TIMEOUT)
+    return blobs
+
+def read_files(repo_url, wanted, ref='HEAD'):
+    # wanted() receives every blob path in the tip tree and returns the paths to read
+    with fetched_tip(repo_url, ref) as (git_dir, commit):
+        tree = list_tree(git_dir, commit)
+        paths = [path for path in wanted(sorted(tree)) if path in tree]
+        blobs = read_blobs(git_dir, [tree[path] for path in paths])
+        contents = {path: blobs[tree[path]] for path in paths if tree[path] in blobs}
+        return commit, tree, contents
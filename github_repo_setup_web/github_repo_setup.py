@@ -1,12 +1,42 @@
 import os
 import re
+import sys
+import shlex
+import json
+import time
+import shutil
+import asyncio
+import tempfile
 import subprocess
 import logging
 import requests
 import base64
+import toml
+from contextlib import contextmanager
 from github import Github
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from logging_config import current_stage
+from lockfiles import find_lockfile, manifest_fingerprint, requirements_fingerprint, cached_lock_path, write_generated_lock
+from tool_envs import get_tool, select_installer, prefetch_build_backend
+from git_objects import read_files
+from process import run_command
+from import_graph import update_index, iter_python_files, INDEX_NAME
+from version_inference import infer_minimum_version, INFERENCE_MAX_FILES, MAX_FILE_SIZE
+from journal import new_journal, record_stage, fingerprint
+from accounting import current_usage, new_usage, add_usage, directory_size, format_bytes
+from profiling import current_tracer, start_tracing, stop_tracing, PROFILE_MODES
+from test_results import (
+    load_report,
+    save_report,
+    failing_names,
+    merge_results,
+    new_report,
+    tests_passed,
+    executed_tests,
+    FAILING_STATUSES,
+    TEST_RETRIES
+)
 
 # Load environment variables
 load_dotenv()
@@ -97,11 +127,16 @@ def get_github_url():
             return url
         print_error("Invalid GitHub URL. Please enter a valid URL (e.g., https://github.com/username/repo).")
 
-def create_local_directory(repo_name, custom_path=None):
+def base_directory(custom_path=None):
     if custom_path:
-        base_dir = os.path.expanduser(custom_path)
-    else:
-        base_dir = os.path.expanduser("~/github_projects")
+        return os.path.expanduser(custom_path)
+    return os.path.expanduser("~/github_projects")
+
+def repo_directory(url, custom_path=None):
+    return os.path.join(base_directory(custom_path), url.split("/")[-1].replace(".git", ""))
+
+def create_local_directory(repo_name, custom_path=None):
+    base_dir = base_directory(custom_path)
     try:
         os.makedirs(base_dir, exist_ok=True)
         local_dir = os.path.join(base_dir, repo_name)
@@ -120,25 +155,210 @@ def get_custom_path():
             return custom_path
         print_error("Please enter an absolute path.")
 
-def download_repository(url, custom_path=None):
-    if not check_git_installed():
+# Defaults for clone_options; the web form and the pipeline can override them per setup
+DEFAULT_CLONE_OPTIONS = {
+    'submodules': os.getenv('SETUP_SUBMODULES', '1') == '1',
+    'submodule_jobs': int(os.getenv('SETUP_SUBMODULE_JOBS', 8)),
+    'shallow_submodules': os.getenv('SETUP_SHALLOW_SUBMODULES', '1') == '1',
+    # fetch: download LFS objects during setup; skip: keep pointer files; defer: fetch alongside later stages
+    'lfs': os.getenv('SETUP_LFS', 'fetch'),
+    'lfs_include': [pattern for pattern in os.getenv('SETUP_LFS_INCLUDE', '').split(',') if pattern],
+}
+LFS_MODES = ['fetch', 'skip', 'defer']
+
+def clone_options_with_defaults(options=None):
+    options = {**DEFAULT_CLONE_OPTIONS, **{key: value for key, value in (options or {}).items() if value is not None}}
+    if options['lfs'] not in LFS_MODES:
+        raise ValueError(f"Invalid LFS mode: {options['lfs']} (expected one of {', '.join(LFS_MODES)})")
+    return options
+
+def is_local_remote(url):
+    return os.path.isdir(url) or url.startswith('file://')
+
+def git_config_args(url):
+    # Submodules of a local superproject are local too; git refuses the file transport by default
+    return ['-c', 'protocol.file.allow=always'] if is_local_remote(url) else []
+
+def uses_submodules(repo_path):
+    return os.path.exists(os.path.join(repo_path, '.gitmodules'))
+
+def skips_lfs_smudge(clone_options):
+    return clone_options['lfs'] != 'fetch' or bool(clone_options['lfs_include'])
+
+def uses_lfs(repo_path):
+    try:
+        with open(os.path.join(repo_path, '.gitattributes'), 'r') as f:
+            return 'filter=lfs' in f.read()
+    except OSError:
+        return False
+
+async def download_repository_async(url, custom_path=None, clone_options=None, replace_partial=False):
+    clone_options = clone_options_with_defaults(clone_options)
+    if not await asyncio.to_thread(check_git_installed):
         print_error("Git is not installed. Please install Git and try again.")
         suggest_git_installation()
-        sys.exit(1)
+        raise RuntimeError("Git is not installed")
 
     repo_name = url.split("/")[-1].replace(".git", "")
     local_repo_path = create_local_directory(repo_name, custom_path)
     if not local_repo_path:
         print_error("Failed to create local directory. Exiting.")
-        sys.exit(1)
+        raise RuntimeError("Failed to create local directory")
+
+    # Checkout leaves LFS pointer files; fetch_lfs_objects_async downloads what is needed
+    env = {**os.environ, 'GIT_LFS_SKIP_SMUDGE': '1'} if skips_lfs_smudge(clone_options) else None
 
+    if os.path.isdir(os.path.join(local_repo_path, '.git')):
+        if not replace_partial:
+            print_error(f"{local_repo_path} already contains a checkout.")
+            raise RuntimeError(f"Repository already exists at {local_repo_path}; resume the previous setup instead")
+        # Resuming a setup whose clone never completed, e.g. its worker died: what is there is half a clone
+        print_warning(f"Removing the incomplete checkout in {local_repo_path} and cloning again.")
+        await asyncio.to_thread(shutil.rmtree, local_repo_path)
+        os.makedirs(local_repo_path)
+
+    was_empty = not os.listdir(local_repo_path)
     try:
-        subprocess.run(["git", "clone", url, local_repo_path], check=True)
+        await run_command(["git", "clone", url, local_repo_path], env=env, resource='network')
+        # The object store is what came over the wire (packs are stored as received)
+        add_usage(network_bytes=await asyncio.to_thread(directory_size, os.path.join(local_repo_path, '.git', 'objects')))
         print_success(f"Repository cloned successfully to {local_repo_path}")
         return local_repo_path
     except subprocess.CalledProcessError as e:
         print_error(f"Failed to clone repository: {e}")
-        sys.exit(1)
+        raise RuntimeError(f"Failed to clone repository: {e}")
+    except asyncio.CancelledError:
+        # Timed out or cancelled: don't leave a half-cloned directory behind
+        if was_empty:
+            shutil.rmtree(local_repo_path, ignore_errors=True)
+        raise
+
+def download_repository(url, custom_path=None, clone_options=None):
+    return asyncio.run(download_repository_async(url, custom_path, clone_options))
+
+async def update_checkout_async(repo_path, url, branch=None):
+    # Incremental: only new objects are fetched, and the checkout is only fast-forwarded, never reset.
+    # Without a branch, the one checked out is updated.
+    args = ["git"] + git_config_args(url)
+    try:
+        current = await run_command(args + ["symbolic-ref", "--short", "HEAD"], cwd=repo_path, capture_output=True)
+        current_branch = current.stdout.decode(errors='replace').strip()
+        branch = branch or current_branch
+        if current_branch != branch:
+            raise RuntimeError(f"{repo_path} has {current_branch} checked out, not {branch}")
+        await run_command(args + ["fetch", "--no-tags", "origin", f"refs/heads/{branch}"], cwd=repo_path,
+                          capture_output=True, resource='network')
+        await run_command(args + ["merge", "--ff-only", "FETCH_HEAD"], cwd=repo_path, capture_output=True,
+                          resource='disk')
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode(errors='replace').strip() if e.stderr else str(e)
+        raise RuntimeError(f"Failed to update {repo_path}: {stderr}")
+    return repo_path
+
+UNSHALLOW = ("if [ \"$(git rev-parse --is-shallow-repository)\" = true ]; then "
+             "git fetch --quiet --unshallow origin '+refs/heads/*:refs/remotes/origin/*'; fi")
+
+async def fetch_submodules_async(repo_path, url, clone_options=None):
+    clone_options = clone_options_with_defaults(clone_options)
+    if not clone_options['submodules'] or not uses_submodules(repo_path):
+        return False
+
+    env = {**os.environ, 'GIT_LFS_SKIP_SMUDGE': '1'} if skips_lfs_smudge(clone_options) else None
+    args = ["git"] + git_config_args(url) + ["submodule", "update", "--init", "--recursive",
+                                             "--jobs", str(clone_options['submodule_jobs'])]
+    try:
+        if clone_options['shallow_submodules']:
+            try:
+                await run_command(args + ["--depth", "1"], cwd=repo_path, env=env, capture_output=True,
+                                  resource='network')
+            except subprocess.CalledProcessError as e:
+                # Servers that refuse fetching a non-tip commit by id need the full history
+                logging.warning(f"Shallow submodule fetch failed, retrying with full history: "
+                                f"{e.stderr.decode(errors='replace').strip() if e.stderr else e}")
+                # Submodules cloned by the failed attempt stay shallow and single-branch unless deepened
+                await run_command(["git"] + git_config_args(url) + ["submodule", "foreach", "--recursive", UNSHALLOW],
+                                  cwd=repo_path, env=env, capture_output=True, resource='network')
+                await run_command(args, cwd=repo_path, env=env, resource='network')
+        else:
+            await run_command(args, cwd=repo_path, env=env, resource='network')
+    except subprocess.CalledProcessError as e:
+        print_error(f"Failed to fetch submodules: {e}")
+        raise RuntimeError(f"Failed to fetch submodules: {e}")
+
+    add_usage(network_bytes=await asyncio.to_thread(directory_size, os.path.join(repo_path, '.git', 'modules')))
+    print_success("Submodules fetched successfully.")
+    return True
+
+async def fetch_lfs_objects_async(repo_path, clone_options=None):
+    clone_options = clone_options_with_defaults(clone_options)
+    if clone_options['lfs'] == 'skip' or not uses_lfs(repo_path):
+        return False
+    if not skips_lfs_smudge(clone_options):
+        # Already smudged during checkout
+        return False
+    if not shutil.which('git-lfs'):
+        print_warning("Git LFS is not installed; large files are left as pointer files.")
+        return False
+
+    args = ["git", "lfs", "pull"]
+    if clone_options['lfs_include']:
+        args += ["--include", ','.join(clone_options['lfs_include'])]
+    try:
+        await run_command(args, cwd=repo_path, capture_output=True, resource='network')
+        if clone_options['submodules'] and uses_submodules(repo_path):
+            # foreach runs its command through a shell, and the include patterns come from the request
+            await run_command(["git", "submodule", "foreach", "--recursive", shlex.join(args)],
+                              cwd=repo_path, capture_output=True, resource='network')
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode(errors='replace').strip() if e.stderr else str(e)
+        print_error(f"Failed to fetch LFS objects: {stderr}")
+        raise RuntimeError(f"Failed to fetch LFS objects: {stderr}")
+
+    add_usage(network_bytes=await asyncio.to_thread(directory_size, os.path.join(repo_path, '.git', 'lfs')))
+    print_success("LFS objects fetched successfully.")
+    return True
+
+async def get_commit_sha_async(repo_path):
+    if not repo_path:
+        return None
+    try:
+        result = await run_command(["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True)
+        return result.stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError, NotADirectoryError):
+        return None
+
+def get_commit_sha(repo_path):
+    return asyncio.run(get_commit_sha_async(repo_path))
+
+@contextmanager
+def timed_stage(durations, stage, usage=None):
+    token = current_stage.set(stage)
+    stage_usage = new_usage()
+    stage_usage['started_at'] = time.time()
+    usage_token = current_usage.set(stage_usage)
+    tracer = current_tracer.get()
+    trace_start = tracer.now() if tracer else None
+    start = time.monotonic()
+    try:
+        yield stage_usage
+    finally:
+        durations[stage] = time.monotonic() - start
+        stage_usage['wall_time'] = durations[stage]
+        if tracer:
+            tracer.span('stage', stage, trace_start, usage=stage_usage)
+        if usage is not None:
+            usage[stage] = stage_usage
+        current_usage.reset(usage_token)
+        current_stage.reset(token)
+        logging.info(f"Stage {stage} finished in {durations[stage]:.2f}s", extra={'usage': stage_usage})
+
+def print_stage_usage(usage):
+    for stage, values in usage.items():
+        print_info(f"  {stage}: {values['wall_time']:.1f}s wall, "
+                   f"{values['cpu_user']:.1f}s user, {values['cpu_sys']:.1f}s sys, "
+                   f"peak RSS {format_bytes(values['peak_rss_bytes'])}, "
+                   f"disk written {format_bytes(values['disk_write_bytes'])}, "
+                   f"network {format_bytes(values['network_bytes'])}")
 
 def suggest_git_installation():
     print_info("To install Git, you can:")
@@ -161,54 +381,100 @@ def detect_python_version(repo_or_url):
     if os.path.isdir(repo_or_url):
         return detect_local_python_version(repo_or_url)
     elif is_valid_github_url(repo_or_url):
+        if os.getenv('SETUP_DETECTION_MODE') == 'git':
+            return detect_remote_python_version(repo_or_url)
         return detect_github_python_version(repo_or_url)
     else:
         logging.error(f"Invalid input: {repo_or_url}")
         return None
 
+LOCAL_VERSION_FILES = ['.python-version', 'runtime.txt', 'pyproject.toml', 'setup.py']
+
+def parse_version_file(file, content):
+    content = content.strip()
+    if file == '.python-version':
+        return content
+    elif file == 'runtime.txt':
+        if content.startswith('python-'):
+            return content.split('-')[1].strip()
+    elif file == 'pyproject.toml':
+        try:
+            data = toml.loads(content)
+            requires_python = data.get('project', {}).get('requires-python')
+            if requires_python:
+                match = re.search(r'>=(\d+\.\d+)', requires_python)
+                if match:
+                    return match.group(1)
+        except Exception as e:
+            logging.warning(f"Error parsing pyproject.toml: {str(e)}")
+    elif file == 'setup.py':
+        match = re.search(r'python_requires\s*=\s*[\'"]([^\'"]+)[\'"]', content)
+        if match:
+            version_spec = match.group(1)
+            match = re.search(r'>=(\d+\.\d+)', version_spec)
+            if match:
+                return match.group(1)
+    return None
+
+def infer_python_version(sources, origin):
+    result = infer_minimum_version(sources)
+    if not result:
+        return None
+    version, reasons = result
+    logging.info(f"Inferred minimum Python {version} for {origin} from {len(sources)} file(s): {'; '.join(reasons)}")
+    return version
+
 def detect_local_python_version(directory):
-    version_files = ['.python-version', 'runtime.txt', 'pyproject.toml', 'setup.py']
-    for file in version_files:
+    for file in LOCAL_VERSION_FILES:
         file_path = os.path.join(directory, file)
         if os.path.exists(file_path):
             with open(file_path, 'r') as f:
-                content = f.read().strip()
-                if file == '.python-version':
-                    return content
-                elif file == 'runtime.txt':
-                    if content.startswith('python-'):
-                        return content.split('-')[1].strip()
-                elif file == 'pyproject.toml':
-                    try:
-                        data = toml.loads(content)
-                        requires_python = data.get('project', {}).get('requires-python')
-                        if requires_python:
-                            match = re.search(r'>=(\d+\.\d+)', requires_python)
-                            if match:
-                                return match.group(1)
-                    except Exception as e:
-                        logging.warning(f"Error parsing pyproject.toml: {str(e)}")
-                elif file == 'setup.py':
-                    match = re.search(r'python_requires\s*=\s*[\'"]([^\'"]+)[\'"]', content)
-                    if match:
-                        version_spec = match.group(1)
-                        match = re.search(r'>=(\d+\.\d+)', version_spec)
-                        if match:
-                            return match.group(1)
-
-    # Check shebang in Python files
-    python_files = search_python_files(directory)
-    for file in python_files[:5]:  # Check first 5 Python files
-        with open(file, 'r') as f:
-            first_line = f.readline().strip()
-            if first_line.startswith('#!') and 'python' in first_line:
-                version = first_line.split('python')[-1].strip()
-                if version:
-                    return version
+                version = parse_version_file(file, f.read())
+            if version:
+                return version
+
+    # No declared version: infer the minimum from the syntax and stdlib modules the sources use. Files are cut
+    # the way infer_minimum_version cuts them, before any is read, so a huge repository costs only the limit.
+    paths = sorted(path for path in iter_python_files(directory)
+                   if os.path.getsize(os.path.join(directory, path)) <= MAX_FILE_SIZE)
+    sources = {}
+    for path in paths[:INFERENCE_MAX_FILES]:
+        with open(os.path.join(directory, path), 'rb') as f:
+            sources[path] = f.read()
+    version = infer_python_version(sources, directory)
+    if version:
+        return version
 
     logging.warning("No Python version detected in local repository")
     return None
 
+def detect_remote_python_version(repo_url, ref='HEAD'):
+    logging.info(f"Detecting Python version from git objects: {repo_url}")
+
+    def wanted(paths):
+        python_files = [path for path in paths if path.endswith('.py')]
+        return LOCAL_VERSION_FILES + python_files[:INFERENCE_MAX_FILES]
+
+    try:
+        commit, _, contents = read_files(repo_url, wanted, ref)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logging.error(f"Failed to fetch {repo_url}: {e.stderr.decode(errors='replace') if e.stderr else e}")
+        return None
+
+    for file in LOCAL_VERSION_FILES:
+        if file in contents:
+            version = parse_version_file(file, contents[file].decode('utf-8', 'replace'))
+            if version:
+                return version
+
+    version = infer_python_version({path: content for path, content in contents.items() if path.endswith('.py')},
+                                   f"{repo_url}@{commit[:12]}")
+    if version:
+        return version
+
+    logging.warning(f"No Python version detected at commit {commit}")
+    return None
+
 def detect_github_python_version(repo_url):
     logging.info(f"Detecting Python version for GitHub repository: {repo_url}")
     try:
@@ -283,7 +549,8 @@ def detect_github_python_version(repo_url):
             python_files = [file for file in contents if file.name.endswith('.py')]
             if python_files:
                 logging.info(f"Found Python files in the repository: {[file.name for file in python_files]}")
-                return "3.6"  # Assume a minimum supported version if Python files are present
+                # Infer the minimum version from the sources, read from git objects rather than the API
+                return detect_remote_python_version(repo_url)
             else:
                 logging.warning("No Python files found in the repository")
 
@@ -293,8 +560,9 @@ def detect_github_python_version(repo_url):
         logging.warning("No Python version detected in GitHub repository")
         return None
     except Exception as e:
+        # The API is unavailable (rate limits, no token, outage): read the manifests from git instead
         logging.error(f"Error in detect_github_python_version: {str(e)}")
-        return None
+        return detect_remote_python_version(repo_url)
 
 def recommend_python_version(directory):
     detected_version = detect_python_version(directory)
@@ -326,8 +594,8 @@ def recommend_python_version(directory):
         else:
             print("Invalid version format. Please use the format 'X.Y' (e.g., 3.8).")
 
-def setup_virtual_environment(repo_path, python_version):
-    venv_path = os.path.join(repo_path, 'venv')
+async def setup_virtual_environment_async(repo_path, python_version, venv_path=None):
+    venv_path = venv_path or os.path.join(repo_path, 'venv')
 
     # Extract the minimum Python version from the version string
     version_match = re.search(r'(\d+\.\d+)', python_version)
@@ -338,65 +606,223 @@ def setup_virtual_environment(repo_path, python_version):
 
     try:
         # Use the minimum version to create the virtual environment
-        subprocess.run([f"python{min_version}", "-m", "venv", venv_path], check=True)
+        await run_command([f"python{min_version}", "-m", "venv", venv_path], resource='disk')
         print_success(f"Virtual environment created at {venv_path}")
 
-        # Activate the virtual environment
-        activate_script = os.path.join(venv_path, 'bin', 'activate')
-        activate_command = f"source {activate_script}"
-
         # Update pip and install wheel
-        subprocess.run(f"{activate_command} && pip install --upgrade pip wheel", shell=True, check=True)
+        await run_command([os.path.join(venv_path, 'bin', 'python'), '-m', 'pip', 'install', '--upgrade', 'pip', 'wheel'],
+                          resource='network')
         print_success("Pip upgraded and wheel installed in the virtual environment")
 
         return venv_path
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
         print_error(f"Failed to set up virtual environment: {e}")
         suggest_python_installation(min_version)
         return None
+    except asyncio.CancelledError:
+        shutil.rmtree(venv_path, ignore_errors=True)
+        raise
 
-def install_dependencies(venv_path, repo_path):
-    requirements_file = os.path.join(repo_path, 'requirements.txt')
-    pyproject_file = os.path.join(repo_path, 'pyproject.toml')
+def setup_virtual_environment(repo_path, python_version, venv_path=None):
+    return asyncio.run(setup_virtual_environment_async(repo_path, python_version, venv_path))
 
-    if os.path.exists(requirements_file):
-        print("Found requirements.txt. Installing dependencies...")
+def venv_python_version(venv_path):
+    try:
+        with open(os.path.join(venv_path, 'pyvenv.cfg'), 'r') as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() in ('version', 'version_info'):
+                    return value.strip()
+    except OSError:
+        pass
+    return None
+
+def venv_environment(venv_path):
+    env = os.environ.copy()
+    env.pop('PYTHONHOME', None)
+    env['VIRTUAL_ENV'] = venv_path
+    env['PATH'] = os.path.join(venv_path, 'bin') + os.pathsep + env.get('PATH', '')
+    return env
+
+async def install_from_lockfile(venv_path, repo_path, kind, lock_path, cache_hits=None):
+    pip_path = os.path.join(venv_path, 'bin', 'pip')
+    env = venv_environment(venv_path)
+    if kind == 'poetry':
+        # With a lock present poetry installs the locked set without resolving
+        poetry = await asyncio.to_thread(get_tool, 'poetry', cache_hits)
+        await run_command([poetry, 'install', '--no-interaction'], cwd=repo_path, env=env, resource='network')
+    elif kind == 'pipenv':
+        pipenv = await asyncio.to_thread(get_tool, 'pipenv', cache_hits)
+        await run_command([pipenv, 'sync'], cwd=repo_path, env=env, resource='network')
+    elif kind == 'pdm':
+        pdm = await asyncio.to_thread(get_tool, 'pdm', cache_hits)
+        await run_command([pdm, 'sync', '--no-self'], cwd=repo_path, env=env, resource='network')
+    elif kind == 'pip':
+        await run_command([pip_path, 'install', '--require-hashes', '--no-deps', '-r', lock_path], cwd=repo_path,
+                          resource='network')
+
+async def install_project(venv_path, repo_path, installer, cache_hits=None):
+    env = venv_environment(venv_path)
+    if installer in ('poetry', 'pdm', 'pipenv'):
+        tool = await asyncio.to_thread(get_tool, installer, cache_hits)
+        await run_command([tool, 'install', '--no-interaction' if installer == 'poetry' else '--quiet'],
+                          cwd=repo_path, env=env, resource='network')
+    else:
         pip_path = os.path.join(venv_path, 'bin', 'pip')
+        wheelhouse = await asyncio.to_thread(prefetch_build_backend, repo_path, cache_hits)
+        if wheelhouse and await install_built_wheel(pip_path, repo_path, wheelhouse, env):
+            return
+        await run_command([pip_path, 'install', '.'], cwd=repo_path, env=env, resource='network')
+
+async def install_built_wheel(pip_path, repo_path, wheelhouse, env):
+    # --find-links alone still has pip query the index for the build backend. Building with --no-index takes it
+    # from the wheelhouse only; the project's own dependencies then come from the index as usual.
+    wheel_dir = tempfile.mkdtemp(prefix='repo-setup-wheel-')
+    try:
         try:
-            subprocess.run([pip_path, 'install', '-r', requirements_file], check=True)
-            print("Dependencies installed successfully.")
-            return True
+            await run_command([pip_path, 'wheel', '--no-deps', '--no-index', '--find-links', wheelhouse,
+                               '--wheel-dir', wheel_dir, '.'], cwd=repo_path, env=env, capture_output=True)
         except subprocess.CalledProcessError as e:
-            print(f"Error installing dependencies: {e}")
+            # e.g. the backend asks for more than its declared requirements
+            logging.warning(f"Building {repo_path} from the wheelhouse failed, building with the index: {str(e)}")
             return False
-    elif os.path.exists(pyproject_file):
-        print("Found pyproject.toml. Installing dependencies using poetry...")
-        poetry_path = os.path.join(venv_path, 'bin', 'poetry')
+        wheels = [os.path.join(wheel_dir, name) for name in os.listdir(wheel_dir) if name.endswith('.whl')]
+        await run_command([pip_path, 'install'] + wheels, cwd=repo_path, env=env, resource='network')
+        return True
+    finally:
+        await asyncio.to_thread(shutil.rmtree, wheel_dir, True)
+
+async def install_dependencies_async(venv_path, repo_path, cache_hits=None):
+    requirements_file = os.path.join(repo_path, 'requirements.txt')
+    pyproject_file = os.path.join(repo_path, 'pyproject.toml')
+    pipfile = os.path.join(repo_path, 'Pipfile')
+    pip_path = os.path.join(venv_path, 'bin', 'pip')
+
+    kind, lock_path = find_lockfile(repo_path)
+    if kind:
+        print(f"Found {os.path.basename(lock_path)}. Installing locked dependencies...")
         try:
-            subprocess.run(['pip', 'install', 'poetry'], check=True)  # Install poetry if not available
-            subprocess.run([poetry_path, 'install'], cwd=repo_path, check=True)
-            print("Dependencies installed successfully using poetry.")
+            await install_from_lockfile(venv_path, repo_path, kind, lock_path, cache_hits)
+            print("Locked dependencies installed successfully.")
             return True
         except subprocess.CalledProcessError as e:
-            print(f"Error installing dependencies with poetry: {e}")
+            print(f"Error installing locked dependencies: {e}")
             return False
-    else:
-        print("No requirements.txt or pyproject.toml found. Skipping dependency installation.")
+
+    if not any(os.path.exists(path) for path in (requirements_file, pyproject_file, pipfile)):
+        print("No requirements.txt, pyproject.toml or Pipfile found. Skipping dependency installation.")
         return True
 
-def setup_git_hooks(repo_path):
+    fingerprint = manifest_fingerprint(repo_path, venv_python_version(venv_path))
+    cached_lock = cached_lock_path(fingerprint)
+    try:
+        if os.path.exists(cached_lock):
+            print("Found a lock generated by a previous setup. Installing locked dependencies...")
+            await run_command([pip_path, 'install', '--no-deps', '-r', cached_lock], resource='network')
+            if not os.path.exists(requirements_file) and os.path.exists(pyproject_file):
+                await run_command([pip_path, 'install', '--no-deps', '.'], cwd=repo_path, resource='network')
+            if cache_hits is not None:
+                cache_hits.append('lock')
+            print("Dependencies installed successfully.")
+            return True
+
+        if os.path.exists(requirements_file):
+            print("Found requirements.txt. Installing dependencies...")
+            await run_command([pip_path, 'install', '-r', requirements_file], resource='network')
+        else:
+            installer = select_installer(repo_path)
+            print(f"Found {'pyproject.toml' if os.path.exists(pyproject_file) else 'Pipfile'}. "
+                  f"Installing dependencies using {installer}...")
+            await install_project(venv_path, repo_path, installer, cache_hits)
+        print("Dependencies installed successfully.")
+    except subprocess.CalledProcessError as e:
+        print(f"Error installing dependencies: {e}")
+        return False
+
+    try:
+        result = await run_command([pip_path, 'freeze', '--exclude-editable'], capture_output=True, text=True)
+        write_generated_lock(result.stdout, fingerprint, venv_path)
+        print("Generated a lock of the installed dependencies for future setups.")
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.warning(f"Failed to generate dependency lock: {str(e)}")
+    return True
+
+def install_dependencies(venv_path, repo_path, cache_hits=None):
+    return asyncio.run(install_dependencies_async(venv_path, repo_path, cache_hits))
+
+async def precompile_environment_async(venv_path, repo_path, workers=0, invalidation_mode=None):
+    python_path = os.path.join(venv_path, 'bin', 'python')
+    invalidation_mode = invalidation_mode or os.getenv('SETUP_PYC_INVALIDATION')
+    try:
+        result = await run_command([python_path, '-c', "import sysconfig; print(sysconfig.get_paths()['purelib'])"],
+                                   capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        print_warning(f"Bytecode precompilation skipped: {e}")
+        return False
+    site_packages = result.stdout.strip()
+
+    # -j 0 uses one worker process per CPU
+    command = [python_path, '-m', 'compileall', '-q', '-j', str(workers)]
+    if invalidation_mode:
+        command += ['--invalidation-mode', invalidation_mode]
+    # Two passes: site-packages lies inside the venv, which the project pass skips when the venv is in the checkout
+    errors = []
+    for targets in ([site_packages], ['-x', re.escape(os.path.abspath(venv_path)), repo_path]):
+        try:
+            await run_command(command + targets, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            # compileall exits non-zero when any file has a syntax error; the rest is still compiled
+            errors.append(e)
+    if errors:
+        print_warning(f"Bytecode precompilation finished with errors: {errors[0]}")
+        return False
+    print_success("Bytecode precompiled for the virtual environment and project sources.")
+    return True
+
+def precompile_environment(venv_path, repo_path, workers=0, invalidation_mode=None):
+    return asyncio.run(precompile_environment_async(venv_path, repo_path, workers, invalidation_mode))
+
+def prompt_for_precompile():
+    while True:
+        choice = input("Do you want to precompile bytecode for faster first runs? (y/n): ").lower()
+        if choice in ['y', 'n']:
+            return choice == 'y'
+        print("Invalid input. Please enter 'y' or 'n'.")
+
+def setup_git_hooks(repo_path, venv_path=None):
     hooks_dir = os.path.join(repo_path, '.git', 'hooks')
     if not os.path.exists(hooks_dir):
         print("Git hooks directory not found. Skipping Git hooks setup.")
         return False
 
+    # The hook may be installed before the venv exists, so the interpreter is resolved at commit time
+    venv_path = os.path.abspath(venv_path or os.path.join(repo_path, 'venv'))
+    venv_python = os.path.join(venv_path, 'Scripts' if os.name == 'nt' else 'bin', 'python')
+
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_graph.py'),
+                os.path.join(hooks_dir, 'affected_tests.py'))
+
     pre_commit_hook = os.path.join(hooks_dir, 'pre-commit')
     with open(pre_commit_hook, 'w') as f:
-        f.write("""#!/bin/sh
-# Pre-commit hook to run tests before committing
-python -m unittest discover tests
+        f.write(f"""#!/bin/sh
+# Pre-commit hook to run the tests affected by the staged changes.
+# Set RUN_ALL_TESTS=1 to run the full suite instead.
+PYTHON="{venv_python}"
+if [ ! -x "$PYTHON" ]; then
+    PYTHON=python
+fi
+if [ -n "$RUN_ALL_TESTS" ]; then
+    exec "$PYTHON" -m unittest discover tests
+fi
+exec "$PYTHON" "$(git rev-parse --git-dir)/hooks/affected_tests.py" --python "$PYTHON"
 """)
     os.chmod(pre_commit_hook, 0o755)
+
+    # Build the import index now so the first commit only pays for the files it changed
+    try:
+        update_index(repo_path, os.path.join(repo_path, '.git', INDEX_NAME))
+    except OSError as e:
+        logging.warning(f"Failed to build import index: {str(e)}")
     print("Git pre-commit hook set up successfully.")
     return True
 
@@ -453,48 +879,177 @@ def check_tests_directory(repo_path):
     tests_dir = os.path.join(repo_path, 'tests')
     return os.path.isdir(tests_dir)
 
-def run_tests(repo_path, venv_path):
+# Runs inside the project's venv and reports each test; see test_runner.py
+TEST_RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_runner.py')
+
+async def run_test_suite(repo_path, venv_path, tests_dir, names=()):
+    python_path = os.path.join(venv_path, 'bin', 'python')
+    fd, report_file = tempfile.mkstemp(prefix='setup-tests-', suffix='.json')
+    os.close(fd)
+    try:
+        result = await run_command([python_path, TEST_RUNNER_PATH, report_file, tests_dir, *names], cwd=repo_path,
+                                   env=venv_environment(venv_path), capture_output=True, text=True, check=False)
+        # unittest reports on stderr
+        print(result.stderr)
+        try:
+            with open(report_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            # The runner itself crashed, e.g. the interpreter is too old to run it
+            return {'tests': [{'id': tests_dir, 'name': None, 'status': 'error', 'duration': 0.0, 'attempts': 1,
+                               'traceback': result.stderr}], 'duration': 0.0}
+    finally:
+        os.remove(report_file)
+
+async def run_tests_async(repo_path, venv_path, retries=None, rerun_failed=False):
     tests_dir = os.path.join(repo_path, 'tests')
     if not os.path.isdir(tests_dir):
         print("No tests directory found. Skipping test execution.")
-        return False
-
-    print("Running tests...")
-    try:
-        # Activate virtual environment and run tests
-        activate_script = os.path.join(venv_path, 'bin', 'activate')
-        test_command = f"source {activate_script} && python -m unittest discover {tests_dir}"
-        result = subprocess.run(test_command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        print("Tests executed successfully.")
-        print(result.stdout)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error running tests: {e}")
-        print(e.stderr)
-        return False
+        return None
+    retries = TEST_RETRIES if retries is None else retries
+
+    # Re-running failures picks up the previous report and replaces only the results of the tests it re-ran
+    previous = load_report(repo_path) if rerun_failed else None
+    names = failing_names(previous['tests']) if previous else []
+    if names:
+        print(f"Re-running {len(names)} failed test(s) from the previous run...")
+        run = await run_test_suite(repo_path, venv_path, tests_dir, names)
+        tests = merge_results(previous['tests'], run['tests'], retry=False)
+    else:
+        print("Running tests...")
+        run = await run_test_suite(repo_path, venv_path, tests_dir)
+        tests = run['tests']
+    duration = run['duration']
+
+    # Retried tests that pass are flaky; those failing every attempt are real failures
+    for attempt in range(1, retries + 1):
+        failing = failing_names(tests)
+        if not failing:
+            break
+        print(f"Retrying {len(failing)} failed test(s), attempt {attempt} of {retries}...")
+        run = await run_test_suite(repo_path, venv_path, tests_dir, failing)
+        tests = merge_results(tests, run['tests'], retry=True)
+        duration += run['duration']
+
+    report = new_report(tests, duration, retries, only_failed=bool(names))
+    save_report(repo_path, report)
+    print_test_report(report)
+    return report
+
+def run_tests(repo_path, venv_path, retries=None, rerun_failed=False):
+    return asyncio.run(run_tests_async(repo_path, venv_path, retries, rerun_failed))
+
+def print_test_report(report, slowest=5):
+    summary = report['summary']
+    print_info(f"Tests: {summary['passed']} passed, {summary['failed'] + summary['error']} failed, "
+               f"{summary['flaky']} flaky, {summary['skipped']} skipped in {summary['duration']:.1f}s")
+    for test in report['tests']:
+        if test['status'] in FAILING_STATUSES:
+            last_line = (test.get('traceback') or '').strip().splitlines()[-1:]
+            print_error(f"  {test['status'].upper()}: {test['id']}" + (f" - {last_line[0]}" if last_line else ''))
+        elif test['status'] == 'flaky':
+            print_warning(f"  FLAKY: {test['id']} (passed on attempt {test['attempts']})")
+    timed_tests = sorted((test for test in report['tests'] if test['duration'] >= 0.01),
+                         key=lambda test: test['duration'], reverse=True)[:slowest]
+    if timed_tests:
+        print_info("Slowest tests: " + ', '.join(f"{test['id']} ({test['duration']:.2f}s)" for test in timed_tests))
+
+def resume_setup(args):
+    from pipeline import run_setup
+
+    print_info(f"Resuming setup of {args.repo_url}")
+    result = asyncio.run(run_setup(args.repo_url, args.path or '', args.python or '', precompile=args.precompile,
+                                   resume=True, profile=args.profile, test_retries=args.retries,
+                                   rerun_failed=args.failed_only))
+    print_profile_paths(result.get('profile', {}))
+    if result['skipped_stages']:
+        print_info(f"Reused from the previous run: {', '.join(result['skipped_stages'])}")
+    print_stage_usage(result['stage_usage'])
+    if not result['success']:
+        print_error(result.get('error') or result['message'])
+        return 1
+    if result['status'] == 'tests_failed':
+        print_warning("Some tests failed. Please review the test output above.")
+        print_info(f"To re-run only the failed tests, run: python {os.path.basename(__file__)} resume "
+                   f"{args.repo_url} --failed-only" + (f" --path {args.path}" if args.path else ''))
+        return 1
+    print_success(f"Project setup completed in {result['local_path']}")
+    return 0
+
+def print_profile_paths(paths):
+    if paths.get('trace'):
+        print_info(f"Profile trace (open in chrome://tracing or ui.perfetto.dev): {paths['trace']}")
+    if paths.get('folded'):
+        print_info(f"Collapsed stacks for flamegraph.pl / speedscope: {paths['folded']}")
+    if paths.get('python_folded'):
+        print_info(f"Python collapsed stacks: {paths['python_folded']}")
 
 if __name__ == "__main__":
+    import argparse
+    from history import record_setup
+
+    profile_help = "Record a timeline of stages and commands; 'python' also profiles this process with cProfile"
+    parser = argparse.ArgumentParser(description="Set up a GitHub repository for local development.")
+    parser.add_argument('--profile', nargs='?', const='timeline', choices=PROFILE_MODES, help=profile_help)
+    commands = parser.add_subparsers(dest='command')
+    resume_parser = commands.add_parser('resume', help="Continue a failed setup from its first failed or changed stage")
+    resume_parser.add_argument('repo_url')
+    resume_parser.add_argument('--path', help="Custom download path used by the original setup")
+    resume_parser.add_argument('--python', help="Python version to use instead of the detected one")
+    resume_parser.add_argument('--precompile', action='store_true')
+    resume_parser.add_argument('--profile', nargs='?', const='timeline', choices=PROFILE_MODES,
+                               default=argparse.SUPPRESS, help=profile_help)
+    resume_parser.add_argument('--failed-only', action='store_true',
+                               help="Re-run only the tests that failed last time instead of the whole suite")
+    resume_parser.add_argument('--retries', type=int, help="Retry failing tests up to N times to tell flaky ones apart")
+    args = parser.parse_args()
+    if args.command == 'resume':
+        sys.exit(resume_setup(args))
+
+    tracing = start_tracing(f"setup-{time.strftime('%Y%m%d-%H%M%S')}", args.profile) if args.profile else None
+    started_at = time.time()
+    stages = {}
+    usage = {}
+    cache_hits = []
     try:
         print_info("GitHub Repository Setup Script")
         print_info("==============================")
 
         repo_url = get_github_url()
-        custom_path = get_custom_path()
-        local_repo_path = download_repository(repo_url, custom_path)
-        print_success(f"Repository cloned to: {local_repo_path}")
-
         summary = {
             "repo_url": repo_url,
-            "local_path": local_repo_path,
+            "local_path": None,
             "git_hooks": False,
             "readme_handled": False,
             "docker_compatibility": False,
             "venv_setup": False,
             "dependencies_installed": False,
             "tests_run": False,
-            "python_version": None
+            "tests_passed": None,
+            "python_version": None,
+            "stage_durations": stages,
+            "stage_usage": usage
         }
 
+        custom_path = get_custom_path()
+        with timed_stage(stages, 'clone', usage):
+            local_repo_path = download_repository(repo_url, custom_path)
+        summary["local_path"] = local_repo_path
+        print_success(f"Repository cloned to: {local_repo_path}")
+
+        # Journal completed stages so "resume" can pick up after a failure
+        journal = new_journal(local_repo_path, repo_url)
+        clone_fingerprint = fingerprint('', repo_url)
+        record_stage(journal, 'clone', clone_fingerprint, local_repo_path, [os.path.join(local_repo_path, '.git')])
+
+        # Options come from SETUP_SUBMODULES / SETUP_LFS / SETUP_LFS_INCLUDE; deferred LFS is fetched here too
+        if uses_submodules(local_repo_path):
+            with timed_stage(stages, 'submodules', usage):
+                summary["submodules"] = asyncio.run(fetch_submodules_async(local_repo_path, repo_url))
+        if uses_lfs(local_repo_path):
+            with timed_stage(stages, 'lfs', usage):
+                summary["lfs_fetched"] = asyncio.run(fetch_lfs_objects_async(local_repo_path))
+
         if prompt_for_git_hooks():
             if setup_git_hooks(local_repo_path):
                 print_success("Git hooks have been set up.")
@@ -531,17 +1086,35 @@ if __name__ == "__main__":
             summary["python_version"] = recommended_version
             print_info(f"Recommended Python version: {recommended_version}")
 
-            venv_path = setup_virtual_environment(local_repo_path, recommended_version)
+            with timed_stage(stages, 'venv', usage):
+                venv_path = setup_virtual_environment(local_repo_path, recommended_version)
             if venv_path:
                 print_success("Virtual environment setup complete.")
                 summary["venv_setup"] = True
-                if install_dependencies(venv_path, local_repo_path):
+                venv_fingerprint = fingerprint(clone_fingerprint, recommended_version)
+                record_stage(journal, 'venv', venv_fingerprint, venv_path, [os.path.join(venv_path, 'pyvenv.cfg')])
+                with timed_stage(stages, 'install', usage):
+                    dependencies_installed = install_dependencies(venv_path, local_repo_path, cache_hits=cache_hits)
+                if dependencies_installed:
                     print_success("Dependencies installed successfully.")
                     summary["dependencies_installed"] = True
+                    install_fingerprint = fingerprint(venv_fingerprint, get_commit_sha(local_repo_path),
+                                                      requirements_fingerprint(local_repo_path, recommended_version))
+                    record_stage(journal, 'install', install_fingerprint, True)
+
+                    if prompt_for_precompile():
+                        with timed_stage(stages, 'precompile', usage):
+                            summary["precompiled"] = precompile_environment(venv_path, local_repo_path)
 
                     if check_tests_directory(local_repo_path):
                         print_info("Tests directory detected.")
-                        if run_tests(local_repo_path, venv_path):
+                        with timed_stage(stages, 'tests', usage):
+                            summary["test_report"] = run_tests(local_repo_path, venv_path)
+                        summary["tests_passed"] = tests_passed(summary["test_report"])
+                        if summary["tests_passed"]:
+                            record_stage(journal, 'tests', fingerprint(install_fingerprint,
+                                                                       get_commit_sha(local_repo_path)),
+                                         summary["test_report"])
                             print_success("All tests passed successfully.")
                         else:
                             print_warning("Some tests failed. Please review the test output above.")
@@ -561,6 +1134,18 @@ if __name__ == "__main__":
     except Exception as e:
         print_error(f"An unexpected error occurred: {e}")
         print_error("Please try again or contact support if the issue persists.")
+        summary["error"] = str(e)
+
+    if summary.get("error") or (summary["python_version"] and not summary["dependencies_installed"]):
+        status = 'failed'
+    elif summary["tests_passed"] is False:
+        status = 'tests_failed'
+    else:
+        status = 'success'
+    record_setup(summary['repo_url'], status, stages, started_at, local_path=summary['local_path'],
+                 commit_sha=get_commit_sha(summary['local_path']), interpreter=summary['python_version'],
+                 exit_status=0 if status == 'success' else 1, error=summary.get("error"), cache_hits=cache_hits,
+                 usage=usage, tests=executed_tests(summary.get("test_report")))
 
     print_info("\nSummary Report:")
     print_info("===============")
@@ -576,4 +1161,13 @@ if __name__ == "__main__":
         print_info(f"Virtual environment setup: {'Successful' if summary['venv_setup'] else 'Failed'}")
         print_info(f"Dependencies installation: {'Successful' if summary['dependencies_installed'] else 'Failed or not performed'}")
         print_info(f"Automated testing: {'Performed' if summary['tests_run'] else 'Not performed'}")
+    if 'precompile' in stages:
+        print_info(f"Bytecode precompilation: {'Successful' if summary.get('precompiled') else 'Completed with errors'}")
+    print_stage_usage(usage)
+    if tracing:
+        print_profile_paths(stop_tracing(*tracing))
+    if status != 'success' and summary['local_path']:
+        print_info(f"To continue from the failed stage, run: python {os.path.basename(__file__)} resume "
+                   f"{summary['repo_url']}" + (f" --path {custom_path}" if custom_path else '')
+                   + (" --failed-only" if status == 'tests_failed' else ''))
     print_success("Project setup process completed.")
@@ -0,0 +1,310 @@
+import os
+import json
+import sqlite3
+import time
+import logging
+
+HISTORY_DB = os.getenv('SETUP_HISTORY_DB', os.path.expanduser("~/github_projects/.setup_history.db"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS setups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT,
+    repo_url TEXT NOT NULL,
+    local_path TEXT,
+    commit_sha TEXT,
+    interpreter TEXT,
+    status TEXT NOT NULL,
+    exit_status INTEGER,
+    error TEXT,
+    cache_hits TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    setup_id INTEGER NOT NULL REFERENCES setups(id) ON DELETE CASCADE,
+    repo_url TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    duration REAL NOT NULL,
+    started_at REAL NOT NULL,
+    cpu_user REAL,
+    cpu_sys REAL,
+    peak_rss_bytes INTEGER,
+    disk_read_bytes INTEGER,
+    disk_write_bytes INTEGER,
+    network_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS test_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    setup_id INTEGER NOT NULL REFERENCES setups(id) ON DELETE CASCADE,
+    repo_url TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    started_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_setups_repo_time ON setups(repo_url, started_at);
+CREATE INDEX IF NOT EXISTS idx_setups_time ON setups(started_at);
+CREATE INDEX IF NOT EXISTS idx_setups_status_time ON setups(status, started_at);
+CREATE INDEX IF NOT EXISTS idx_setups_job ON setups(job_id);
+CREATE INDEX IF NOT EXISTS idx_stage_runs_repo_stage ON stage_runs(repo_url, stage, started_at);
+CREATE INDEX IF NOT EXISTS idx_stage_runs_stage ON stage_runs(stage, started_at);
+CREATE INDEX IF NOT EXISTS idx_test_runs_repo_test ON test_runs(repo_url, test_id, started_at);
+"""
+
+USAGE_COLUMNS = ['cpu_user', 'cpu_sys', 'peak_rss_bytes', 'disk_read_bytes', 'disk_write_bytes', 'network_bytes']
+
+_initialized = set()
+
+def _migrate(conn):
+    # Databases created before resource accounting lack the usage columns
+    existing = {row['name'] for row in conn.execute("PRAGMA table_info(stage_runs)")}
+    for column in USAGE_COLUMNS:
+        if column not in existing:
+            column_type = 'REAL' if column.startswith('cpu_') else 'INTEGER'
+            conn.execute(f"ALTER TABLE stage_runs ADD COLUMN {column} {column_type}")
+
+def connect(db_path=None):
+    db_path = db_path or HISTORY_DB
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    if db_path not in _initialized:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        _initialized.add(db_path)
+    return conn
+
+def record_setup(repo_url, status, stages, started_at, finished_at=None, job_id=None,
+                 local_path=None, commit_sha=None, interpreter=None, exit_status=None,
+                 error=None, cache_hits=None, usage=None, tests=None, db_path=None):
+    finished_at = finished_at or time.time()
+    usage = usage or {}
+    try:
+        conn = connect(db_path)
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO setups (job_id, repo_url, local_path, commit_sha, interpreter, status, "
+                    "exit_status, error, cache_hits, started_at, finished_at, duration) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, repo_url, local_path, commit_sha, interpreter, status, exit_status, error,
+                     json.dumps(cache_hits or []), started_at, finished_at, finished_at - started_at)
+                )
+                setup_id = cursor.lastrowid
+                # Each stage's own start, from timed_stage; older exports only have the setup's
+                conn.executemany(
+                    f"INSERT INTO stage_runs (setup_id, repo_url, stage, duration, started_at, "
+                    f"{', '.join(USAGE_COLUMNS)}) VALUES (?, ?, ?, ?, ?{', ?' * len(USAGE_COLUMNS)})",
+                    [(setup_id, repo_url, stage, duration, usage.get(stage, {}).get('started_at') or started_at)
+                     + tuple(usage.get(stage, {}).get(column) for column in USAGE_COLUMNS)
+                     for stage, duration in stages.items()]
+                )
+                conn.executemany(
+                    "INSERT INTO test_runs (setup_id, repo_url, test_id, status, duration, attempts, started_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(setup_id, repo_url, test['id'], test['status'], test['duration'], test['attempts'],
+                      started_at) for test in tests or []]
+                )
+        finally:
+            conn.close()
+        return setup_id
+    except sqlite3.Error as e:
+        # History is best effort; a broken store must never fail a setup
+        logging.error(f"Failed to record setup history: {str(e)}")
+        return None
+
+def export_setup(job_id, db_path=None):
+    # What record_setup was given for a job, so the history on another host can record it as well
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT * FROM setups WHERE job_id = ? ORDER BY id DESC LIMIT 1", (job_id,)).fetchone()
+        if row is None:
+            return None
+        stage_rows = conn.execute(f"SELECT stage, duration, started_at, {', '.join(USAGE_COLUMNS)} FROM stage_runs "
+                                  f"WHERE setup_id = ?", (row['id'],)).fetchall()
+        test_rows = conn.execute("SELECT test_id, status, duration, attempts FROM test_runs WHERE setup_id = ?",
+                                 (row['id'],)).fetchall()
+    finally:
+        conn.close()
+    return {
+        'repo_url': row['repo_url'],
+        'status': row['status'],
+        'stages': {stage['stage']: stage['duration'] for stage in stage_rows},
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+        'job_id': row['job_id'],
+        'local_path': row['local_path'],
+        'commit_sha': row['commit_sha'],
+        'interpreter': row['interpreter'],
+        'exit_status': row['exit_status'],
+        'error': row['error'],
+        'cache_hits': json.loads(row['cache_hits'] or '[]'),
+        'usage': {stage['stage']: {column: stage[column] for column in USAGE_COLUMNS + ['started_at']}
+                  for stage in stage_rows},
+        'tests': [{'id': test['test_id'], 'status': test['status'], 'duration': test['duration'],
+                   'attempts': test['attempts']} for test in test_rows]
+    }
+
+def import_setup(record, db_path=None):
+    try:
+        conn = connect(db_path)
+        try:
+            # A worker on this host writes to the same database, so its setups are already here
+            exists = conn.execute("SELECT 1 FROM setups WHERE job_id = ?", (record['job_id'],)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to import setup history: {str(e)}")
+        return None
+    return None if exists else record_setup(**record, db_path=db_path)
+
+def _row_to_dict(row, stages, usage):
+    record = dict(row)
+    record['cache_hits'] = json.loads(record['cache_hits'] or '[]')
+    record['stages'] = stages.get(record['id'], {})
+    record['stage_usage'] = usage.get(record['id'], {})
+    return record
+
+def get_history(repo_url=None, status=None, since=None, until=None, page=1, per_page=50, db_path=None):
+    clauses, params = [], []
+    if repo_url:
+        clauses.append("repo_url = ?")
+        params.append(repo_url)
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if since is not None:
+        clauses.append("started_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("started_at < ?")
+        params.append(until)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    page = max(1, int(page))
+    per_page = max(1, min(int(per_page), 500))
+
+    conn = connect(db_path)
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM setups {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM setups {where} ORDER BY started_at DESC, id DESC LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]
+        ).fetchall()
+        stages = {}
+        usage = {}
+        ids = [row['id'] for row in rows]
+        if ids:
+            placeholders = ','.join('?' * len(ids))
+            for stage_row in conn.execute(
+                    f"SELECT setup_id, stage, duration, {', '.join(USAGE_COLUMNS)} FROM stage_runs "
+                    f"WHERE setup_id IN ({placeholders})", ids):
+                stages.setdefault(stage_row['setup_id'], {})[stage_row['stage']] = stage_row['duration']
+                usage.setdefault(stage_row['setup_id'], {})[stage_row['stage']] = {
+                    column: stage_row[column] for column in USAGE_COLUMNS
+                }
+    finally:
+        conn.close()
+
+    return {
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'results': [_row_to_dict(row, stages, usage) for row in rows]
+    }
+
+def get_stage_durations(repo_url=None, stage=None, since=None, limit=20, db_path=None):
+    clauses, params = [], []
+    if repo_url:
+        clauses.append("repo_url = ?")
+        params.append(repo_url)
+    if stage:
+        clauses.append("stage = ?")
+        params.append(stage)
+    if since is not None:
+        clauses.append("started_at >= ?")
+        params.append(since)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    conn = connect(db_path)
+    try:
+        # Only the most recent runs per stage, so estimates follow the repo as it changes
+        rows = conn.execute(
+            f"SELECT stage, duration, cpu_user, cpu_sys, peak_rss_bytes, disk_write_bytes FROM ("
+            f"  SELECT stage, duration, cpu_user, cpu_sys, peak_rss_bytes, disk_write_bytes,"
+            f"  ROW_NUMBER() OVER (PARTITION BY stage ORDER BY started_at DESC) AS rn"
+            f"  FROM stage_runs {where}"
+            f") WHERE rn <= ?",
+            params + [int(limit)]
+        ).fetchall()
+    finally:
+        conn.close()
+
+    runs = {}
+    for row in rows:
+        runs.setdefault(row['stage'], []).append(row)
+
+    stats = {}
+    for name, stage_rows in runs.items():
+        values = sorted(row['duration'] for row in stage_rows)
+        cpu = [row['cpu_user'] + row['cpu_sys'] for row in stage_rows if row['cpu_user'] is not None]
+        rss = [row['peak_rss_bytes'] for row in stage_rows if row['peak_rss_bytes'] is not None]
+        written = [row['disk_write_bytes'] for row in stage_rows if row['disk_write_bytes'] is not None]
+        stats[name] = {
+            'runs': len(values),
+            'mean': sum(values) / len(values),
+            'median': values[len(values) // 2],
+            'min': values[0],
+            'max': values[-1],
+            'mean_cpu': sum(cpu) / len(cpu) if cpu else None,
+            'max_peak_rss_bytes': max(rss) if rss else None,
+            'max_disk_write_bytes': max(written) if written else None
+        }
+    return stats
+
+def get_test_durations(repo_url, test_id=None, since=None, limit=20, db_path=None):
+    clauses, params = ["repo_url = ?"], [repo_url]
+    if test_id:
+        clauses.append("test_id = ?")
+        params.append(test_id)
+    if since is not None:
+        clauses.append("started_at >= ?")
+        params.append(since)
+
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            f"SELECT test_id, status, duration FROM ("
+            f"  SELECT test_id, status, duration,"
+            f"  ROW_NUMBER() OVER (PARTITION BY test_id ORDER BY started_at DESC) AS rn"
+            f"  FROM test_runs WHERE {' AND '.join(clauses)}"
+            f") WHERE rn <= ?",
+            params + [int(limit)]
+        ).fetchall()
+    finally:
+        conn.close()
+
+    runs = {}
+    for row in rows:
+        runs.setdefault(row['test_id'], []).append(row)
+
+    stats = {}
+    for name, test_rows in runs.items():
+        values = sorted(row['duration'] for row in test_rows)
+        statuses = [row['status'] for row in test_rows]
+        stats[name] = {
+            'runs': len(values),
+            'mean': sum(values) / len(values),
+            'max': values[-1],
+            'failures': sum(status in ('failed', 'error', 'unexpected_success') for status in statuses),
+            'flaky': statuses.count('flaky')
+        }
+    return stats
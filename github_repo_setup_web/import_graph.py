@@ -0,0 +1,203 @@
+# Import-dependency index used by the pre-commit hook to run only the affected tests.
+#
+# This file is copied into .git/hooks/ of set-up repositories and executed there with the
+# project's virtual environment, so it must stay standard-library only.
+#
+# Usage: python affected_tests.py [--python <interpreter>] [--tests-dir tests] [--list]
+import os
+import sys
+import ast
+import json
+import argparse
+import subprocess
+
+INDEX_VERSION = 1
+INDEX_NAME = 'import_graph.json'
+SKIP_DIRS = {'.git', '__pycache__', 'node_modules', 'build', 'dist', 'site-packages'}
+# Changes to these can affect any test, so they always trigger the full suite
+FULL_SUITE_FILES = {'requirements.txt', 'pyproject.toml', 'setup.py', 'setup.cfg', 'Pipfile', 'Pipfile.lock',
+                    'poetry.lock', 'pdm.lock', 'conftest.py', 'tox.ini'}
+
+def is_virtualenv(path):
+    return os.path.exists(os.path.join(path, 'pyvenv.cfg'))
+
+def iter_python_files(repo_path):
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS and not d.startswith('.')
+                   and not is_virtualenv(os.path.join(root, d))]
+        for file in files:
+            if file.endswith('.py'):
+                yield os.path.relpath(os.path.join(root, file), repo_path)
+
+def module_names(rel_path, source_roots):
+    # A file can be importable under several names (e.g. "src/pkg/a.py" as "pkg.a"), one per source root
+    names = []
+    for root in source_roots:
+        prefix = f"{root}{os.sep}" if root else ''
+        if not rel_path.startswith(prefix):
+            continue
+        parts = rel_path[len(prefix):][:-3].split(os.sep)
+        if parts[-1] == '__init__':
+            parts = parts[:-1]
+        if parts:
+            names.append('.'.join(parts))
+    return names
+
+def parse_imports(path, module_name, is_package):
+    try:
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (SyntaxError, ValueError, OSError):
+        return []
+
+    package = module_name if is_package else module_name.rpartition('.')[0]
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package.split('.') if package else []
+                base = base[:len(base) - (node.level - 1)] if node.level > 1 else base
+                target = '.'.join(base + ([node.module] if node.module else []))
+            else:
+                target = node.module or ''
+            if target:
+                imports.add(target)
+            # "from pkg import mod" may import a submodule
+            imports.update(f"{target}.{alias.name}" if target else alias.name for alias in node.names)
+    return sorted(imports)
+
+def load_index(index_path):
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': INDEX_VERSION, 'files': {}}
+
+def update_index(repo_path, index_path, tests_dir='tests'):
+    index = load_index(index_path)
+    source_roots = ['', 'src', tests_dir]
+    files = {}
+    changed = False
+    for rel_path in iter_python_files(repo_path):
+        path = os.path.join(repo_path, rel_path)
+        stat = os.stat(path)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        cached = index['files'].get(rel_path)
+        # Only files whose mtime or size changed since the last run are parsed again
+        if cached and cached['signature'] == signature:
+            files[rel_path] = cached
+            continue
+        names = module_names(rel_path, source_roots)
+        is_package = rel_path.endswith('__init__.py')
+        files[rel_path] = {
+            'signature': signature,
+            'modules': names,
+            'imports': parse_imports(path, names[0], is_package) if names else []
+        }
+        changed = True
+
+    if changed or set(files) != set(index['files']):
+        index['files'] = files
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    else:
+        index['files'] = files
+    return index
+
+def is_test_file(rel_path, tests_dir):
+    return rel_path.startswith(f"{tests_dir}{os.sep}") and os.path.basename(rel_path).startswith('test')
+
+def affected_test_files(index, changed_files, tests_dir='tests', previous=None):
+    # Deleted files are only in the index as it was before they were deleted
+    files = {**(previous or {}).get('files', {}), **index['files']}
+    owners = {}
+    for rel_path, entry in files.items():
+        for name in entry['modules']:
+            owners.setdefault(name, set()).add(rel_path)
+
+    # Reverse edges: module file -> files importing it (an import of "a.b.c" also depends on a and a.b)
+    importers = {}
+    for rel_path, entry in files.items():
+        for imported in entry['imports']:
+            parts = imported.split('.')
+            for i in range(1, len(parts) + 1):
+                for owner in owners.get('.'.join(parts[:i]), ()):
+                    importers.setdefault(owner, set()).add(rel_path)
+
+    affected = set()
+    pending = [path for path in changed_files if path in files]
+    while pending:
+        path = pending.pop()
+        if path in affected:
+            continue
+        affected.add(path)
+        pending.extend(importers.get(path, ()))
+    return sorted(path for path in affected if path in index['files'] and is_test_file(path, tests_dir))
+
+def staged_files(repo_path):
+    # Without renames, a moved file shows up as the deletion of its old path too
+    result = subprocess.run(['git', 'diff', '--cached', '--name-only', '--no-renames', '--diff-filter=ACMD', '-z'],
+                            cwd=repo_path, check=True, capture_output=True, text=True)
+    return [os.path.normpath(path) for path in result.stdout.split('\0') if path]
+
+def git_dir(repo_path):
+    result = subprocess.run(['git', 'rev-parse', '--git-dir'], cwd=repo_path, check=True,
+                            capture_output=True, text=True)
+    return os.path.join(repo_path, result.stdout.strip())
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tests affected by the staged changes.")
+    parser.add_argument('--python', default=sys.executable, help="Interpreter used to run the tests")
+    parser.add_argument('--tests-dir', default='tests')
+    parser.add_argument('--list', action='store_true', help="Only print the affected test modules")
+    args = parser.parse_args()
+
+    repo_path = subprocess.run(['git', 'rev-parse', '--show-toplevel'], check=True, capture_output=True,
+                               text=True).stdout.strip()
+    tests_path = os.path.join(repo_path, args.tests_dir)
+    full_suite = [args.python, '-m', 'unittest', 'discover', args.tests_dir]
+
+    try:
+        changed = staged_files(repo_path)
+        index_path = os.path.join(git_dir(repo_path), INDEX_NAME)
+        previous = load_index(index_path)
+        index = update_index(repo_path, index_path, args.tests_dir)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Import index unavailable ({e}); running the full test suite.")
+        return subprocess.call(full_suite, cwd=repo_path)
+
+    if any(os.path.basename(path) in FULL_SUITE_FILES for path in changed):
+        print("Project configuration changed; running the full test suite.")
+        return subprocess.call(full_suite, cwd=repo_path)
+
+    # A deleted module the index never saw may still be imported anywhere
+    deleted = [path for path in changed if path.endswith('.py') and not os.path.exists(os.path.join(repo_path, path))]
+    if any(path not in previous['files'] for path in deleted):
+        print("A deleted module is not in the import index; running the full test suite.")
+        return subprocess.call(full_suite, cwd=repo_path)
+
+    tests = affected_test_files(index, changed, args.tests_dir, previous)
+    if args.list:
+        print('\n'.join(tests))
+        return 0
+    if not tests:
+        print("No tests affected by the staged changes.")
+        return 0
+
+    # Same module names and sys.path as "unittest discover tests" would use
+    names = ['.'.join(os.path.relpath(os.path.join(repo_path, path), tests_path)[:-3].split(os.sep))
+             for path in tests]
+    print(f"Running {len(names)} affected test module(s): {', '.join(names)}")
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [tests_path, env.get('PYTHONPATH')]))
+    return subprocess.call([args.python, '-m', 'unittest'] + names, cwd=repo_path, env=env)
+
+if __name__ == '__main__':
+    sys.exit(main())
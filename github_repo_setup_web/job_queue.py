@@ -0,0 +1,488 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import sqlite3
+
+# "sqlite:///<path>" (a file on a filesystem all workers share) or "redis://host:port/db"
+JOB_QUEUE_URL = os.getenv('SETUP_JOB_QUEUE',
+                          'sqlite:///' + os.path.expanduser("~/github_projects/.setup_jobs.db"))
+# Seconds a worker holds a job without a heartbeat before the job is handed to another worker
+LEASE_SECONDS = float(os.getenv('SETUP_JOB_LEASE', 60))
+# Deliveries before a job whose workers keep dying is given up on
+MAX_ATTEMPTS = int(os.getenv('SETUP_JOB_MAX_ATTEMPTS', 3))
+# Seconds of waiting that make up for one second of estimated run time, so long setups are not starved
+QUEUE_AGING = float(os.getenv('SETUP_QUEUE_AGING', 2.0))
+# Estimated run time of a setup without history
+DEFAULT_DURATION = 600.0
+REDIS_PREFIX = os.getenv('SETUP_REDIS_PREFIX', 'setup:')
+
+# queued -> running -> finished | cancelled | failed; running goes back to queued when a lease expires
+FINAL_STATUSES = ('finished', 'cancelled', 'failed')
+WORKER_LOST_ERROR = f"Worker lost {MAX_ATTEMPTS} time(s) in a row"
+
+def priority(enqueued_at, duration=None):
+    # Shortest estimated job first, aged by time spent waiting: duration - waited * aging orders jobs the
+    # same way at any moment, and this form of it never changes, so it can be stored with the job
+    return (DEFAULT_DURATION if duration is None else duration) + enqueued_at * QUEUE_AGING
+
+def new_job(request, job_id=None, duration=None):
+    enqueued_at = time.time()
+    return {
+        'job_id': job_id or str(uuid.uuid4()),
+        'request': request,
+        'priority': priority(enqueued_at, duration),
+        'status': 'queued',
+        'stage': None,
+        'worker': None,
+        'attempts': 0,
+        'lease_expires': None,
+        'cancel_requested': False,
+        'result': None,
+        'error': None,
+        'enqueued_at': enqueued_at,
+        'started_at': None,
+        'finished_at': None
+    }
+
+def final_status(result):
+    return 'cancelled' if result.get('status') == 'cancelled' else 'finished'
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    request TEXT NOT NULL,
+    priority REAL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_expires REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, enqueued_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_priority ON jobs(status, priority);
+CREATE TABLE IF NOT EXISTS artifacts (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+CREATE TABLE IF NOT EXISTS history_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    record TEXT NOT NULL
+);
+"""
+
+class SqliteQueue:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connect()
+        try:
+            # WAL needs shared memory, which network filesystems don't provide; rollback journaling works there
+            conn.execute("PRAGMA journal_mode = DELETE")
+            # Queues created before priorities lack the column, and the index on it in the schema
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'jobs'").fetchone() and \
+                    'priority' not in {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN priority REAL")
+            conn.executescript(SQLITE_SCHEMA)
+        finally:
+            conn.close()
+
+    def connect(self):
+        # One connection per call, so workers can use the queue from any thread
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def transaction(self, conn):
+        # Taking the write lock up front keeps two workers from leasing the same job
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['request'] = json.loads(job['request'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def enqueue(self, request, job_id=None, duration=None):
+        job = new_job(request, job_id, duration)
+        conn = self.connect()
+        try:
+            conn.execute("INSERT INTO jobs (job_id, request, priority, status, enqueued_at) "
+                         "VALUES (?, ?, ?, 'queued', ?)",
+                         (job['job_id'], json.dumps(request), job['priority'], job['enqueued_at']))
+        finally:
+            conn.close()
+        return job
+
+    def lease(self, worker_id, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        conn = self.transaction(self.connect())
+        try:
+            # Jobs of dead workers go back in the queue, unless they have killed too many already
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+                         "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                         (WORKER_LOST_ERROR, now, now, MAX_ATTEMPTS))
+            conn.execute("UPDATE jobs SET status = 'queued', worker = NULL "
+                         "WHERE status = 'running' AND lease_expires < ?", (now,))
+            row = conn.execute("SELECT job_id FROM jobs WHERE status = 'queued' "
+                               "ORDER BY priority, enqueued_at LIMIT 1").fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                         "lease_expires = ?, started_at = COALESCE(started_at, ?) WHERE job_id = ?",
+                         (worker_id, now + lease_seconds, now, row['job_id']))
+            job = self._job(conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row['job_id'],)).fetchone())
+            conn.execute("COMMIT")
+            return job
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id, worker_id, stage=None, lease_seconds=LEASE_SECONDS):
+        conn = self.connect()
+        try:
+            updated = conn.execute("UPDATE jobs SET lease_expires = ?, stage = ? "
+                                   "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                   (time.time() + lease_seconds, stage, job_id, worker_id)).rowcount
+            if not updated:
+                return 'lost'
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            return 'cancel' if row['cancel_requested'] else 'ok'
+        finally:
+            conn.close()
+
+    def release(self, job_id, worker_id):
+        conn = self.connect()
+        try:
+            # Handed back untouched: the delivery doesn't count as an attempt and the job keeps its place
+            return bool(conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, lease_expires = NULL, "
+                                     "attempts = attempts - 1, "
+                                     "started_at = CASE WHEN attempts > 1 THEN started_at END "
+                                     "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                     (job_id, worker_id)).rowcount)
+        finally:
+            conn.close()
+
+    def complete(self, job_id, worker_id, result):
+        conn = self.connect()
+        try:
+            # A worker whose lease ran out no longer owns the job; its result is dropped
+            return bool(conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? "
+                                     "WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                     (final_status(result), json.dumps(result), result.get('error'), time.time(),
+                                      job_id, worker_id)).rowcount)
+        finally:
+            conn.close()
+
+    def cancel(self, job_id):
+        conn = self.transaction(self.connect())
+        try:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row and row['status'] == 'queued':
+                conn.execute("UPDATE jobs SET status = 'cancelled', error = 'Setup cancelled', finished_at = ? "
+                             "WHERE job_id = ?", (time.time(), job_id))
+            elif row and row['status'] == 'running':
+                # The worker sees the flag on its next heartbeat
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+            conn.execute("COMMIT")
+            return row['status'] if row else None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self.connect()
+        try:
+            return self._job(conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone())
+        finally:
+            conn.close()
+
+    def list_jobs(self, statuses=('queued', 'running'), limit=100):
+        conn = self.connect()
+        try:
+            rows = conn.execute(f"SELECT * FROM jobs WHERE status IN ({','.join('?' * len(statuses))}) "
+                                f"ORDER BY enqueued_at DESC LIMIT ?", (*statuses, limit)).fetchall()
+            return [self._job(row) for row in rows]
+        finally:
+            conn.close()
+
+    def pending(self):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def put_artifact(self, job_id, name, data):
+        conn = self.connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO artifacts (job_id, name, data) VALUES (?, ?, ?)",
+                         (job_id, name, sqlite3.Binary(data)))
+        finally:
+            conn.close()
+
+    def get_artifact(self, job_id, name):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT data FROM artifacts WHERE job_id = ? AND name = ?", (job_id, name)).fetchone()
+            return bytes(row['data']) if row else None
+        finally:
+            conn.close()
+
+    def add_history(self, record):
+        conn = self.connect()
+        try:
+            conn.execute("INSERT INTO history_outbox (record) VALUES (?)", (json.dumps(record),))
+        finally:
+            conn.close()
+
+    def take_history(self, limit=500):
+        conn = self.transaction(self.connect())
+        try:
+            rows = conn.execute("SELECT id, record FROM history_outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+            if rows:
+                conn.execute(f"DELETE FROM history_outbox WHERE id IN ({','.join('?' * len(rows))})",
+                             [row['id'] for row in rows])
+            conn.execute("COMMIT")
+            return [json.loads(row['record']) for row in rows]
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+# Every state change is one Lua script, so it is atomic on the server. Job keys are derived from the
+# prefix inside the scripts, which works on a single Redis (or compatible) server but not on a cluster.
+REDIS_LEASE = """
+local now, expires, worker, max_attempts, prefix = tonumber(ARGV[1]), ARGV[2], ARGV[3], tonumber(ARGV[4]), ARGV[5]
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], id)
+    local key = prefix .. 'job:' .. id
+    if tonumber(redis.call('HGET', key, 'attempts') or '0') >= max_attempts then
+        redis.call('HSET', key, 'status', 'failed', 'error', ARGV[6], 'finished_at', now)
+    else
+        redis.call('HSET', key, 'status', 'queued', 'worker', '')
+        redis.call('ZADD', KEYS[1], redis.call('HGET', key, 'priority') or 0, id)
+    end
+end
+while true do
+    local id = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    if not id then
+        return false
+    end
+    redis.call('ZREM', KEYS[1], id)
+    local key = prefix .. 'job:' .. id
+    -- Jobs cancelled while queued are still in the list
+    if redis.call('HGET', key, 'status') == 'queued' then
+        redis.call('HINCRBY', key, 'attempts', 1)
+        redis.call('HSET', key, 'status', 'running', 'worker', worker, 'lease_expires', expires)
+        redis.call('HSETNX', key, 'started_at', now)
+        redis.call('ZADD', KEYS[2], expires, id)
+        return id
+    end
+end
+"""
+
+REDIS_HEARTBEAT = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] then
+    return 'lost'
+end
+redis.call('HSET', KEYS[1], 'lease_expires', ARGV[2], 'stage', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[4])
+if redis.call('HGET', KEYS[1], 'cancel_requested') == '1' then
+    return 'cancel'
+end
+return 'ok'
+"""
+
+REDIS_COMPLETE = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2], 'result', ARGV[3], 'error', ARGV[4], 'finished_at', ARGV[5])
+redis.call('ZREM', KEYS[2], ARGV[6])
+return 1
+"""
+
+REDIS_RELEASE = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'queued', 'worker', '')
+if redis.call('HINCRBY', KEYS[1], 'attempts', -1) == 0 then
+    redis.call('HDEL', KEYS[1], 'started_at')
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[3], redis.call('HGET', KEYS[1], 'priority') or 0, ARGV[2])
+return 1
+"""
+
+REDIS_CANCEL = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'queued' then
+    redis.call('HSET', KEYS[1], 'status', 'cancelled', 'error', 'Setup cancelled', 'finished_at', ARGV[1])
+elseif status == 'running' then
+    redis.call('HSET', KEYS[1], 'cancel_requested', '1')
+end
+return status
+"""
+
+class RedisQueue:
+    def __init__(self, url, prefix=REDIS_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The Redis job queue needs the redis package: pip install redis")
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        # Queued job ids scored by priority
+        self.queue_key = f"{prefix}pending"
+        self.leases_key = f"{prefix}leases"
+        self.jobs_key = f"{prefix}jobs"
+        self.history_key = f"{prefix}history"
+        self.scripts = {name: self.redis.register_script(script) for name, script in (
+            ('lease', REDIS_LEASE), ('heartbeat', REDIS_HEARTBEAT), ('release', REDIS_RELEASE),
+            ('complete', REDIS_COMPLETE), ('cancel', REDIS_CANCEL))}
+        # Queues from before priorities kept the queued ids in a plain list; jobs without one go first
+        legacy_key = f"{prefix}queue"
+        if self.redis.type(legacy_key) == 'list':
+            for job_id in self.redis.lrange(legacy_key, 0, -1):
+                self.redis.zadd(self.queue_key, {job_id: 0})
+            self.redis.delete(legacy_key)
+
+    def job_key(self, job_id):
+        return f"{self.prefix}job:{job_id}"
+
+    def _job(self, job_id, fields):
+        if not fields:
+            return None
+        job = new_job(json.loads(fields['request']), job_id)
+        job.update({
+            'priority': float(fields.get('priority') or 0),
+            'status': fields['status'],
+            'stage': fields.get('stage') or None,
+            'worker': fields.get('worker') or None,
+            'attempts': int(fields.get('attempts') or 0),
+            'lease_expires': float(fields['lease_expires']) if fields.get('lease_expires') else None,
+            'cancel_requested': fields.get('cancel_requested') == '1',
+            'result': json.loads(fields['result']) if fields.get('result') else None,
+            'error': fields.get('error') or None,
+            'enqueued_at': float(fields['enqueued_at']),
+            'started_at': float(fields['started_at']) if fields.get('started_at') else None,
+            'finished_at': float(fields['finished_at']) if fields.get('finished_at') else None
+        })
+        return job
+
+    def enqueue(self, request, job_id=None, duration=None):
+        job = new_job(request, job_id, duration)
+        with self.redis.pipeline() as pipe:
+            pipe.hset(self.job_key(job['job_id']), mapping={
+                'request': json.dumps(request), 'priority': job['priority'], 'status': 'queued', 'attempts': 0,
+                'cancel_requested': 0, 'enqueued_at': job['enqueued_at']})
+            pipe.zadd(self.jobs_key, {job['job_id']: job['enqueued_at']})
+            pipe.zadd(self.queue_key, {job['job_id']: job['priority']})
+            pipe.execute()
+        return job
+
+    def lease(self, worker_id, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        job_id = self.scripts['lease'](keys=[self.queue_key, self.leases_key],
+                                       args=[now, now + lease_seconds, worker_id, MAX_ATTEMPTS, self.prefix,
+                                             WORKER_LOST_ERROR])
+        return self.get(job_id) if job_id else None
+
+    def heartbeat(self, job_id, worker_id, stage=None, lease_seconds=LEASE_SECONDS):
+        return self.scripts['heartbeat'](keys=[self.job_key(job_id), self.leases_key],
+                                         args=[worker_id, time.time() + lease_seconds, stage or '', job_id])
+
+    def release(self, job_id, worker_id):
+        return bool(self.scripts['release'](keys=[self.job_key(job_id), self.leases_key, self.queue_key],
+                                            args=[worker_id, job_id]))
+
+    def complete(self, job_id, worker_id, result):
+        return bool(self.scripts['complete'](keys=[self.job_key(job_id), self.leases_key],
+                                             args=[worker_id, final_status(result), json.dumps(result),
+                                                   result.get('error') or '', time.time(), job_id]))
+
+    def cancel(self, job_id):
+        return self.scripts['cancel'](keys=[self.job_key(job_id)], args=[time.time()]) or None
+
+    def get(self, job_id):
+        return self._job(job_id, self.redis.hgetall(self.job_key(job_id)))
+
+    def list_jobs(self, statuses=('queued', 'running'), limit=100):
+        jobs = []
+        # Newest first; finished jobs are skipped, so scan in pages rather than all at once
+        for start in range(0, self.redis.zcard(self.jobs_key), 500):
+            for job_id in self.redis.zrevrange(self.jobs_key, start, start + 499):
+                job = self.get(job_id)
+                if job and job['status'] in statuses:
+                    jobs.append(job)
+                    if len(jobs) == limit:
+                        return jobs
+        return jobs
+
+    def pending(self):
+        # Includes jobs cancelled while queued until a worker pops them, so it may overcount slightly
+        return self.redis.zcard(self.queue_key)
+
+    def put_artifact(self, job_id, name, data):
+        # Responses are decoded as text, so binary artifacts are stored base64-encoded
+        self.redis.hset(f"{self.prefix}artifacts:{job_id}", name, base64.b64encode(data).decode())
+
+    def get_artifact(self, job_id, name):
+        data = self.redis.hget(f"{self.prefix}artifacts:{job_id}", name)
+        return base64.b64decode(data) if data is not None else None
+
+    def add_history(self, record):
+        self.redis.rpush(self.history_key, json.dumps(record))
+
+    def take_history(self, limit=500):
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(self.history_key, 0, limit - 1)
+            pipe.ltrim(self.history_key, limit, -1)
+            records, _ = pipe.execute()
+        return [json.loads(record) for record in records]
+
+def open_queue(url=None):
+    url = url or JOB_QUEUE_URL
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(url)
+    if url.startswith('sqlite:///'):
+        return SqliteQueue(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported job queue: {url}")
+
+if __name__ == "__main__":
+    # Usage: python job_queue.py enqueue <repo_url> [<repo_url> ...] | list | show <job_id>
+    queue = open_queue()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'enqueue':
+        for repo_url in sys.argv[2:]:
+            print(queue.enqueue({'repo_url': repo_url})['job_id'])
+    elif command == 'show':
+        print(json.dumps(queue.get(sys.argv[2]), indent=2))
+    else:
+        for job in queue.list_jobs():
+            print(f"{job['job_id']} {job['status']:9} {job['stage'] or '-':12} {job['worker'] or '-'} "
+                  f"{job['request']['repo_url']}")
@@ -0,0 +1,22 @@
+import threading
+
+# Stage of every setup running in this process; workers report it to the queue with each heartbeat
+_stages = {}
+_lock = threading.Lock()
+
+def register_job(job_id):
+    with _lock:
+        _stages[job_id] = None
+
+def unregister_job(job_id):
+    with _lock:
+        _stages.pop(job_id, None)
+
+def set_job_stage(job_id, stage):
+    with _lock:
+        if job_id in _stages:
+            _stages[job_id] = stage
+
+def job_stage(job_id):
+    with _lock:
+        return _stages.get(job_id)
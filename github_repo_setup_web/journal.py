@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+JOURNAL_NAME = 'setup-journal.json'
+JOURNAL_VERSION = 1
+
+# Each stage's fingerprint folds in the fingerprint of the stage it builds on, so re-running a
+# stage invalidates everything downstream of it:
+#
+#   clone -> submodules, lfs, detect
+#   clone -> venv (interpreter) -> install (commit, manifests, locks) -> precompile, tests
+
+def journal_path(repo_path):
+    return os.path.join(repo_path, '.git', JOURNAL_NAME)
+
+def fingerprint(previous, *inputs):
+    return hashlib.sha256(json.dumps([previous, *inputs]).encode()).hexdigest()
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def new_journal(repo_path, repo_url):
+    return {'version': JOURNAL_VERSION, 'repo_url': repo_url, 'repo_path': repo_path, 'stages': {}}
+
+def load_journal(repo_path, repo_url):
+    try:
+        with open(journal_path(repo_path), 'r') as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return new_journal(repo_path, repo_url)
+    # A journal for another remote, or a moved checkout, can't vouch for anything here
+    if journal.get('version') != JOURNAL_VERSION or journal.get('repo_url') != repo_url:
+        logging.warning(f"Ignoring setup journal in {repo_path}: it belongs to {journal.get('repo_url')}")
+        return new_journal(repo_path, repo_url)
+    journal['repo_path'] = repo_path
+    return journal
+
+def journal_repo_url(repo_path):
+    try:
+        with open(journal_path(repo_path), 'r') as f:
+            return json.load(f).get('repo_url')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def save_journal(journal):
+    path = journal_path(journal['repo_path'])
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(journal, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # The journal only speeds up a later resume; failing to write it must not fail the setup
+        logging.warning(f"Failed to write setup journal: {str(e)}")
+
+def completed_stage(journal, stage, stage_fingerprint):
+    entry = journal['stages'].get(stage)
+    if not entry or entry['fingerprint'] != stage_fingerprint:
+        return None
+    # The outputs must still be there: a deleted venv is as good as a failed one
+    if not all(os.path.exists(path) for path in entry['artifacts']):
+        return None
+    return entry
+
+def record_stage(journal, stage, stage_fingerprint, result=None, artifacts=()):
+    journal['stages'][stage] = {
+        'fingerprint': stage_fingerprint,
+        'result': result,
+        'artifacts': list(artifacts),
+        'completed_at': time.time()
+    }
+    save_journal(journal)
+
+def forget_stage(journal, stage):
+    if journal['stages'].pop(stage, None) is not None:
+        save_journal(journal)
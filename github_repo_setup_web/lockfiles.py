@@ -0,0 +1,111 @@
+import os
+import re
+import hashlib
+
+LOCK_CACHE_DIR = os.getenv('SETUP_LOCK_CACHE', os.path.expanduser("~/github_projects/.locks"))
+GENERATED_LOCK_NAME = 'requirements.lock'
+
+MANIFEST_FILES = ['requirements.txt', 'pyproject.toml', 'setup.py', 'setup.cfg', 'Pipfile']
+HASH_PINNED_FILES = ['requirements.lock', 'requirements.txt']
+# A requirements file option that pulls in another file: -r/-c FILE, -rFILE, --requirement=FILE
+NESTED_FILE_OPTION = re.compile(r'(?:-r|-c|--requirement|--constraint)(?:\s*=\s*|\s*)(\S+)')
+
+def is_hash_pinned(requirements_file):
+    try:
+        with open(requirements_file, 'r') as f:
+            content = f.read()
+    except OSError:
+        return False
+
+    # Join continuation lines so each requirement is one logical line
+    logical_lines = re.sub(r'\\\s*\n', ' ', content).splitlines()
+    requirements = []
+    for line in logical_lines:
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('-'):
+            # Options such as --index-url are allowed, nested files cannot be checked
+            if line.startswith(('-r', '-c', '--requirement', '--constraint', '-e', '--editable')):
+                return False
+            continue
+        requirements.append(line)
+
+    return bool(requirements) and all('==' in req and '--hash=' in req for req in requirements)
+
+def find_lockfile(repo_path):
+    if os.path.exists(os.path.join(repo_path, 'poetry.lock')) and \
+            os.path.exists(os.path.join(repo_path, 'pyproject.toml')):
+        return 'poetry', os.path.join(repo_path, 'poetry.lock')
+    if os.path.exists(os.path.join(repo_path, 'Pipfile.lock')):
+        return 'pipenv', os.path.join(repo_path, 'Pipfile.lock')
+    if os.path.exists(os.path.join(repo_path, 'pdm.lock')):
+        return 'pdm', os.path.join(repo_path, 'pdm.lock')
+    for name in HASH_PINNED_FILES:
+        path = os.path.join(repo_path, name)
+        if is_hash_pinned(path):
+            return 'pip', path
+    return None, None
+
+def nested_requirement_files(requirements_file):
+    try:
+        with open(requirements_file, 'r') as f:
+            content = f.read()
+    except (OSError, UnicodeDecodeError):
+        return []
+    files = []
+    for line in re.sub(r'\\\s*\n', ' ', content).splitlines():
+        match = NESTED_FILE_OPTION.match(line.strip())
+        # Paths are relative to the file that names them; a URL is only fingerprinted by its address
+        if match and '://' not in match.group(1):
+            files.append(os.path.normpath(os.path.join(os.path.dirname(requirements_file), match.group(1))))
+    return files
+
+def manifest_fingerprint(repo_path, python_version):
+    digest = hashlib.sha256(f"python={python_version}\n".encode())
+    for name in MANIFEST_FILES:
+        path = os.path.join(repo_path, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(name.encode() + b'\0' + f.read() + b'\0')
+    # Files pulled in with -r/-c decide the install as much as requirements.txt does, at any depth
+    pending = nested_requirement_files(os.path.join(repo_path, 'requirements.txt'))
+    seen = set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen or not os.path.isfile(path):
+            continue
+        seen.add(path)
+        with open(path, 'rb') as f:
+            digest.update(os.path.relpath(path, repo_path).encode() + b'\0' + f.read() + b'\0')
+        pending += nested_requirement_files(path)
+    return digest.hexdigest()
+
+def requirements_fingerprint(repo_path, python_version):
+    # Manifests, lock file and interpreter: everything that decides what an install puts in the venv
+    digest = hashlib.sha256(manifest_fingerprint(repo_path, python_version).encode())
+    kind, lock_path = find_lockfile(repo_path)
+    if kind:
+        with open(lock_path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def cached_lock_path(fingerprint):
+    return os.path.join(LOCK_CACHE_DIR, f"{fingerprint}.txt")
+
+def write_generated_lock(frozen_requirements, fingerprint, venv_path):
+    # Editable and local-path entries point into this checkout and cannot be reused elsewhere
+    lines = [line for line in frozen_requirements.splitlines()
+             if line.strip() and not line.startswith(('-e ', '#')) and ' @ file:' not in line]
+    content = '\n'.join(lines) + '\n'
+
+    os.makedirs(LOCK_CACHE_DIR, exist_ok=True)
+    cache_path = cached_lock_path(fingerprint)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, cache_path)
+
+    with open(os.path.join(venv_path, GENERATED_LOCK_NAME), 'w') as f:
+        f.write(content)
+    return cache_path
@@ -0,0 +1,126 @@
+import os
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler
+
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+current_stage = contextvars.ContextVar('current_stage', default=None)
+
+# "{pid}" is replaced by the process id: the built-in rotation is only safe when one process owns the file
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# "size" rotates at LOG_MAX_BYTES, "external" leaves rotation to logrotate and reopens the file when it is moved
+# (several processes may then share it), anything else is a TimedRotatingFileHandler "when" value (e.g. "midnight")
+LOG_ROTATION = os.getenv('LOG_ROTATION', 'size')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Per-endpoint payload sampling, e.g. "setup=0.01,detect_version=0.1"; payloads are not logged by default
+LOG_PAYLOAD_SAMPLING = os.getenv('LOG_PAYLOAD_SAMPLING', '*=0')
+
+_listener = None
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.job_id = current_job_id.get()
+        record.stage = current_stage.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'job_id', 'stage'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'job_id': getattr(record, 'job_id', None),
+            'stage': getattr(record, 'stage', None)
+        }
+        # Anything passed through extra= is kept as structured fields
+        for key, value in vars(record).items():
+            if key not in self.RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The base class folds the traceback into msg; keep it in exc_text, rendered now since the
+        # frames are gone by the time the listener formats the record
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # Never block a request on logging: drop the record if the listener falls behind
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def parse_sampling(spec):
+    rates = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        endpoint, rate = item.split('=', 1)
+        try:
+            rates[endpoint.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+PAYLOAD_SAMPLE_RATES = parse_sampling(LOG_PAYLOAD_SAMPLING)
+
+def should_log_payload(endpoint):
+    rate = PAYLOAD_SAMPLE_RATES.get(endpoint, PAYLOAD_SAMPLE_RATES.get('*', 0.0))
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+def build_file_handler(log_file=LOG_FILE):
+    log_file = log_file.replace('{pid}', str(os.getpid()))
+    if LOG_ROTATION == 'external':
+        handler = WatchedFileHandler(log_file)
+    elif LOG_ROTATION == 'size':
+        handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = TimedRotatingFileHandler(log_file, when=LOG_ROTATION, backupCount=LOG_BACKUP_COUNT)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+def configure_logging(log_file=LOG_FILE, level=LOG_LEVEL):
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    _listener = QueueListener(log_queue, build_file_handler(log_file), console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+from github_repo_setup import (
+    detect_local_python_version,
+    setup_virtual_environment_async,
+    install_dependencies_async,
+    run_tests_async,
+    check_tests_directory,
+    timed_stage,
+    print_info,
+    print_success,
+    print_warning
+)
+from lockfiles import MANIFEST_FILES, requirements_fingerprint
+from import_graph import SKIP_DIRS, is_virtualenv
+from test_results import tests_passed
+
+MONOREPO_MAX_DEPTH = int(os.getenv('SETUP_MONOREPO_MAX_DEPTH', 4))
+# How many sub-projects install and test at once; commands are further limited per resource class
+MONOREPO_CONCURRENCY = int(os.getenv('SETUP_MONOREPO_CONCURRENCY', 4))
+SHARED_VENV_DIR = '.venvs'
+
+def discover_projects(repo_path, max_depth=MONOREPO_MAX_DEPTH):
+    projects = []
+    root_depth = repo_path.rstrip(os.sep).count(os.sep)
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS and not d.startswith('.') and d != 'venv'
+                         and not is_virtualenv(os.path.join(root, d)))
+        if root.count(os.sep) - root_depth >= max_depth:
+            dirs[:] = []
+        if any(name in files for name in MANIFEST_FILES):
+            projects.append(os.path.relpath(root, repo_path))
+    return projects
+
+async def plan_projects(repo_path, projects, python_version=None):
+    groups = {}
+    for project in projects:
+        project_path = os.path.normpath(os.path.join(repo_path, project))
+        version = python_version or await asyncio.to_thread(detect_local_python_version, project_path)
+        # Projects with identical manifests, locks and interpreter share one environment
+        key = requirements_fingerprint(project_path, version) if version else f"undetected:{project}"
+        groups.setdefault(key, {'python_version': version, 'projects': []})['projects'].append(project)
+
+    for key, group in groups.items():
+        if len(group['projects']) == 1:
+            group['venv_path'] = os.path.normpath(os.path.join(repo_path, group['projects'][0], 'venv'))
+        else:
+            group['venv_path'] = os.path.join(repo_path, SHARED_VENV_DIR, key[:16])
+    return groups
+
+async def timed(stages, usage, name, coro, timeout):
+    with timed_stage(stages, name, usage):
+        return await asyncio.wait_for(coro, timeout)
+
+async def setup_group(repo_path, group, timeouts, cache_hits):
+    venv_path = group['venv_path']
+    reports = {project: {
+        'path': project,
+        'python_version': group['python_version'],
+        'venv_path': venv_path,
+        'shared_with': [other for other in group['projects'] if other != project],
+        'status': 'pending',
+        'test_results': None,
+        'stage_durations': {},
+        'stage_usage': {}
+    } for project in group['projects']}
+    first = reports[group['projects'][0]]
+    stage = None
+    try:
+        if not group['python_version']:
+            raise ValueError("Unable to detect Python version")
+
+        # One environment per requirement set, installed from the first project that uses it
+        stage = 'venv'
+        os.makedirs(os.path.dirname(venv_path), exist_ok=True)
+        if not await timed(first['stage_durations'], first['stage_usage'], 'venv',
+                           setup_virtual_environment_async(repo_path, group['python_version'], venv_path),
+                           timeouts.get('venv')):
+            raise RuntimeError(f"Failed to set up a Python {group['python_version']} virtual environment")
+        stage = 'install'
+        for project in group['projects']:
+            report = reports[project]
+            if not await timed(report['stage_durations'], report['stage_usage'], 'install',
+                               install_dependencies_async(venv_path, os.path.join(repo_path, project), cache_hits),
+                               timeouts.get('install')):
+                raise RuntimeError(f"Failed to install dependencies of {project}")
+    except Exception as e:
+        error = f"Stage {stage} timed out" if isinstance(e, asyncio.TimeoutError) else str(e)
+        logging.error(f"Setup of sub-project(s) {', '.join(group['projects'])} failed: {error}")
+        for report in reports.values():
+            report['status'] = 'timed_out' if isinstance(e, asyncio.TimeoutError) else 'failed'
+            report['error'] = error
+        return list(reports.values())
+
+    # Test runs of projects sharing an environment don't depend on each other
+    async def test_project(report):
+        project_path = os.path.normpath(os.path.join(repo_path, report['path']))
+        if check_tests_directory(project_path):
+            try:
+                report['test_results'] = await timed(report['stage_durations'], report['stage_usage'], 'tests',
+                                                     run_tests_async(project_path, venv_path), timeouts.get('tests'))
+            except asyncio.TimeoutError:
+                report['status'], report['error'] = 'timed_out', "Stage tests timed out"
+                return
+        report['status'] = 'success' if tests_passed(report['test_results']) else 'tests_failed'
+
+    await asyncio.gather(*(test_project(report) for report in reports.values()))
+    return list(reports.values())
+
+async def setup_projects(repo_path, projects, python_version=None, timeouts=None, cache_hits=None,
+                         concurrency=MONOREPO_CONCURRENCY):
+    timeouts = timeouts or {}
+    groups = await plan_projects(repo_path, projects, python_version)
+    logging.info(f"Setting up {len(projects)} sub-project(s) in {len(groups)} environment(s)")
+    limit = asyncio.Semaphore(concurrency)
+
+    async def bounded(group):
+        async with limit:
+            return await setup_group(repo_path, group, timeouts, cache_hits)
+
+    results = await asyncio.gather(*(bounded(group) for group in groups.values()))
+    return sorted((report for reports in results for report in reports), key=lambda report: report['path'])
+
+def merge_project_stages(reports, stages, usage):
+    # History keeps one flat stage map per setup, so sub-project stages are recorded as "<project>/<stage>"
+    for report in reports:
+        for stage, duration in report['stage_durations'].items():
+            stages[f"{report['path']}/{stage}"] = duration
+            usage[f"{report['path']}/{stage}"] = report['stage_usage'][stage]
+
+def print_project_report(reports):
+    for report in reports:
+        durations = ', '.join(f"{stage} {duration:.1f}s" for stage, duration in report['stage_durations'].items())
+        shared = f" (venv shared with {', '.join(report['shared_with'])})" if report['shared_with'] else ''
+        line = f"{report['path']}: {report['status']}, Python {report['python_version']}{shared}"
+        if durations:
+            line += f" [{durations}]"
+        if report['status'] == 'success':
+            print_success(line)
+        elif report['status'] == 'tests_failed':
+            print_warning(f"{line}: tests failed")
+        else:
+            print_warning(f"{line}: {report['error']}")
+
+if __name__ == "__main__":
+    # Usage: python monorepo.py <repo_path> [<python_version>]; sets up every sub-project of a checkout
+    from logging_config import configure_logging
+
+    configure_logging()
+    repo_path = os.path.abspath(sys.argv[1])
+    projects = discover_projects(repo_path)
+    print_info(f"Found {len(projects)} sub-project(s): {', '.join(projects)}")
+    reports = asyncio.run(setup_projects(repo_path, projects, sys.argv[2] if len(sys.argv) > 2 else None))
+    print_project_report(reports)
+    print(json.dumps(reports))
+    sys.exit(0 if all(report['status'] == 'success' for report in reports) else 1)
@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import functools
+from github_repo_setup import (
+    download_repository_async,
+    update_checkout_async,
+    fetch_submodules_async,
+    fetch_lfs_objects_async,
+    clone_options_with_defaults,
+    uses_submodules,
+    uses_lfs,
+    detect_python_version,
+    setup_virtual_environment_async,
+    install_dependencies_async,
+    precompile_environment_async,
+    setup_git_hooks,
+    check_tests_directory,
+    run_tests_async,
+    get_commit_sha_async,
+    repo_directory,
+    timed_stage
+)
+from monorepo import discover_projects, setup_projects, merge_project_stages
+from journal import (new_journal, load_journal, journal_repo_url, completed_stage, record_stage, forget_stage,
+                     fingerprint, file_digest)
+from lockfiles import requirements_fingerprint
+from history import record_setup
+from logging_config import current_job_id
+from jobs import register_job, unregister_job, set_job_stage
+from profiling import start_tracing, stop_tracing
+from test_results import tests_passed, executed_tests
+
+# Seconds per stage, overridable with SETUP_TIMEOUT_<STAGE>; 0 means no limit
+DEFAULT_STAGE_TIMEOUTS = {
+    'clone': 900,
+    'update': 900,
+    'submodules': 900,
+    'lfs': 1800,
+    'detect': 120,
+    'venv': 300,
+    'install': 1800,
+    'precompile': 600,
+    'tests': 1800,
+}
+STAGE_TIMEOUTS = {
+    stage: float(os.getenv(f"SETUP_TIMEOUT_{stage.upper()}", default)) or None
+    for stage, default in DEFAULT_STAGE_TIMEOUTS.items()
+}
+
+# How many whole setups one event loop drives at once
+SETUP_CONCURRENCY = int(os.getenv('SETUP_CONCURRENCY', 16))
+
+class StageTimeout(RuntimeError):
+    pass
+
+async def run_stage(stages, name, coro, timeouts, usage=None):
+    set_job_stage(current_job_id.get(), name)
+    return await run_timed(stages, name, coro, timeouts, usage)
+
+async def run_timed(stages, name, coro, timeouts, usage=None):
+    # Also used directly for stages running alongside others, which must not take over the job's stage
+    timeout = timeouts.get(name)
+    with timed_stage(stages, name, usage):
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            raise StageTimeout(f"Stage {name} timed out after {timeout}s")
+
+async def run_journaled(journal, resume, stages, name, stage_fingerprint, make_coro, timeouts, usage, skipped,
+                        artifacts=lambda result: (), succeeded=lambda result: True, runner=run_stage):
+    # On resume, a stage whose inputs are unchanged and whose outputs still exist is not run again
+    entry = completed_stage(journal, name, stage_fingerprint) if resume else None
+    if entry:
+        logging.info(f"Stage {name} is unchanged since {time.ctime(entry['completed_at'])}, skipping it")
+        skipped.append(name)
+        return entry['result']
+    forget_stage(journal, name)
+    result = await runner(stages, name, make_coro(), timeouts, usage)
+    if succeeded(result):
+        record_stage(journal, name, stage_fingerprint, result, artifacts(result))
+    return result
+
+async def run_setup(repo_url, custom_path='', python_version='', precompile=False, job_id=None, timeouts=None,
+                    clone_options=None, monorepo=False, resume=False, profile=None, test_retries=None,
+                    rerun_failed=False):
+    job_id = job_id or str(uuid.uuid4())
+    if not profile:
+        return await _run_setup(repo_url, custom_path, python_version, precompile, job_id, timeouts,
+                                clone_options, monorepo, resume, test_retries, rerun_failed)
+    # The profile is written even when the setup fails or is cancelled; that's when it's most wanted
+    tracer, token = start_tracing(job_id, profile)
+    try:
+        result = await _run_setup(repo_url, custom_path, python_version, precompile, job_id, timeouts,
+                                  clone_options, monorepo, resume, test_retries, rerun_failed)
+    finally:
+        paths = stop_tracing(tracer, token)
+    result['profile'] = paths
+    return result
+
+async def _run_setup(repo_url, custom_path, python_version, precompile, job_id, timeouts, clone_options,
+                     monorepo, resume, test_retries, rerun_failed):
+    current_job_id.set(job_id)
+    timeouts = {**STAGE_TIMEOUTS, **(timeouts or {})}
+
+    started_at = time.time()
+    stages = {}
+    usage = {}
+    cache_hits = []
+    skipped = []
+    local_repo_path = None
+    detected_version = None
+    test_results = None
+    deferred_lfs = None
+    project_reports = None
+    register_job(job_id)
+    try:
+        clone_options = clone_options_with_defaults(clone_options)
+        requested_version = python_version if python_version != "Detection failed" else ''
+
+        # Download repository; a checkout whose clone a previous setup journaled is kept, and setting it up
+        # again continues like a resume, so a prewarmed checkout is served warm
+        repo_path = repo_directory(repo_url, custom_path)
+        journal = load_journal(repo_path, repo_url)
+        clone_fingerprint = fingerprint('', repo_url)
+        if completed_stage(journal, 'clone', clone_fingerprint):
+            local_repo_path = journal['stages']['clone']['result']
+            if not resume:
+                # A plain setup is of the repository as it is now; only a resume keeps the commit it had
+                await run_stage(stages, 'update', update_checkout_async(local_repo_path, repo_url), timeouts, usage)
+            skipped.append('clone')
+            resume = True
+            logging.info(f"Resuming setup of {repo_url} in {local_repo_path}")
+        else:
+            # Resuming without a journaled clone means the clone never finished; a checkout journaled for another
+            # repository of the same name is not ours to remove
+            replace_partial = resume and journal_repo_url(repo_path) in (None, repo_url)
+            local_repo_path = await run_stage(stages, 'clone',
+                                              download_repository_async(repo_url, custom_path, clone_options,
+                                                                        replace_partial),
+                                              timeouts, usage)
+            journal = new_journal(local_repo_path, repo_url)
+            record_stage(journal, 'clone', clone_fingerprint, local_repo_path,
+                         [os.path.join(local_repo_path, '.git')])
+        commit = await get_commit_sha_async(local_repo_path)
+
+        def journaled(name, stage_fingerprint, make_coro, **kwargs):
+            return run_journaled(journal, resume, stages, name, stage_fingerprint, make_coro, timeouts, usage,
+                                 skipped, **kwargs)
+
+        # Then its submodules and LFS objects as separately timed stages
+        if uses_submodules(local_repo_path):
+            await journaled('submodules',
+                            fingerprint(clone_fingerprint, commit,
+                                        file_digest(os.path.join(local_repo_path, '.gitmodules')),
+                                        clone_options['submodules'], clone_options['shallow_submodules']),
+                            lambda: fetch_submodules_async(local_repo_path, repo_url, clone_options))
+        if uses_lfs(local_repo_path):
+            lfs_fingerprint = fingerprint(clone_fingerprint, commit, clone_options['lfs'], clone_options['lfs_include'])
+            fetch_lfs = functools.partial(fetch_lfs_objects_async, local_repo_path, clone_options)
+            if clone_options['lfs'] == 'defer':
+                # Large files are usually only needed by the tests, so they download while the venv is built
+                deferred_lfs = asyncio.create_task(journaled('lfs', lfs_fingerprint, fetch_lfs, runner=run_timed))
+            else:
+                await journaled('lfs', lfs_fingerprint, fetch_lfs)
+
+        if monorepo:
+            # Every sub-project gets its own environment (shared when requirements match), set up in parallel
+            projects = await run_stage(stages, 'discover', asyncio.to_thread(discover_projects, local_repo_path),
+                                       timeouts, usage)
+            if not projects:
+                raise RuntimeError("No Python projects found in the repository")
+            if deferred_lfs:
+                set_job_stage(job_id, 'lfs')
+                await deferred_lfs
+            python_version = requested_version
+            # Sub-project stages carry their own deadlines, "projects" only measures the whole
+            project_reports = await run_stage(stages, 'projects',
+                                              setup_projects(local_repo_path, projects, python_version or None,
+                                                             timeouts, cache_hits),
+                                              timeouts, usage)
+            merge_project_stages(project_reports, stages, usage)
+            statuses = {report['status'] for report in project_reports}
+            if statuses - {'success', 'tests_failed'}:
+                status = 'failed'
+            else:
+                status = 'tests_failed' if 'tests_failed' in statuses else 'success'
+        else:
+            # Detect Python version
+            detected_version = await journaled('detect', fingerprint(clone_fingerprint, commit, requested_version),
+                                               lambda: asyncio.to_thread(detect_python_version, local_repo_path),
+                                               succeeded=bool)
+            python_version = requested_version or detected_version
+            if not python_version:
+                raise ValueError("Unable to detect Python version. Please specify a version manually.")
+
+            # Setup virtual environment
+            venv_fingerprint = fingerprint(clone_fingerprint, python_version)
+            venv_path = await journaled('venv', venv_fingerprint,
+                                        lambda: setup_virtual_environment_async(local_repo_path, python_version),
+                                        artifacts=lambda path: [os.path.join(path, 'pyvenv.cfg')], succeeded=bool)
+            if not venv_path:
+                raise RuntimeError(f"Failed to set up a Python {python_version} virtual environment")
+
+            # Install dependencies
+            install_fingerprint = fingerprint(venv_fingerprint, commit,
+                                              requirements_fingerprint(local_repo_path, python_version))
+            if not await journaled('install', install_fingerprint,
+                                   lambda: install_dependencies_async(venv_path, local_repo_path, cache_hits),
+                                   succeeded=bool):
+                raise RuntimeError("Failed to install dependencies")
+
+            # Precompile bytecode so the first test run and app start don't pay for it
+            if precompile:
+                await journaled('precompile', fingerprint(install_fingerprint, os.getenv('SETUP_PYC_INVALIDATION')),
+                                lambda: precompile_environment_async(venv_path, local_repo_path))
+
+            # Setup Git hooks
+            with timed_stage(stages, 'git_hooks', usage):
+                # Builds the import index, which parses every source file
+                await asyncio.to_thread(setup_git_hooks, local_repo_path, venv_path)
+
+            if deferred_lfs:
+                set_job_stage(job_id, 'lfs')
+                await deferred_lfs
+
+            # Check for tests and run them; only a passing run is journaled
+            if check_tests_directory(local_repo_path):
+                test_results = await journaled('tests', fingerprint(install_fingerprint, commit),
+                                               lambda: run_tests_async(local_repo_path, venv_path, test_retries,
+                                                                       rerun_failed),
+                                               succeeded=tests_passed)
+
+            status = 'success' if tests_passed(test_results) else 'tests_failed'
+
+        # A journaled test run was already recorded by the setup that ran it
+        tests = executed_tests(test_results) if 'tests' not in skipped else None
+
+        record_setup(repo_url, status, stages, started_at, job_id=job_id, local_path=local_repo_path,
+                     commit_sha=commit, interpreter=python_version,
+                     exit_status=0 if status == 'success' else 1, cache_hits=cache_hits, usage=usage, tests=tests)
+
+        result = {
+            'success': status != 'failed',
+            'status': status,
+            'job_id': job_id,
+            'repo_url': repo_url,
+            'message': 'Repository setup completed successfully' if status != 'failed'
+                       else 'Some sub-projects failed to set up',
+            'local_path': local_repo_path,
+            'detected_version': detected_version,
+            'used_version': python_version,
+            'test_results': test_results,
+            'stage_durations': stages,
+            'stage_usage': usage,
+            'skipped_stages': skipped,
+            'cache_hits': cache_hits
+        }
+        if project_reports is not None:
+            result['projects'] = project_reports
+        return result
+
+    except (Exception, asyncio.CancelledError) as e:
+        if isinstance(e, asyncio.CancelledError):
+            status, error = 'cancelled', 'Setup cancelled'
+        elif isinstance(e, StageTimeout):
+            status, error = 'timed_out', str(e)
+        else:
+            status, error = 'failed', str(e)
+        logging.error(f"Error in setup of {repo_url}: {error}")
+        record_setup(repo_url, status, stages, started_at, job_id=job_id, local_path=local_repo_path,
+                     commit_sha=await get_commit_sha_async(local_repo_path), interpreter=python_version or detected_version,
+                     exit_status=1, error=error, cache_hits=cache_hits, usage=usage)
+        return {
+            'success': False,
+            'status': status,
+            'job_id': job_id,
+            'repo_url': repo_url,
+            'error': error,
+            'local_path': local_repo_path,
+            'stage_durations': stages,
+            'stage_usage': usage,
+            'skipped_stages': skipped,
+            'cache_hits': cache_hits
+        }
+    finally:
+        if deferred_lfs and not deferred_lfs.done():
+            deferred_lfs.cancel()
+            await asyncio.gather(deferred_lfs, return_exceptions=True)
+        unregister_job(job_id)
+
+async def run_setups(setup_requests, concurrency=SETUP_CONCURRENCY):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def bounded(setup_request):
+        async with limit:
+            return await run_setup(**setup_request)
+
+    # Each setup runs in its own task, so job ids and stages stay separate in the logs
+    return await asyncio.gather(*(bounded(setup_request) for setup_request in setup_requests))
+
+if __name__ == "__main__":
+    # Usage: python pipeline.py <repo_url> [<repo_url> ...]; prints one JSON result per line
+    from logging_config import configure_logging
+
+    configure_logging()
+    results = asyncio.run(run_setups([{'repo_url': url} for url in sys.argv[1:]]))
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(0 if all(result['success'] for result in results) else 1)
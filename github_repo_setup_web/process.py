@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import errno
+import shutil
+import signal
+import asyncio
+import logging
+import tempfile
+import subprocess
+import weakref
+from accounting import add_usage
+from logging_config import current_stage
+from profiling import current_tracer, command_label
+
+SHIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rusage_shim.py')
+
+# How many commands of each resource class may run at once within one event loop
+RESOURCE_LIMITS = {
+    'network': int(os.getenv('SETUP_NETWORK_CONCURRENCY', 4)),
+    'cpu': int(os.getenv('SETUP_CPU_CONCURRENCY', os.cpu_count() or 2)),
+    'disk': int(os.getenv('SETUP_DISK_CONCURRENCY', 4)),
+}
+
+_semaphores = weakref.WeakKeyDictionary()
+
+def resource_semaphore(resource):
+    # asyncio primitives belong to one loop; every loop (one per asyncio.run) gets its own set
+    loop = asyncio.get_running_loop()
+    semaphores = _semaphores.setdefault(loop, {})
+    if resource not in semaphores:
+        semaphores[resource] = asyncio.Semaphore(RESOURCE_LIMITS.get(resource, 1))
+    return semaphores[resource]
+
+# Seconds between SIGTERM and SIGKILL when a command's process group is stopped
+KILL_GRACE_PERIOD = float(os.getenv('SETUP_KILL_GRACE_PERIOD', 5))
+
+def _signal_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def _terminate(process):
+    # Commands run in their own session, so the whole tree (git remote helpers, pip builds,
+    # test subprocesses) is stopped, not just the direct child
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        pass
+    _signal_group(process, signal.SIGKILL)
+    await process.wait()
+
+def _find_executable(args, cwd, env):
+    executable = args[0]
+    if os.sep in executable:
+        return os.path.join(cwd, executable) if cwd and not os.path.isabs(executable) else executable
+    path = (env or os.environ).get('PATH', os.defpath)
+    return shutil.which(executable, path=path)
+
+def _collect_usage(usage_path):
+    try:
+        with open(usage_path, 'r') as f:
+            usage = json.load(f)
+    except (OSError, ValueError):
+        # Killed before the shim could report
+        return
+    finally:
+        try:
+            os.unlink(usage_path)
+        except OSError:
+            pass
+    add_usage(commands=1, **usage)
+    return usage
+
+async def run_command(args, cwd=None, env=None, check=True, capture_output=False, text=False,
+                      timeout=None, resource='cpu'):
+    executable = _find_executable(args, cwd, env)
+    if not executable or not os.path.exists(executable):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), args[0])
+
+    fd, usage_path = tempfile.mkstemp(prefix='repo-setup-rusage-', suffix='.json')
+    os.close(fd)
+    output = asyncio.subprocess.PIPE if capture_output else None
+    tracer = current_tracer.get()
+    async with resource_semaphore(resource):
+        logging.debug(f"Running {args}")
+        trace_start = tracer.now() if tracer else None
+        # The shim wait4()s on the command so its CPU, memory and I/O can be charged to the current stage
+        process = await asyncio.create_subprocess_exec(sys.executable, '-S', '-E', SHIM_PATH, usage_path, *args,
+                                                       cwd=cwd, env=env, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=output, stderr=output, start_new_session=True)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            await _terminate(process)
+            raise subprocess.TimeoutExpired(args, timeout)
+        except asyncio.CancelledError:
+            await _terminate(process)
+            raise
+        finally:
+            command_usage = _collect_usage(usage_path)
+            if tracer:
+                # Queueing on the resource semaphore is not part of the span
+                tracer.span('command', command_label(args), trace_start, stage=current_stage.get(),
+                            argv=[str(arg) for arg in args], pid=process.pid, returncode=process.returncode,
+                            resource=resource, usage=command_usage)
+
+    if text:
+        stdout = stdout.decode(errors='replace') if stdout is not None else None
+        stderr = stderr.decode(errors='replace') if stderr is not None else None
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
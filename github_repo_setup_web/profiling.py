@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import contextvars
+
+# Tracer of the setup running in this context; None (the default) makes every hook a single lookup
+current_tracer = contextvars.ContextVar('current_tracer', default=None)
+
+PROFILE_DIR = os.getenv('SETUP_PROFILE_DIR', os.path.expanduser("~/github_projects/.profiles"))
+# "timeline" records stages and commands; "python" also runs cProfile on the setup's thread
+PROFILE_MODES = ('timeline', 'python')
+# Call paths below this share of the profiled time are left out of the collapsed stacks
+PROFILE_MIN_SHARE = float(os.getenv('SETUP_PROFILE_MIN_SHARE', 0.0005))
+
+# Pseudo process ids that group the trace into a stage row set and a command row set
+STAGES_PID = 1
+COMMANDS_PID = 2
+
+class Tracer:
+    def __init__(self, label, mode='timeline'):
+        self.label = label
+        self.mode = mode
+        self.spans = []
+        self.paths = {}
+        self.profile = None
+        self.started_at = time.time()
+        self.origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter_ns()
+
+    def span(self, category, name, start, end=None, **args):
+        end = end if end is not None else time.perf_counter_ns()
+        with self._lock:
+            self.spans.append({'cat': category, 'name': name, 'start': start, 'end': end, 'args': args})
+
+    def start_profile(self):
+        if self.mode != 'python':
+            return
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # Only one profiler per thread (per process on 3.12+), e.g. with concurrent profiled setups
+            logging.warning(f"Python profiling is unavailable for {self.label}: {str(e)}")
+            self.profile = None
+
+    def stop_profile(self):
+        if self.profile:
+            self.profile.disable()
+
+    def chrome_trace(self):
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': STAGES_PID, 'tid': 0, 'args': {'name': f"Stages ({self.label})"}},
+            {'name': 'process_name', 'ph': 'M', 'pid': COMMANDS_PID, 'tid': 0, 'args': {'name': 'Commands'}}
+        ]
+        for category, pid in (('stage', STAGES_PID), ('command', COMMANDS_PID)):
+            spans = [span for span in self.spans if span['cat'] == category]
+            for lane, span in assign_lanes(spans):
+                events.append({
+                    'name': span['name'],
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': (span['start'] - self.origin) / 1000,
+                    'dur': (span['end'] - span['start']) / 1000,
+                    'pid': pid,
+                    'tid': lane,
+                    'args': span['args']
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'label': self.label, 'started_at': self.started_at}}
+
+    def collapsed_timeline(self):
+        # Wall time per "setup;<stage>;<command>" path, in microseconds
+        folded = {}
+        stages = [span for span in self.spans if span['cat'] == 'stage']
+        for span in stages:
+            commands = [command for command in self.spans
+                        if command['cat'] == 'command' and command['args'].get('stage') == span['name']
+                        and span['start'] <= command['start'] <= span['end']]
+            # Commands may overlap, so a stage's own time is whatever none of them covers
+            own = (span['end'] - span['start']) - covered(commands)
+            add_folded(folded, ('setup', span['name']), own / 1000)
+            for command in commands:
+                add_folded(folded, ('setup', span['name'], command['name']), (command['end'] - command['start']) / 1000)
+        for command in self.spans:
+            if command['cat'] == 'command' and not command['args'].get('stage'):
+                add_folded(folded, ('setup', command['name']), (command['end'] - command['start']) / 1000)
+        return folded
+
+    def collapsed_profile(self):
+        return collapse_profile(self.profile) if self.profile else {}
+
+    def export(self, directory=PROFILE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.label)
+        self.paths['trace'] = f"{base}.trace.json"
+        with open(self.paths['trace'], 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        self.paths['folded'] = f"{base}.folded"
+        write_folded(self.paths['folded'], self.collapsed_timeline())
+        if self.profile:
+            self.paths['python_folded'] = f"{base}.python.folded"
+            write_folded(self.paths['python_folded'], self.collapsed_profile())
+            self.paths['pstats'] = f"{base}.pstats"
+            self.profile.dump_stats(self.paths['pstats'])
+        logging.info(f"Wrote profile of {self.label} to {base}.*", extra={'profile': self.paths})
+        return self.paths
+
+def assign_lanes(spans):
+    # Chrome trace rows need strictly nested complete events, so overlapping spans go to separate rows
+    lanes = []
+    for span in sorted(spans, key=lambda span: (span['start'], -span['end'])):
+        for lane, open_ends in enumerate(lanes):
+            while open_ends and open_ends[-1] <= span['start']:
+                open_ends.pop()
+            if not open_ends or span['end'] <= open_ends[-1]:
+                open_ends.append(span['end'])
+                yield lane, span
+                break
+        else:
+            lanes.append([span['end']])
+            yield len(lanes) - 1, span
+
+def covered(spans):
+    total, end = 0, None
+    for span in sorted(spans, key=lambda span: span['start']):
+        start = span['start'] if end is None else max(span['start'], end)
+        if span['end'] > start:
+            total += span['end'] - start
+        end = span['end'] if end is None else max(end, span['end'])
+    return total
+
+def add_folded(folded, path, value):
+    if value > 0:
+        key = ';'.join(frame.replace(';', ',') for frame in path)
+        folded[key] = folded.get(key, 0) + value
+
+def write_folded(path, folded):
+    with open(path, 'w') as f:
+        for stack, value in sorted(folded.items()):
+            if int(value):
+                f.write(f"{stack} {int(value)}\n")
+
+def frame_label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+def collapse_profile(profile, min_share=PROFILE_MIN_SHARE):
+    # profile is a cProfile.Profile or the path of a dumped .pstats file
+    # cProfile keeps caller/callee edges, not stacks: a function's time is split over its call paths
+    # in proportion to the cumulative time of each edge, which is exact for tree-shaped call graphs
+    stats = pstats.Stats(profile).stats
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    threshold = sum(value[2] for value in stats.values()) * min_share
+    folded = {}
+    pending = [((frame_label(func),), func, 1.0, frozenset([func])) for func, value in stats.items() if not value[4]]
+    while pending:
+        path, func, share, on_path = pending.pop()
+        add_folded(folded, path, stats[func][2] * share * 1e6)
+        for callee, edge_time in callees.get(func, ()):
+            callee_time = stats[callee][3]
+            if callee in on_path or callee_time <= 0 or edge_time * share < threshold:
+                continue
+            pending.append((path + (frame_label(callee),), callee, share * min(1.0, edge_time / callee_time),
+                            on_path | {callee}))
+    return folded
+
+def command_label(args):
+    # "git clone", "python -m pip install": the program and its leading subcommands, without paths or URLs
+    words = [os.path.basename(str(args[0]))]
+    for arg in args[1:]:
+        arg = str(arg)
+        if len(words) == 4 or (arg.startswith('-') and arg != '-m') or any(c in arg for c in '/\\=:'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+def start_tracing(label, mode='timeline'):
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    tracer = Tracer(label, mode)
+    token = current_tracer.set(tracer)
+    tracer.start_profile()
+    return tracer, token
+
+def stop_tracing(tracer, token, directory=PROFILE_DIR):
+    tracer.stop_profile()
+    current_tracer.reset(token)
+    try:
+        return tracer.export(directory)
+    except OSError as e:
+        # A profile is a diagnostic; failing to write it must not fail the setup
+        logging.warning(f"Failed to write profile of {tracer.label}: {str(e)}")
+        return {}
+
+if __name__ == "__main__":
+    # Usage: python profiling.py <file.pstats>; prints the collapsed stacks of a saved Python profile
+    folded = collapse_profile(sys.argv[1])
+    for stack, value in sorted(folded.items()):
+        if int(value):
+            print(f"{stack} {int(value)}")
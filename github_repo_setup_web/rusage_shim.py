@@ -0,0 +1,34 @@
+# Runs a command and writes its resource usage as JSON, for process.run_command.
+# asyncio reaps its children itself, so the only way to get per-command rusage is to
+# wait4() on the command from a small parent of our own.
+#
+# Usage: python -S -E rusage_shim.py <result_path> <command> [args...]
+import os
+import sys
+import json
+
+def main():
+    result_path, args = sys.argv[1], sys.argv[2:]
+    try:
+        pid = os.posix_spawnp(args[0], args, os.environ)
+    except OSError as e:
+        sys.stderr.write(f"{args[0]}: {e.strerror}\n")
+        sys.exit(127)
+
+    _, status, usage = os.wait4(pid, 0)
+    with open(result_path, 'w') as f:
+        json.dump({
+            'cpu_user': usage.ru_utime,
+            'cpu_sys': usage.ru_stime,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_bytes': usage.ru_maxrss * 1024,
+            # Block counts are in 512-byte units
+            'disk_read_bytes': usage.ru_inblock * 512,
+            'disk_write_bytes': usage.ru_oublock * 512
+        }, f)
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    sys.exit(exit_code if exit_code >= 0 else 128 - exit_code)
+
+if __name__ == '__main__':
+    main()
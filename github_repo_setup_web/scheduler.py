@@ -0,0 +1,158 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from history import get_stage_durations
+from github_repo_setup import g, base_directory
+
+def _total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 ** 3
+
+# Budgets are reservations against estimated cost, not measurements of current usage
+CPU_BUDGET = float(os.getenv('SETUP_CPU_BUDGET', os.cpu_count() or 1))
+MEMORY_BUDGET = int(os.getenv('SETUP_MEMORY_BUDGET', int(_total_memory() * 0.75)))
+DISK_BUDGET = int(os.getenv('SETUP_DISK_BUDGET', 50 * 1024 ** 3))
+QUEUE_SIZE = int(os.getenv('SETUP_QUEUE_SIZE', 32))
+# Seconds a repository's stage history is reused for estimates before it is read again
+ESTIMATE_TTL = float(os.getenv('SETUP_ESTIMATE_TTL', 300))
+
+DEFAULT_COST = {'cpu': 1.0, 'memory': 1024 ** 3, 'disk': 1024 ** 3, 'duration': 600.0}
+
+_lock = threading.Lock()
+_running = {}
+_releases = 0
+_repo_sizes = {}
+_stage_stats = {}
+
+def repo_size(repo_url):
+    # Size of the repository on GitHub in bytes, or None; cached for the lifetime of the process
+    if repo_url in _repo_sizes:
+        return _repo_sizes[repo_url]
+    size = None
+    try:
+        parts = repo_url.rstrip('/').split('/')
+        size = g.get_repo(f"{parts[-2]}/{parts[-1].replace('.git', '')}").size * 1024
+    except Exception as e:
+        logging.warning(f"Could not get the size of {repo_url}: {str(e)}")
+    _repo_sizes[repo_url] = size
+    return size
+
+def stage_stats(repo_url):
+    cached = _stage_stats.get(repo_url)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        stats = get_stage_durations(repo_url)
+    except Exception as e:
+        logging.warning(f"Could not read stage history for {repo_url}: {str(e)}")
+        stats = {}
+    # Sub-project stages ("<project>/<stage>") overlap and are covered by the "projects" stage
+    stats = {stage: values for stage, values in stats.items() if '/' not in stage}
+    _stage_stats[repo_url] = (time.monotonic() + ESTIMATE_TTL, stats)
+    return stats
+
+def estimated_duration(repo_url):
+    # Cheap enough for the request path: no GitHub lookup, and the history is read once per ESTIMATE_TTL
+    stats = stage_stats(repo_url)
+    return sum(values['mean'] for values in stats.values()) if stats else DEFAULT_COST['duration']
+
+def estimate_cost(repo_url):
+    cost = dict(DEFAULT_COST)
+    stats = stage_stats(repo_url)
+    if stats:
+        cost['duration'] = sum(values['mean'] for values in stats.values())
+        cpu_seconds = [values['mean_cpu'] for values in stats.values() if values['mean_cpu'] is not None]
+        if cpu_seconds and cost['duration'] > 0:
+            cost['cpu'] = max(0.5, sum(cpu_seconds) / cost['duration'])
+        rss = [values['max_peak_rss_bytes'] for values in stats.values() if values['max_peak_rss_bytes']]
+        if rss:
+            cost['memory'] = max(256 * 1024 ** 2, int(max(rss) * 1.25))
+        written = [values['max_disk_write_bytes'] for values in stats.values() if values['max_disk_write_bytes']]
+        if written:
+            cost['disk'] = sum(written)
+
+    size = repo_size(repo_url)
+    if size:
+        # Working tree plus object store, on top of what the environment writes
+        cost['disk'] += 2 * size
+
+    # A job larger than the whole budget runs alone rather than never
+    cost['cpu'] = min(cost['cpu'], CPU_BUDGET)
+    cost['memory'] = min(cost['memory'], MEMORY_BUDGET)
+    cost['disk'] = min(cost['disk'], DISK_BUDGET)
+    return cost
+
+def _in_use():
+    return {
+        resource: sum(job['cost'][resource] for job in _running.values())
+        for resource in ('cpu', 'memory', 'disk')
+    }
+
+def _disk_limit():
+    try:
+        return min(DISK_BUDGET, shutil.disk_usage(base_directory()).free)
+    except OSError:
+        return DISK_BUDGET
+
+def _fits(cost):
+    if not _running:
+        return True
+    used = _in_use()
+    return (used['cpu'] + cost['cpu'] <= CPU_BUDGET and
+            used['memory'] + cost['memory'] <= MEMORY_BUDGET and
+            used['disk'] + cost['disk'] <= _disk_limit())
+
+def has_room():
+    # Checked before leasing, so a worker whose budgets are used up leaves queued jobs to idle workers
+    with _lock:
+        if not _running:
+            return True
+        used = _in_use()
+        return used['cpu'] < CPU_BUDGET and used['memory'] < MEMORY_BUDGET and used['disk'] < _disk_limit()
+
+def try_admit(job_id, repo_url, cost):
+    # Never waits: a job that doesn't fit goes back to the shared queue, where another worker can take it
+    with _lock:
+        if not _fits(cost):
+            logging.info(f"Not admitting setup of {repo_url}: {len(_running)} running", extra={'cost': cost})
+            return False
+        now = time.time()
+        _running[job_id] = {'job_id': job_id, 'repo_url': repo_url, 'cost': cost, 'started_at': now,
+                            'estimated_end': now + cost['duration']}
+        return True
+
+def release(job_id):
+    global _releases
+    with _lock:
+        if _running.pop(job_id, None):
+            _releases += 1
+
+def releases():
+    # Changes whenever reserved capacity is given back, which is when a job that didn't fit may fit
+    with _lock:
+        return _releases
+
+def capacity():
+    with _lock:
+        used = _in_use()
+        try:
+            disk_free = shutil.disk_usage(base_directory()).free
+        except OSError:
+            disk_free = None
+        return {
+            'budget': {'cpu': CPU_BUDGET, 'memory': MEMORY_BUDGET, 'disk': DISK_BUDGET},
+            'reserved': used,
+            'available': {
+                'cpu': CPU_BUDGET - used['cpu'],
+                'memory': MEMORY_BUDGET - used['memory'],
+                'disk': DISK_BUDGET - used['disk']
+            },
+            'disk_free': disk_free,
+            'queue_size': QUEUE_SIZE,
+            'running': [{key: job[key] for key in ('job_id', 'repo_url', 'cost', 'started_at', 'estimated_end')}
+                        for job in _running.values()]
+        }
@@ -0,0 +1,300 @@
+import io
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import shutil
+import hashlib
+import logging
+import tarfile
+import argparse
+import platform
+import tempfile
+import subprocess
+from github_repo_setup import venv_python_version, get_commit_sha, print_success, print_error
+from lockfiles import manifest_fingerprint
+from journal import journal_path
+
+SNAPSHOT_DIR = os.getenv('SETUP_SNAPSHOT_DIR', os.path.expanduser("~/github_projects/.snapshots"))
+SNAPSHOT_COMPRESSLEVEL = int(os.getenv('SETUP_SNAPSHOT_COMPRESSLEVEL', 6))
+METADATA_NAME = 'snapshot.json'
+SNAPSHOT_FORMAT = 1
+CHUNK_SIZE = 1024 * 1024
+# Members are checked by _safe_member; newer Pythons also want an explicit extraction filter
+EXTRACT_ARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+# Text files in the venv that embed absolute paths; everything else is relocatable as is
+FIXUP_SUFFIXES = ('.pth', '.cfg', '.json', '.py', '.sh', '.fish', '.csh', '.nu', '.ps1', '.bat')
+
+class HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+class HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def drain(self):
+        # Trailing padding and the gzip footer are part of the digest too
+        while self.read(CHUNK_SIZE):
+            pass
+
+def snapshot_metadata(repo_path, venv_path):
+    try:
+        repo_url = subprocess.run(["git", "remote", "get-url", "origin"], cwd=repo_path, check=True,
+                                  capture_output=True, text=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        repo_url = None
+    python_version = venv_python_version(venv_path)
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'repo_url': repo_url,
+        'commit_sha': get_commit_sha(repo_path),
+        'repo_path': os.path.abspath(repo_path),
+        'venv': os.path.relpath(venv_path, repo_path),
+        'python_version': python_version,
+        'manifest_fingerprint': manifest_fingerprint(repo_path, python_version),
+        'platform': sys.platform,
+        'machine': platform.machine()
+    }
+
+def export_snapshot(repo_path, venv_path=None, output_dir=SNAPSHOT_DIR):
+    repo_path = os.path.abspath(repo_path)
+    venv_path = os.path.abspath(venv_path or os.path.join(repo_path, 'venv'))
+    if not os.path.exists(os.path.join(venv_path, 'pyvenv.cfg')):
+        raise RuntimeError(f"No virtual environment found at {venv_path}")
+    if not venv_path.startswith(repo_path + os.sep):
+        raise RuntimeError("The virtual environment must live inside the repository to be snapshotted")
+
+    metadata = snapshot_metadata(repo_path, venv_path)
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', suffix='.tmp', dir=output_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = HashingWriter(f)
+            # mtime=0 keeps the gzip header independent of when the export ran
+            with gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=SNAPSHOT_COMPRESSLEVEL, mtime=0) as gz:
+                with tarfile.open(fileobj=gz, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                    # Metadata goes first so a restore can validate the host before extracting anything
+                    data = json.dumps(metadata, indent=2).encode()
+                    info = tarfile.TarInfo(METADATA_NAME)
+                    info.size = len(data)
+                    tar.addfile(info, fileobj=io.BytesIO(data))
+                    # File mtimes are kept, so timestamp-based .pyc files stay valid after restore
+                    tar.add(repo_path, arcname='repo', filter=_normalize_owner)
+        digest = writer.digest.hexdigest()
+
+        # Content-addressed: identical snapshots share one archive
+        archive_path = os.path.join(output_dir, f"{digest}.tar.gz")
+        if os.path.exists(archive_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, archive_path)
+        with open(os.path.join(output_dir, f"{digest}.json"), 'w') as f:
+            # The export time only goes in the sidecar; in the archive it would change the digest of every export
+            json.dump({**metadata, 'sha256': digest, 'size': os.path.getsize(archive_path),
+                       'created_at': time.time()}, f, indent=2)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logging.info(f"Exported snapshot {digest} of {repo_path}")
+    return archive_path, digest
+
+def _normalize_owner(info):
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+def _safe_member(member, root):
+    if member.isdev() or os.path.isabs(member.name):
+        return False
+    destination = os.path.realpath(os.path.join(root, member.name))
+    if not destination.startswith(os.path.realpath(root) + os.sep):
+        return False
+    if member.islnk():
+        target = os.path.realpath(os.path.join(root, member.linkname))
+        return target.startswith(os.path.realpath(root) + os.sep)
+    # Symlinks may point outside: the venv interpreter links to the host's Python
+    return True
+
+def check_host(metadata, venv_path):
+    if metadata.get('format') != SNAPSHOT_FORMAT:
+        raise RuntimeError(f"Unsupported snapshot format: {metadata.get('format')}")
+    if (metadata['platform'], metadata['machine']) != (sys.platform, platform.machine()):
+        raise RuntimeError(f"Snapshot was built on {metadata['platform']}/{metadata['machine']}, "
+                           f"this host is {sys.platform}/{platform.machine()}")
+    home = None
+    with open(os.path.join(venv_path, 'pyvenv.cfg'), 'r') as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            if key.strip() == 'home':
+                home = value.strip()
+    if not home or not os.path.isdir(home):
+        raise RuntimeError(f"Python {metadata['python_version']} is not installed at {home} on this host")
+
+def root_pattern(old_root):
+    # Whole paths only: /x/repo must not match inside /x/repo2 or /y/x/repo
+    return r'(?<![\w.~+@-])' + re.escape(old_root) + r'(?![^/\s\'"\0:;,=)\]}])'
+
+def _rewrite_file(path, pattern, new, skip_binary=False):
+    with open(path, 'rb') as f:
+        content = f.read()
+    if skip_binary and b'\0' in content:
+        return 0
+    rewritten = pattern.sub(lambda match: new, content)
+    if rewritten == content:
+        return 0
+    stat = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(rewritten)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return 1
+
+def _relocate(value, pattern, new):
+    if isinstance(value, str):
+        return pattern.sub(lambda match: new, value)
+    if isinstance(value, list):
+        return [_relocate(item, pattern, new) for item in value]
+    if isinstance(value, dict):
+        return {key: _relocate(item, pattern, new) for key, item in value.items()}
+    return value
+
+def fix_up_paths(root, old_root, new_root, venv_relpath):
+    # Scripts, activate files, pyvenv.cfg and editable-install .pth files embed the old location
+    pattern = root_pattern(old_root)
+    old, new = re.compile(pattern.encode()), new_root.encode()
+    fixed = 0
+    for directory, dirs, files in os.walk(os.path.join(root, venv_relpath)):
+        in_bin = os.path.basename(directory) in ('bin', 'Scripts')
+        for file in files:
+            if not (in_bin or file == 'pyvenv.cfg' or file.endswith(FIXUP_SUFFIXES)):
+                continue
+            path = os.path.join(directory, file)
+            if not os.path.islink(path):
+                fixed += _rewrite_file(path, old, new, skip_binary=in_bin)
+
+    # So do the git hooks (the pre-commit hook runs the venv interpreter)...
+    hooks = os.path.join(root, '.git', 'hooks')
+    if os.path.isdir(hooks):
+        for file in os.listdir(hooks):
+            path = os.path.join(hooks, file)
+            if not file.endswith('.sample') and os.path.isfile(path) and not os.path.islink(path):
+                fixed += _rewrite_file(path, old, new, skip_binary=True)
+
+    # ...and the setup journal: its artifacts are absolute paths, the clone result is the checkout itself
+    path = journal_path(root)
+    try:
+        with open(path, 'r') as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        journal = None
+    if journal is not None:
+        relocated = _relocate(journal, re.compile(pattern), new_root)
+        if relocated != journal:
+            with open(path, 'w') as f:
+                json.dump(relocated, f, indent=2)
+            fixed += 1
+    logging.info(f"Rewrote {fixed} file(s) in {new_root} for the new location")
+    return fixed
+
+def restore_snapshot(source, target_path, expected_sha256=None):
+    target_path = os.path.abspath(target_path)
+    if os.path.exists(target_path):
+        raise RuntimeError(f"Target {target_path} already exists")
+    if expected_sha256 is None and source != '-':
+        # Archives are named by their digest
+        name = os.path.basename(source)
+        if name.endswith('.tar.gz') and len(name) == 64 + len('.tar.gz'):
+            expected_sha256 = name[:64]
+    if expected_sha256 is None:
+        raise RuntimeError("Cannot verify the snapshot: pass its sha256")
+
+    parent = os.path.dirname(target_path)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.snapshot-restore-', dir=parent)
+    try:
+        f = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        try:
+            reader = HashingReader(f)
+            # Decompression, hashing and extraction happen in one streaming pass
+            with gzip.GzipFile(fileobj=reader, mode='rb') as gz:
+                with tarfile.open(fileobj=gz, mode='r|') as tar:
+                    metadata = None
+                    for member in tar:
+                        if metadata is None:
+                            if member.name != METADATA_NAME:
+                                raise RuntimeError("Not a setup snapshot: metadata is missing")
+                            metadata = json.loads(tar.extractfile(member).read())
+                            continue
+                        if not _safe_member(member, staging):
+                            raise RuntimeError(f"Refusing unsafe archive member: {member.name}")
+                        tar.extract(member, staging, **EXTRACT_ARGS)
+            reader.drain()
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+        digest = reader.digest.hexdigest()
+        if digest != expected_sha256:
+            raise RuntimeError(f"Snapshot integrity check failed: expected {expected_sha256}, got {digest}")
+
+        extracted = os.path.join(staging, 'repo')
+        venv_path = os.path.join(extracted, metadata['venv'])
+        check_host(metadata, venv_path)
+        fix_up_paths(extracted, metadata['repo_path'], target_path, metadata['venv'])
+        os.rename(extracted, target_path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    logging.info(f"Restored snapshot {expected_sha256} to {target_path}")
+    return {**metadata, 'sha256': expected_sha256, 'repo_path': target_path,
+            'venv_path': os.path.join(target_path, metadata['venv'])}
+
+if __name__ == "__main__":
+    # Usage: python snapshots.py export <repo_path> [--venv PATH] [--output DIR]
+    #        python snapshots.py restore <archive|-> <target_path> [--sha256 DIGEST]
+    from logging_config import configure_logging
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Export or restore a completed repository setup.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('repo_path')
+    export_parser.add_argument('--venv')
+    export_parser.add_argument('--output', default=SNAPSHOT_DIR)
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('archive', help="Archive path, or - to read from stdin")
+    restore_parser.add_argument('target_path')
+    restore_parser.add_argument('--sha256')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'export':
+            archive_path, digest = export_snapshot(args.repo_path, args.venv, args.output)
+            print_success(f"Snapshot written to {archive_path}")
+            print(digest)
+        else:
+            start = time.monotonic()
+            result = restore_snapshot(args.archive, args.target_path, args.sha256)
+            print_success(f"Restored {result['repo_url'] or result['sha256']} to {result['repo_path']} "
+                          f"in {time.monotonic() - start:.1f}s")
+    except (RuntimeError, OSError, tarfile.TarError) as e:
+        print_error(str(e))
+        sys.exit(1)
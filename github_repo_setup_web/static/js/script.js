@@ -11,6 +11,8 @@ document.addEventListener('DOMContentLoaded', (event) => {
     const resultDiv = document.getElementById('result');
     const resultMessage = document.getElementById('result-message');
     const resultDetails = document.getElementById('result-details');
+    const cancelButton = document.getElementById('cancel-setup');
+    let currentJobId = null;
 
     console.log('Form elements:', {
         form: form,
@@ -64,6 +66,35 @@ document.addEventListener('DOMContentLoaded', (event) => {
                 resultDetails.appendChild(li);
             });
         }
+        if (data.profile && data.profile.trace) {
+            const li = document.createElement('li');
+            const link = document.createElement('a');
+            link.href = `/jobs/${data.job_id}/profile?format=trace`;
+            link.textContent = 'Download profile (Chrome trace)';
+            li.appendChild(link);
+            resultDetails.appendChild(li);
+        }
+        if (data.test_results && data.test_results.summary) {
+            const summary = data.test_results.summary;
+            const li = document.createElement('li');
+            li.textContent = `Tests: ${summary.passed} passed, ${summary.failed + summary.error} failed, ` +
+                `${summary.flaky} flaky, ${summary.skipped} skipped in ${summary.duration.toFixed(1)}s`;
+            resultDetails.appendChild(li);
+            data.test_results.tests
+                .filter(test => ['failed', 'error', 'unexpected_success', 'flaky'].includes(test.status))
+                .forEach(test => {
+                    const item = document.createElement('li');
+                    item.textContent = `${test.status.toUpperCase()}: ${test.id}`;
+                    resultDetails.appendChild(item);
+                });
+        }
+        if (data.projects) {
+            data.projects.forEach(project => {
+                const li = document.createElement('li');
+                li.textContent = `${project.path}: ${project.status}` + (project.error ? ` (${project.error})` : '');
+                resultDetails.appendChild(li);
+            });
+        }
         resultDiv.classList.remove('hidden');
     }
 
@@ -168,6 +199,28 @@ function detectPythonVersion(repoUrl) {
         }
     });
 
+    function pollJob(jobId) {
+        return new Promise((resolve, reject) => {
+            const poll = () => {
+                fetch(`/jobs/${jobId}`)
+                    .then(response => response.json())
+                    .then(job => {
+                        if (job.error && !job.status) {
+                            reject(new Error(job.error));
+                        } else if (['finished', 'cancelled', 'failed'].includes(job.status)) {
+                            resolve(job);
+                        } else {
+                            const where = job.status === 'queued' ? 'waiting for a worker' : (job.stage || 'starting');
+                            loadingDiv.querySelector('p').textContent = `Setting up repository (${where})...`;
+                            setTimeout(poll, 2000);
+                        }
+                    })
+                    .catch(reject);
+            };
+            poll();
+        });
+    }
+
     form.addEventListener('submit', (event) => {
         console.log('Form submitted');
         event.preventDefault();
@@ -177,8 +230,11 @@ function detectPythonVersion(repoUrl) {
         }
 
         showLoading('Setting up repository...');
+        currentJobId = crypto.randomUUID();
+        cancelButton.classList.remove('hidden');
 
         const formData = new FormData(form);
+        formData.set('job_id', currentJobId);
         if (customPythonVersionInput.value.trim() !== '') {
             formData.set('python_version', customPythonVersionInput.value.trim());
         }
@@ -192,24 +248,46 @@ function detectPythonVersion(repoUrl) {
         })
         .then(response => {
             console.log('Setup response status:', response.status);
-            if (!response.ok) {
+            if (!response.ok && response.status !== 429) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
             return response.json();
         })
         .then(data => {
             console.log('Setup response:', data);
-            hideLoading();
             if (data.error) {
+                hideLoading();
+                cancelButton.classList.add('hidden');
                 showError(data.error);
-            } else {
-                showSuccess(data);
+                return;
             }
+            // The setup runs on a worker; follow it until it is done
+            return pollJob(data.job_id).then(job => {
+                hideLoading();
+                cancelButton.classList.add('hidden');
+                const result = job.result || {};
+                if (job.status === 'finished' && result.success) {
+                    showSuccess(result);
+                } else {
+                    showError(result.error || job.error || result.message || `Setup ${job.status}`);
+                }
+            });
         })
         .catch(error => {
             console.error('Error:', error);
             hideLoading();
+            cancelButton.classList.add('hidden');
             showError('An error occurred during setup. Please try again.');
         });
     });
+
+    cancelButton.addEventListener('click', () => {
+        if (!currentJobId) {
+            return;
+        }
+        console.log('Cancelling job:', currentJobId);
+        showLoading('Cancelling setup...');
+        fetch(`/jobs/${currentJobId}/cancel`, { method: 'POST' })
+            .catch(error => console.error('Error cancelling setup:', error));
+    });
 });
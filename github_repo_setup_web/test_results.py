@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import logging
+
+REPORT_NAME = 'setup-test-results.json'
+# Extra runs of the failing tests; a test that passes on a retry is reported as flaky, not failed
+TEST_RETRIES = int(os.getenv('SETUP_TEST_RETRIES', 0))
+
+STATUSES = ('passed', 'failed', 'error', 'skipped', 'expected_failure', 'unexpected_success', 'flaky')
+FAILING_STATUSES = ('failed', 'error', 'unexpected_success')
+
+def report_path(repo_path):
+    return os.path.join(repo_path, '.git', REPORT_NAME)
+
+def load_report(repo_path):
+    try:
+        with open(report_path(repo_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_report(repo_path, report):
+    path = report_path(repo_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # Only needed to re-run failures later; failing to write it must not fail the setup
+        logging.warning(f"Failed to write test report: {str(e)}")
+
+def failing_names(tests):
+    # What to re-run: one name per failing test, even when several of its subtests failed
+    return list(dict.fromkeys(test['name'] for test in tests if test['status'] in FAILING_STATUSES and test['name']))
+
+def merge_results(tests, rerun, retry):
+    # A re-run replaces the results of the tests it covered. Within one setup (a retry), passing now
+    # means the test is flaky; after a fix (re-running earlier failures), it simply passes and the
+    # results it did not cover are marked as reused from the earlier run.
+    attempts = {}
+    for test in tests:
+        attempts[test['name']] = max(attempts.get(test['name'], 0), test['attempts'])
+    rerun_names = {test['name'] for test in rerun}
+    merged = [test if retry else dict(test, reused=True) for test in tests if test['name'] not in rerun_names]
+    for test in rerun:
+        test = dict(test, attempts=attempts.get(test['name'], 0) + 1)
+        if retry and test['status'] == 'passed':
+            test['status'] = 'flaky'
+        merged.append(test)
+    return merged
+
+def new_report(tests, duration, retries=0, only_failed=False):
+    summary = {status: 0 for status in STATUSES}
+    for test in tests:
+        summary[test['status']] += 1
+    summary['total'] = len(tests)
+    summary['duration'] = duration
+    return {
+        'success': not any(test['status'] in FAILING_STATUSES for test in tests),
+        'summary': summary,
+        'tests': tests,
+        'retries': retries,
+        'only_failed': only_failed,
+        'created_at': time.time()
+    }
+
+def executed_tests(results):
+    # What this run actually executed, for the history; reused results were recorded by the run that made them
+    if not isinstance(results, dict):
+        return None
+    return [test for test in results['tests'] if not test.get('reused')]
+
+def tests_passed(results):
+    # None: no tests were run. Journals written before per-test reports hold a plain True.
+    if results is None or results is True:
+        return True
+    return bool(results) and results['success']
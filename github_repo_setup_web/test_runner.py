@@ -0,0 +1,96 @@
+# Runs a project's unittest suite inside its virtual environment and writes one JSON record per test
+# (status, duration, traceback), for run_tests_async. Standard library only, and no syntax newer than
+# Python 3.6, since it runs under whatever interpreter the project uses.
+#
+# Usage: python test_runner.py <report_path> <tests_dir> [<test name> ...]
+# With test names, only those are run; names are what a previous report lists as "name".
+import os
+import re
+import sys
+import json
+import time
+import unittest
+
+class CollectingResult(unittest.TextTestResult):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = []
+        self.started = {}
+
+    def startTest(self, test):
+        self.started[test.id()] = time.perf_counter()
+        super().startTest(test)
+
+    def record(self, test, status, err=None, name=None):
+        started = self.started.get(name or test.id())
+        self.records.append({
+            # Subtests keep their own id, e.g. "test_module.Case.test_x (i=1)"
+            'id': test.id() if name else rerun_name(test),
+            'name': name or rerun_name(test),
+            'status': status,
+            'duration': time.perf_counter() - started if started is not None else 0.0,
+            'attempts': 1,
+            'traceback': self._exc_info_to_string(err, test) if err else None
+        })
+
+    def addSuccess(self, test):
+        super().addSuccess(test)
+        self.record(test, 'passed')
+
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        self.record(test, 'failed', err)
+
+    def addError(self, test, err):
+        super().addError(test, err)
+        self.record(test, 'error', err)
+
+    def addSkip(self, test, reason):
+        super().addSkip(test, reason)
+        self.record(test, 'skipped')
+
+    def addExpectedFailure(self, test, err):
+        super().addExpectedFailure(test, err)
+        self.record(test, 'expected_failure')
+
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        self.record(test, 'unexpected_success')
+
+    def addSubTest(self, test, subtest, err):
+        super().addSubTest(test, subtest, err)
+        # A failing subtest fails its test, which is what gets re-run
+        if err is not None:
+            failed = issubclass(err[0], test.failureException)
+            self.record(subtest, 'failed' if failed else 'error', err, name=test.id())
+
+def rerun_name(test):
+    # Import failures and class/module fixture errors are not real tests; re-run what they stand for
+    kind = type(test).__name__
+    if kind == '_FailedTest':
+        return test._testMethodName
+    if kind == '_ErrorHolder':
+        match = re.search(r'\((.*)\)', test.description)
+        return match.group(1) if match else test.description
+    return test.id()
+
+def main():
+    report_path, tests_dir, names = sys.argv[1], os.path.abspath(sys.argv[2]), sys.argv[3:]
+    # Same import roots as "python -m unittest discover <tests_dir>" run from the project
+    sys.path[0] = os.getcwd()
+    loader = unittest.TestLoader()
+    if names:
+        sys.path.insert(0, tests_dir)
+        suite = loader.loadTestsFromNames(names)
+    else:
+        suite = loader.discover(tests_dir)
+
+    start = time.perf_counter()
+    result = unittest.TextTestRunner(resultclass=CollectingResult, verbosity=1).run(suite)
+    # Loader errors (e.g. an unknown name) surface as _FailedTest cases, so they are in the records too
+    with open(report_path, 'w') as f:
+        json.dump({'tests': result.records, 'duration': time.perf_counter() - start}, f)
+    sys.exit(0 if result.wasSuccessful() else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# A real worker process whose setups only sleep, for the queue tests.
+# Usage: python fake_worker.py <queue_url> <worker_id> <concurrency>
+#
+# Job repo_urls say what the setup does: "sleep:<seconds>" awaits, "block:<seconds>" blocks the event loop
+# (and with it the heartbeats) on the first attempt. Every start is recorded in $FAKE_WORKER_RUNS.
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker
+import scheduler
+from job_queue import open_queue
+
+async def fake_setup(repo_url, job_id=None, resume=False, **kwargs):
+    kind, seconds = repo_url.split(':')
+    with open(os.path.join(os.environ['FAKE_WORKER_RUNS'], f"{job_id}.{os.getpid()}"), 'a') as f:
+        f.write('started\n')
+    result = {'job_id': job_id, 'repo_url': repo_url, 'pid': os.getpid()}
+    try:
+        if kind == 'block' and not resume:
+            time.sleep(float(seconds))
+        else:
+            await asyncio.sleep(float(seconds))
+    except asyncio.CancelledError:
+        # Like run_setup, a cancelled setup still returns its result
+        return dict(result, success=False, status='cancelled', error='Setup cancelled')
+    return dict(result, success=True, status='success')
+
+worker.run_setup = fake_setup
+# Without this, admission would ask GitHub for the size of the repository
+worker.estimate_cost = lambda repo_url: dict(scheduler.DEFAULT_COST)
+
+if __name__ == '__main__':
+    worker.run_worker(open_queue(sys.argv[1]), sys.argv[2], int(sys.argv[3]))
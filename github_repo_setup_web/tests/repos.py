@@ -0,0 +1,28 @@
+import os
+import subprocess
+
+GIT_IDENTITY = ['-c', 'user.name=Setup Tests', '-c', 'user.email=setup-tests@example.com']
+
+def git(cwd, *args):
+    return subprocess.run(['git', '-c', 'protocol.file.allow=always'] + GIT_IDENTITY + list(args), cwd=cwd,
+                          check=True, capture_output=True, text=True).stdout.strip()
+
+def commit_files(work_path, files, message='Add files'):
+    if not os.path.isdir(os.path.join(work_path, '.git')):
+        os.makedirs(work_path, exist_ok=True)
+        git(work_path, 'init', '--quiet', '--initial-branch=main')
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(work_path, path)) or work_path, exist_ok=True)
+        with open(os.path.join(work_path, path), 'w') as f:
+            f.write(content)
+    git(work_path, 'add', '--all')
+    git(work_path, 'commit', '--quiet', '-m', message)
+    return git(work_path, 'rev-parse', 'HEAD')
+
+def make_bare_repo(root, name, files, allow_filter=True):
+    work_path = os.path.join(root, f"{name}-work")
+    commit_files(work_path, files)
+    bare_path = os.path.join(root, f"{name}.git")
+    git(root, 'clone', '--quiet', '--bare', work_path, bare_path)
+    git(bare_path, 'config', 'uploadpack.allowFilter', 'true' if allow_filter else 'false')
+    return bare_path
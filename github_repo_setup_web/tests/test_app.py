@@ -0,0 +1,77 @@
+import os
+import json
+import unittest
+from unittest import mock
+
+import app as app_module
+import webhooks
+from app import app
+from webhooks import sign
+
+PUSH_PAYLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads', 'push.json')
+SECRET = 'webhook-secret'
+
+class DetectVersionsTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def results(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_accepts_list_object_and_form(self):
+        for request in ({'json': ['not-a-url']}, {'json': {'repo_urls': ['not-a-url']}},
+                        {'data': {'repo_url': 'not-a-url'}}):
+            self.assertEqual(self.results(self.client.post('/detect_versions', **request)),
+                             [{'repo_url': 'not-a-url', 'success': False, 'error': 'Invalid GitHub URL'}])
+
+    def test_rejects_malformed_batches(self):
+        for payload in ([], {}, 5, {'repo_urls': 'not-a-list'}, [{}], {'repo_urls': [['nested']]},
+                        ['https://github.com/owner/a', None]):
+            with self.subTest(payload=payload):
+                self.assertEqual(self.client.post('/detect_versions', json=payload).status_code, 400)
+
+class GithubWebhookTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        with open(PUSH_PAYLOAD, 'rb') as f:
+            self.body = f.read()
+        for target, name, value in ((app_module, 'WEBHOOK_SECRET', SECRET), (webhooks, 'WEBHOOK_SECRET', SECRET),
+                                    (webhooks, 'WEBHOOK_REPOS', {'octo-org/octo-repo'})):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app_module, 'schedule_prewarm', return_value=1)
+        self.schedule_prewarm = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app_module, 'start_local_workers')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deliver(self, body, signature):
+        return self.client.post('/webhook/github', data=body, content_type='application/json',
+                                headers={'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'delivery',
+                                         'X-Hub-Signature-256': signature})
+
+    def test_replayed_push_with_valid_signature_schedules_a_prewarm(self):
+        response = self.deliver(self.body, sign(self.body, SECRET))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['commit'], '0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c')
+        push = self.schedule_prewarm.call_args.args[0]
+        self.assertEqual(push, {'full_name': 'octo-org/octo-repo', 'repo_url': 'https://github.com/octo-org/octo-repo',
+                                'branch': 'main', 'after': '0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c'})
+
+    def test_replayed_push_with_invalid_signature_is_refused(self):
+        for signature in ('', sign(self.body, 'another-secret'), sign(self.body + b' ', SECRET)):
+            with self.subTest(signature=signature):
+                self.assertEqual(self.deliver(self.body, signature).status_code, 401)
+        self.schedule_prewarm.assert_not_called()
+
+    def test_signed_payload_that_is_not_an_object_is_malformed(self):
+        for body in (b'[]', b'"push"', b'5', b'null', b'{"repository": "octo-org/octo-repo"}', b'not json'):
+            with self.subTest(body=body):
+                self.assertEqual(self.deliver(body, sign(body, SECRET)).status_code, 400)
+        self.schedule_prewarm.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+import history
+import process
+from pipeline import run_setup
+from github_repo_setup import setup_virtual_environment_async
+from job_queue import SqliteQueue, FINAL_STATUSES
+
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'worker.py')
+
+# Leaves half of its output behind, starts a child that ignores SIGTERM, then hangs. Anything
+# else goes to the real command, so `git --version` still works.
+HANGING_COMMAND = '''#!{python}
+import os, sys, time, subprocess
+args = sys.argv[1:]
+target = {partial_dir}
+if target is None:
+    os.execv({real}, [{real}] + args)
+os.makedirs(target, exist_ok=True)
+open(os.path.join(target, 'partial'), 'w').close()
+child = subprocess.Popen([sys.executable, '-c', 'import os, sys, time, signal\\n'
+                          'signal.signal(signal.SIGTERM, signal.SIG_IGN)\\n'
+                          'open(sys.argv[1], "a").write(f"{{os.getpid()}}\\\\n")\\n'
+                          'time.sleep(600)', os.environ['FAKE_PIDS']])
+with open(os.environ['FAKE_PIDS'], 'a') as f:
+    f.write(f"{{os.getpid()}}\\n")
+time.sleep(600)
+'''
+
+def is_alive(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    # Killed but not yet reaped by init
+    return state != 'Z'
+
+class HangingCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.bin = os.path.join(self.root, 'bin')
+        os.makedirs(self.bin)
+        self.pids = os.path.join(self.root, 'pids')
+        self.checkouts = os.path.join(self.root, 'checkouts')
+        # `git clone URL DEST` leaves DEST/.git behind; `python9.9 -m venv DEST` leaves DEST
+        self.write_command('git', "os.path.join(args[-1], '.git') if args[:1] == ['clone'] else None",
+                           shutil.which('git'))
+        self.write_command('python9.9', "args[-1]", sys.executable)
+        self.env = {'PATH': f"{self.bin}{os.pathsep}{os.environ['PATH']}", 'FAKE_PIDS': self.pids}
+        self.addCleanup(self.kill_leftovers)
+
+    def write_command(self, name, partial_dir, real):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write(HANGING_COMMAND.format(python=sys.executable, partial_dir=partial_dir, real=repr(real)))
+        os.chmod(path, 0o755)
+
+    def started_pids(self):
+        try:
+            with open(self.pids) as f:
+                return [int(line) for line in f.read().split()]
+        except FileNotFoundError:
+            return []
+
+    def kill_leftovers(self):
+        for pid in self.started_pids():
+            try:
+                os.kill(pid, 9)
+            except ProcessLookupError:
+                pass
+
+    def wait_for(self, predicate, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = predicate()
+            if value:
+                return value
+            time.sleep(0.05)
+        self.fail(f"Timed out after {timeout}s")
+
+    def assert_all_stopped(self):
+        pids = self.started_pids()
+        # The command and its SIGTERM-ignoring child
+        self.assertEqual(len(pids), 2)
+        self.wait_for(lambda: not any(is_alive(pid) for pid in pids), timeout=5)
+
+    def test_stage_timeout_kills_the_process_group_and_removes_the_half_clone(self):
+        with mock.patch.dict(os.environ, self.env), mock.patch.object(process, 'KILL_GRACE_PERIOD', 0.5), \
+                mock.patch.object(history, 'HISTORY_DB', os.path.join(self.root, 'history.db')):
+            started = time.monotonic()
+            result = asyncio.run(run_setup(os.path.join(self.root, 'hang.git'), self.checkouts,
+                                           timeouts={'clone': 2}))
+        self.assertEqual(result['status'], 'timed_out')
+        self.assertLess(time.monotonic() - started, 15)
+        self.assert_all_stopped()
+        self.assertFalse(os.path.exists(os.path.join(self.checkouts, 'hang')))
+
+    def test_cancelled_venv_is_removed(self):
+        repo_path = os.path.join(self.root, 'repo')
+        os.makedirs(repo_path)
+        venv_path = os.path.join(repo_path, 'venv')
+
+        async def cancel_when_started():
+            task = asyncio.create_task(setup_virtual_environment_async(repo_path, '9.9'))
+            while len(self.started_pids()) < 2:
+                await asyncio.sleep(0.05)
+            task.cancel()
+            await task
+
+        with mock.patch.dict(os.environ, self.env), mock.patch.object(process, 'KILL_GRACE_PERIOD', 0.5):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(cancel_when_started())
+        self.assert_all_stopped()
+        self.assertFalse(os.path.exists(venv_path))
+
+    def test_cancel_through_the_queue(self):
+        queue_path = os.path.join(self.root, 'jobs.db')
+        queue = SqliteQueue(queue_path)
+        env = dict(os.environ, **self.env, SETUP_KILL_GRACE_PERIOD='0.5', SETUP_HEARTBEAT_INTERVAL='0.3',
+                   SETUP_POLL_INTERVAL='0.1', SETUP_CPU_BUDGET='8',
+                   SETUP_HISTORY_DB=os.path.join(self.root, 'history.db'),
+                   SETUP_PROFILE_DIR=os.path.join(self.root, 'profiles'))
+        worker = subprocess.Popen([sys.executable, WORKER, '--queue', f"sqlite:///{queue_path}", '--id', 'worker'],
+                                  cwd=self.root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(lambda: worker.poll() is None and (worker.kill(), worker.wait()))
+
+        job_id = queue.enqueue({'repo_url': os.path.join(self.root, 'hang.git'),
+                                'custom_path': self.checkouts})['job_id']
+        self.wait_for(lambda: len(self.started_pids()) == 2)
+        queue.cancel(job_id)
+        self.wait_for(lambda: queue.get(job_id)['status'] in FINAL_STATUSES)
+        job = queue.get(job_id)
+        self.assertEqual(job['status'], 'cancelled')
+        self.assert_all_stopped()
+        self.assertFalse(os.path.exists(os.path.join(self.checkouts, 'hang')))
+
+if __name__ == '__main__':
+    unittest.main()
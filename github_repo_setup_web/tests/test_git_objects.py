@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import git_objects
+import version_inference
+from github_repo_setup import detect_remote_python_version
+from tests.repos import git, make_bare_repo
+
+FILES = {
+    '.python-version': '3.10\n',
+    'README.md': 'Not read\n',
+    'pkg/__init__.py': '',
+    'pkg/walrus.py': 'if (n := 1):\n    pass\n',
+}
+
+def missing_objects(git_dir, commit):
+    output = git(git_dir, f"--git-dir={git_dir}", 'rev-list', '--objects', '--missing=print', commit)
+    return {line[1:] for line in output.splitlines() if line.startswith('?')}
+
+class ReadFilesTests(unittest.TestCase):
+    allow_filter = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        cache = mock.patch.object(version_inference, 'INFERENCE_CACHE', f"{self.root}/inference.db")
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    def make_repo(self, files=FILES):
+        return make_bare_repo(self.root, 'origin', files, allow_filter=self.allow_filter)
+
+    def test_reads_wanted_files_only(self):
+        repo = self.make_repo()
+        commit, tree, contents = git_objects.read_files(repo, lambda paths: ['.python-version', 'pkg/walrus.py'])
+        self.assertEqual(commit, git(repo, 'rev-parse', 'HEAD'))
+        self.assertEqual(sorted(tree), sorted(FILES))
+        self.assertEqual(contents, {'.python-version': b'3.10\n', 'pkg/walrus.py': FILES['pkg/walrus.py'].encode()})
+
+    def test_ignores_paths_missing_from_tree(self):
+        _, _, contents = git_objects.read_files(self.make_repo(), lambda paths: ['setup.py', 'README.md'])
+        self.assertEqual(contents, {'README.md': b'Not read\n'})
+
+    def test_fetches_blobs_only_when_filtered(self):
+        repo = self.make_repo()
+        readme = git(repo, 'rev-parse', 'HEAD:README.md')
+        with git_objects.fetched_tip(repo) as (git_dir, commit):
+            # Servers without uploadpack.allowFilter ignore the filter and send every blob
+            self.assertEqual(readme in missing_objects(git_dir, commit), self.allow_filter)
+
+    def test_detects_version_file(self):
+        self.assertEqual(detect_remote_python_version(self.make_repo()), '3.10')
+
+    def test_infers_version_from_sources(self):
+        files = {path: content for path, content in FILES.items() if path != '.python-version'}
+        self.assertEqual(detect_remote_python_version(self.make_repo(files)), '3.8')
+
+    def test_missing_repository(self):
+        self.assertIsNone(detect_remote_python_version(f"{self.root}/missing.git"))
+
+class ReadFilesWithoutFilterTests(ReadFilesTests):
+    allow_filter = False
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import history
+from history import record_setup, export_setup, import_setup, connect
+from github_repo_setup import timed_stage
+
+class RecordSetupTests(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.db_path = f"{root}/history.db"
+
+    def stage_starts(self, setup_id, db_path=None):
+        conn = connect(db_path or self.db_path)
+        try:
+            return {row['stage']: row['started_at'] for row in
+                    conn.execute("SELECT stage, started_at FROM stage_runs WHERE setup_id = ?", (setup_id,))}
+        finally:
+            conn.close()
+
+    def test_stages_keep_their_own_start(self):
+        started_at = time.time()
+        stages, usage = {}, {}
+        for stage in ('clone', 'venv'):
+            with timed_stage(stages, stage, usage):
+                time.sleep(0.05)
+        setup_id = record_setup('https://github.com/owner/repo', 'success', stages, started_at, job_id='job',
+                                usage=usage, db_path=self.db_path)
+        starts = self.stage_starts(setup_id)
+        self.assertGreaterEqual(starts['clone'], started_at)
+        self.assertGreaterEqual(starts['venv'], starts['clone'] + stages['clone'])
+        self.assertEqual(starts, {stage: usage[stage]['started_at'] for stage in stages})
+
+        # Stage starts survive a copy to another host's history
+        other_db = self.db_path.replace('history.db', 'other.db')
+        self.assertEqual(self.stage_starts(import_setup(export_setup('job', self.db_path), other_db), other_db),
+                         starts)
+
+    def test_stages_without_a_start_use_the_setup_start(self):
+        setup_id = record_setup('https://github.com/owner/repo', 'success', {'clone': 1.0}, 1000.0,
+                                finished_at=1001.0, db_path=self.db_path)
+        self.assertEqual(self.stage_starts(setup_id), {'clone': 1000.0})
+
+    def test_connection_is_closed_on_error(self):
+        conn = connect(self.db_path)
+        with mock.patch.object(history, 'connect', return_value=conn):
+            # A stage without a duration violates NOT NULL
+            self.assertIsNone(record_setup('https://github.com/owner/repo', 'success', {'clone': None},
+                                           time.time(), db_path=self.db_path))
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lockfiles import manifest_fingerprint
+
+class ManifestFingerprintTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.repo_path, ignore_errors=True)
+        self.write('requirements.txt', '-r requirements/base.txt\n--constraint=constraints.txt\nrequests\n')
+        self.write('requirements/base.txt', '-rcommon.txt\nflask==3.0.0\n')
+        self.write('requirements/common.txt', '-r base.txt\nclick==8.1.7\n')
+        self.write('constraints.txt', 'urllib3<3\n')
+
+    def write(self, name, content):
+        path = os.path.join(self.repo_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def fingerprint(self):
+        return manifest_fingerprint(self.repo_path, '3.11')
+
+    def test_nested_files_are_hashed_at_any_depth(self):
+        for name, content in (('requirements/common.txt', '-r base.txt\nclick==8.1.8\n'),
+                              ('constraints.txt', 'urllib3<2\n')):
+            with self.subTest(name=name):
+                before = self.fingerprint()
+                self.write(name, content)
+                self.assertNotEqual(self.fingerprint(), before)
+
+    def test_unrelated_files_are_not_hashed(self):
+        before = self.fingerprint()
+        self.write('requirements/docs.txt', 'sphinx\n')
+        self.assertEqual(self.fingerprint(), before)
+
+    def test_missing_nested_file(self):
+        os.remove(os.path.join(self.repo_path, 'constraints.txt'))
+        before = self.fingerprint()
+        self.assertEqual(self.fingerprint(), before)
+        self.write('constraints.txt', 'urllib3<3\n')
+        self.assertNotEqual(self.fingerprint(), before)
+
+if __name__ == '__main__':
+    unittest.main()
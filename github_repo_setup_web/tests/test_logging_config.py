@@ -0,0 +1,82 @@
+import os
+import json
+import queue
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest import mock
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+
+import logging_config
+from logging_config import DroppingQueueHandler, JsonFormatter, build_file_handler, should_log_payload
+
+class QueuedExceptionTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.logger = logging.getLogger('tests.logging_config')
+        self.logger.propagate = False
+        handler = DroppingQueueHandler(self.queue)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def log_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception("Failed with %s", 'context')
+        return self.queue.get_nowait()
+
+    def test_json_keeps_traceback_separate(self):
+        entry = json.loads(JsonFormatter().format(self.log_exception()))
+        self.assertEqual(entry['message'], 'Failed with context')
+        self.assertIn('Traceback', entry['exception'])
+        self.assertIn('ValueError: boom', entry['exception'])
+
+    def test_text_format_still_shows_traceback(self):
+        text = logging.Formatter('%(levelname)s - %(message)s').format(self.log_exception())
+        self.assertTrue(text.startswith('ERROR - Failed with context\nTraceback'))
+        self.assertEqual(text.count('ValueError: boom'), 1)
+
+    def test_records_without_exception(self):
+        self.logger.warning("plain %d", 1)
+        entry = json.loads(JsonFormatter().format(self.queue.get_nowait()))
+        self.assertEqual(entry['message'], 'plain 1')
+        self.assertNotIn('exception', entry)
+
+class FileHandlerTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def handler(self, rotation, name='app.log'):
+        with mock.patch.object(logging_config, 'LOG_ROTATION', rotation):
+            handler = build_file_handler(os.path.join(self.root, name))
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_pid_in_the_path(self):
+        handler = self.handler('size', 'worker-{pid}.log')
+        self.assertIsInstance(handler, RotatingFileHandler)
+        self.assertEqual(handler.baseFilename, os.path.join(self.root, f"worker-{os.getpid()}.log"))
+
+    def test_external_rotation_reopens_a_moved_file(self):
+        handler = self.handler('external')
+        self.assertIsInstance(handler, WatchedFileHandler)
+        logger = logging.getLogger('tests.logging_config.external')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning("before")
+        os.rename(handler.baseFilename, f"{handler.baseFilename}.1")
+        logger.warning("after")
+        with open(handler.baseFilename) as f:
+            self.assertEqual([json.loads(line)['message'] for line in f], ['after'])
+
+    @unittest.skipIf('LOG_PAYLOAD_SAMPLING' in os.environ, "sampling is configured by the environment")
+    def test_payloads_are_not_logged_by_default(self):
+        for endpoint in ('setup', 'resume', 'detect_version'):
+            self.assertFalse(should_log_payload(endpoint))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import history
+from pipeline import run_setup
+from tests.repos import git, commit_files, make_bare_repo
+
+class ReusedCheckoutTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.origin = make_bare_repo(self.root, 'project', {'main.py': 'print("one")\n'})
+        self.checkouts = os.path.join(self.root, 'checkouts')
+        self.checkout = os.path.join(self.checkouts, 'project')
+        patcher = mock.patch.object(history, 'HISTORY_DB', os.path.join(self.root, 'history.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def setup(self, **kwargs):
+        # Only the checkout matters here, not the environment
+        with mock.patch('pipeline.setup_virtual_environment_async', side_effect=RuntimeError('no venv')):
+            return asyncio.run(run_setup(self.origin, self.checkouts, python_version='3.11', **kwargs))
+
+    def push(self):
+        work_path = os.path.join(self.root, 'project-work')
+        commit = commit_files(work_path, {'main.py': 'print("two")\n'}, 'Second commit')
+        git(work_path, 'push', '--quiet', self.origin, 'HEAD:main')
+        return commit
+
+    def test_plain_setup_fast_forwards_a_reused_checkout(self):
+        first = self.setup()
+        self.assertIn('clone', first['stage_durations'])
+        commit = self.push()
+        second = self.setup()
+        self.assertIn('clone', second['skipped_stages'])
+        self.assertIn('update', second['stage_durations'])
+        self.assertEqual(git(self.checkout, 'rev-parse', 'HEAD'), commit)
+
+    def test_resume_keeps_the_commit(self):
+        self.setup()
+        before = git(self.checkout, 'rev-parse', 'HEAD')
+        self.push()
+        result = self.setup(resume=True)
+        self.assertNotIn('update', result['stage_durations'])
+        self.assertEqual(git(self.checkout, 'rev-parse', 'HEAD'), before)
+
+    def test_checkout_that_cannot_fast_forward_fails(self):
+        self.setup()
+        commit_files(self.checkout, {'local.py': 'pass\n'}, 'Local commit')
+        self.push()
+        result = self.setup()
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('Failed to update', result['error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from snapshots import export_snapshot, restore_snapshot, fix_up_paths
+from github_repo_setup import setup_git_hooks
+from journal import new_journal, record_stage, load_journal, completed_stage, journal_path
+from tests.repos import commit_files
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.repo_path = os.path.join(self.root, 'builds', 'project')
+        commit_files(self.repo_path, {'main.py': 'print("hello")\n', '.gitignore': 'venv/\n'})
+        self.venv_path = os.path.join(self.repo_path, 'venv')
+        subprocess.run([sys.executable, '-m', 'venv', '--without-pip', self.venv_path], check=True)
+
+    def test_restore_relocates_the_hook_and_the_journal(self):
+        setup_git_hooks(self.repo_path, self.venv_path)
+        journal = new_journal(self.repo_path, 'https://github.com/owner/project')
+        record_stage(journal, 'clone', 'clone-fingerprint', self.repo_path, [os.path.join(self.repo_path, '.git')])
+        record_stage(journal, 'venv', 'venv-fingerprint', self.venv_path, [self.venv_path])
+
+        _, digest = export_snapshot(self.repo_path, output_dir=os.path.join(self.root, 'snapshots'))
+        target = os.path.join(self.root, 'restored', 'project')
+        restore_snapshot(os.path.join(self.root, 'snapshots', f"{digest}.tar.gz"), target)
+
+        with open(os.path.join(target, '.git', 'hooks', 'pre-commit')) as f:
+            hook = f.read()
+        self.assertIn(f'PYTHON="{os.path.join(target, "venv", "bin", "python")}"', hook)
+        self.assertNotIn(self.repo_path, hook)
+
+        restored = load_journal(target, 'https://github.com/owner/project')
+        self.assertEqual(restored['stages']['clone']['result'], target)
+        self.assertEqual(restored['stages']['venv']['artifacts'], [os.path.join(target, 'venv')])
+        shutil.rmtree(self.repo_path)
+        self.assertTrue(completed_stage(restored, 'venv', 'venv-fingerprint'))
+
+        output = subprocess.run([os.path.join(target, 'venv', 'bin', 'python'), '-c', 'import sys; print(sys.prefix)'],
+                                check=True, capture_output=True, text=True).stdout.strip()
+        self.assertEqual(output, os.path.join(target, 'venv'))
+
+    def test_only_whole_paths_are_rewritten(self):
+        sibling = f"{self.repo_path}2"
+        with open(os.path.join(self.venv_path, 'bin', 'activate'), 'a') as f:
+            f.write(f'\nSIBLING="{sibling}/venv"\nNESTED="/mirror{self.repo_path}"\n')
+        journal = new_journal(self.repo_path, 'https://github.com/owner/project')
+        record_stage(journal, 'clone', 'clone-fingerprint', self.repo_path, [f"{sibling}/.git"])
+
+        fix_up_paths(self.repo_path, self.repo_path, '/srv/project', 'venv')
+        with open(os.path.join(self.venv_path, 'bin', 'activate')) as f:
+            activate = f.read()
+        self.assertIn('/srv/project/venv', activate)
+        self.assertIn(f'SIBLING="{sibling}/venv"', activate)
+        self.assertIn(f'NESTED="/mirror{self.repo_path}"', activate)
+        with open(journal_path(self.repo_path)) as f:
+            stages = json.load(f)['stages']
+        self.assertEqual(stages['clone']['result'], '/srv/project')
+        self.assertEqual(stages['clone']['artifacts'], [f"{sibling}/.git"])
+
+if __name__ == '__main__':
+    unittest.main()
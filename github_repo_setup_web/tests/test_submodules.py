@@ -0,0 +1,139 @@
+import os
+import shlex
+import shutil
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import github_repo_setup
+from github_repo_setup import (
+    clone_options_with_defaults,
+    skips_lfs_smudge,
+    fetch_submodules_async,
+    fetch_lfs_objects_async
+)
+from tests.repos import git, commit_files, make_bare_repo
+
+# Protocol v2 serves any object by id; v0 lets a server refuse commits that are not a branch tip
+PROTOCOL_V0 = {'GIT_CONFIG_COUNT': '1', 'GIT_CONFIG_KEY_0': 'protocol.version', 'GIT_CONFIG_VALUE_0': '0'}
+
+class SubmoduleTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.submodule = make_bare_repo(self.root, 'lib', {'lib.py': 'VALUE = 1\n'})
+        self.recorded = git(self.submodule, 'rev-parse', 'HEAD')
+        self.superproject = os.path.join(self.root, 'app-work')
+        commit_files(self.superproject, {'main.py': 'import lib\n'})
+        # file:// rather than a path: local clones ignore --depth
+        git(self.superproject, 'submodule', 'add', '--quiet', f"file://{self.submodule}", 'lib')
+        git(self.superproject, 'commit', '--quiet', '-m', 'Add submodule')
+
+    def clone(self):
+        clone_path = os.path.join(self.root, 'app')
+        git(self.root, 'clone', '--quiet', self.superproject, clone_path)
+        return clone_path
+
+    def advance_submodule(self):
+        work_path = os.path.join(self.root, 'lib-work')
+        commit_files(work_path, {'other.py': ''}, 'Move the tip past the recorded commit')
+        git(work_path, 'push', '--quiet', self.submodule, 'main')
+
+    def assert_checked_out(self, clone_path, shallow):
+        self.assertEqual(git(os.path.join(clone_path, 'lib'), 'rev-parse', 'HEAD'), self.recorded)
+        self.assertEqual(git(os.path.join(clone_path, 'lib'), 'rev-parse', '--is-shallow-repository'),
+                         'true' if shallow else 'false')
+
+    def test_shallow(self):
+        clone_path = self.clone()
+        self.assertTrue(asyncio.run(fetch_submodules_async(clone_path, self.superproject)))
+        self.assert_checked_out(clone_path, shallow=True)
+
+    def test_full_history(self):
+        clone_path = self.clone()
+        self.assertTrue(asyncio.run(fetch_submodules_async(clone_path, self.superproject,
+                                                           {'shallow_submodules': False})))
+        self.assert_checked_out(clone_path, shallow=False)
+
+    def test_falls_back_to_full_history(self):
+        self.advance_submodule()
+        git(self.submodule, 'config', 'uploadpack.allowReachableSHA1InWant', 'false')
+        clone_path = self.clone()
+        with mock.patch.dict(os.environ, PROTOCOL_V0):
+            self.assertTrue(asyncio.run(fetch_submodules_async(clone_path, self.superproject)))
+        self.assert_checked_out(clone_path, shallow=False)
+
+    def test_disabled(self):
+        clone_path = self.clone()
+        self.assertFalse(asyncio.run(fetch_submodules_async(clone_path, self.superproject, {'submodules': False})))
+        self.assertEqual(os.listdir(os.path.join(clone_path, 'lib')), [])
+
+    def test_without_submodules(self):
+        clone_path = os.path.join(self.root, 'lib-clone')
+        git(self.root, 'clone', '--quiet', self.submodule, clone_path)
+        self.assertFalse(asyncio.run(fetch_submodules_async(clone_path, self.submodule)))
+
+class LfsOptionTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.repo_path, ignore_errors=True)
+        with open(os.path.join(self.repo_path, '.gitattributes'), 'w') as f:
+            f.write('*.bin filter=lfs diff=lfs merge=lfs -text\n')
+        self.commands = []
+        async def run_command(args, **kwargs):
+            self.commands.append(args)
+        patcher = mock.patch.object(github_repo_setup, 'run_command', run_command)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, options, lfs_installed=True):
+        with mock.patch.object(github_repo_setup.shutil, 'which', return_value='/usr/bin/git-lfs' if lfs_installed else None):
+            return asyncio.run(fetch_lfs_objects_async(self.repo_path, dict(options, submodules=False)))
+
+    def test_rejects_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            clone_options_with_defaults({'lfs': 'lazy'})
+
+    def test_unset_options_keep_defaults(self):
+        self.assertEqual(clone_options_with_defaults({'lfs': None})['lfs'],
+                         github_repo_setup.DEFAULT_CLONE_OPTIONS['lfs'])
+
+    def test_smudge(self):
+        self.assertFalse(skips_lfs_smudge(clone_options_with_defaults({'lfs': 'fetch', 'lfs_include': []})))
+        self.assertTrue(skips_lfs_smudge(clone_options_with_defaults({'lfs': 'fetch', 'lfs_include': ['*.bin']})))
+        self.assertTrue(skips_lfs_smudge(clone_options_with_defaults({'lfs': 'skip'})))
+        self.assertTrue(skips_lfs_smudge(clone_options_with_defaults({'lfs': 'defer'})))
+
+    def test_skip(self):
+        self.assertFalse(self.fetch({'lfs': 'skip'}))
+        self.assertEqual(self.commands, [])
+
+    def test_fetch_smudges_during_checkout(self):
+        self.assertFalse(self.fetch({'lfs': 'fetch', 'lfs_include': []}))
+        self.assertEqual(self.commands, [])
+
+    def test_defer(self):
+        self.assertTrue(self.fetch({'lfs': 'defer', 'lfs_include': []}))
+        self.assertEqual(self.commands, [['git', 'lfs', 'pull']])
+
+    def test_defer_without_git_lfs(self):
+        self.assertFalse(self.fetch({'lfs': 'defer'}, lfs_installed=False))
+        self.assertEqual(self.commands, [])
+
+    def test_include_patterns_reach_submodules_quoted(self):
+        with open(os.path.join(self.repo_path, '.gitmodules'), 'w') as f:
+            f.write('')
+        include = ['*.bin', 'data/$(touch pwned)']
+        with mock.patch.object(github_repo_setup.shutil, 'which', return_value='/usr/bin/git-lfs'):
+            self.assertTrue(asyncio.run(fetch_lfs_objects_async(self.repo_path, {'lfs': 'defer', 'lfs_include': include,
+                                                                                 'submodules': True})))
+        pull = ['git', 'lfs', 'pull', '--include', ','.join(include)]
+        self.assertEqual(self.commands, [pull, ['git', 'submodule', 'foreach', '--recursive', shlex.join(pull)]])
+
+    def test_not_an_lfs_repository(self):
+        os.remove(os.path.join(self.repo_path, '.gitattributes'))
+        self.assertFalse(self.fetch({'lfs': 'defer'}))
+
+if __name__ == '__main__':
+    unittest.main()
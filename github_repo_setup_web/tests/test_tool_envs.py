@@ -0,0 +1,109 @@
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+import github_repo_setup
+from github_repo_setup import install_project
+
+# A minimal build backend, published to the wheelhouse as the "tiny-backend" wheel it can itself write.
+# TINY_BACKEND_REQUIRES stands in for a backend that asks for more than its declared requirements.
+TINY_BACKEND = '''import os
+import zipfile
+
+def write_wheel(directory, name, version, files):
+    dist = name.replace('-', '_')
+    info = f"{dist}-{version}.dist-info"
+    files = dict(files)
+    files[f"{info}/METADATA"] = f"Metadata-Version: 2.1\\nName: {name}\\nVersion: {version}\\n"
+    files[f"{info}/WHEEL"] = "Wheel-Version: 1.0\\nGenerator: tiny-backend\\nRoot-Is-Purelib: true\\nTag: py3-none-any\\n"
+    record = f"{info}/RECORD"
+    files[record] = ''.join(f"{path},,\\n" for path in list(files) + [record])
+    filename = f"{dist}-{version}-py3-none-any.whl"
+    with zipfile.ZipFile(os.path.join(directory, filename), 'w') as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+    return filename
+
+def get_requires_for_build_wheel(config_settings=None):
+    return os.environ.get('TINY_BACKEND_REQUIRES', '').split()
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    with open('offline_project.py') as f:
+        return write_wheel(wheel_directory, 'offline-project', '1.0', {'offline_project.py': f.read()})
+'''
+
+PYPROJECT = '''[build-system]
+requires = ["tiny-backend"]
+build-backend = "tiny_backend"
+'''
+
+UNREACHABLE_INDEX = 'http://127.0.0.1:9/simple'
+
+class WheelhouseBuildTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp(prefix='setup-tests-')
+        cls.venv_path = os.path.join(cls.root, 'venv')
+        subprocess.run([sys.executable, '-m', 'venv', cls.venv_path], check=True)
+        cls.wheelhouse = os.path.join(cls.root, 'wheelhouse')
+        os.makedirs(cls.wheelhouse)
+        backend = {}
+        exec(TINY_BACKEND, backend)
+        backend['write_wheel'](cls.wheelhouse, 'tiny-backend', '1.0', {'tiny_backend.py': TINY_BACKEND})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root, ignore_errors=True)
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp(prefix='project-', dir=self.root)
+        with open(os.path.join(self.repo_path, 'pyproject.toml'), 'w') as f:
+            f.write(PYPROJECT)
+        with open(os.path.join(self.repo_path, 'offline_project.py'), 'w') as f:
+            f.write('VALUE = 1\n')
+        # The backend is prefetched; no index can be reached
+        for patcher in (mock.patch.object(github_repo_setup, 'prefetch_build_backend', return_value=self.wheelhouse),
+                        mock.patch.dict(os.environ, PIP_INDEX_URL=UNREACHABLE_INDEX,
+                                        PIP_EXTRA_INDEX_URL=UNREACHABLE_INDEX, PIP_RETRIES='0', PIP_TIMEOUT='1',
+                                        PIP_DISABLE_PIP_VERSION_CHECK='1', PIP_NO_CACHE_DIR='1')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.commands = []
+        run_command = github_repo_setup.run_command
+
+        async def recording_run_command(args, **kwargs):
+            self.commands.append(args)
+            return await run_command(args, **kwargs)
+        patcher = mock.patch.object(github_repo_setup, 'run_command', recording_run_command)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(subprocess.run, [os.path.join(self.venv_path, 'bin', 'pip'), 'uninstall', '--yes',
+                                         '--quiet', 'offline-project'], capture_output=True)
+
+    def installed(self):
+        return subprocess.run([os.path.join(self.venv_path, 'bin', 'python'), '-c', 'import offline_project'],
+                              cwd=self.root).returncode == 0
+
+    def test_builds_from_the_wheelhouse_without_the_index(self):
+        asyncio.run(install_project(self.venv_path, self.repo_path, 'pip'))
+        self.assertTrue(self.installed())
+        self.assertEqual(len(self.commands), 2)
+        self.assertIn('--no-index', self.commands[0])
+        self.assertTrue(self.commands[1][-1].endswith('offline_project-1.0-py3-none-any.whl'))
+
+    def test_falls_back_to_the_index_when_the_wheelhouse_is_not_enough(self):
+        with mock.patch.dict(os.environ, TINY_BACKEND_REQUIRES='not-in-the-wheelhouse'):
+            with self.assertRaises(subprocess.CalledProcessError):
+                # The fallback build needs the index, which is unreachable here
+                asyncio.run(install_project(self.venv_path, self.repo_path, 'pip'))
+        self.assertIn('--no-index', self.commands[0])
+        self.assertEqual(self.commands[1][-2:], ['install', '.'])
+        self.assertFalse(self.installed())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+import github_repo_setup
+import version_inference
+from version_inference import infer_minimum_version, analyze_source
+
+SOURCES = {
+    'walrus.py': b'if (n := 1):\n    pass\n',
+    'match.py': b'match x:\n    case 1:\n        pass\n',
+    'py2.py': b'print "not python 3"\n',
+}
+
+class InferenceCacheTests(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.cache_path = f"{root}/inference.db"
+        for patcher in (mock.patch.object(version_inference, 'INFERENCE_CACHE', self.cache_path),
+                        mock.patch.object(version_inference, 'PARALLEL_THRESHOLD', 10 ** 6)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def cached_count(self):
+        conn = sqlite3.connect(self.cache_path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM file_results").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_infers_from_sources(self):
+        version, reasons = infer_minimum_version(SOURCES)
+        self.assertEqual(version, '3.10')
+        self.assertTrue(any('match.py:1' in reason for reason in reasons))
+
+    def test_cached_files_are_not_parsed_again(self):
+        first = infer_minimum_version(SOURCES)
+        with mock.patch.object(version_inference, 'analyze_source', side_effect=AssertionError) as analyze:
+            self.assertEqual(infer_minimum_version(SOURCES), first)
+        analyze.assert_not_called()
+        # Unparseable files are cached too
+        self.assertEqual(self.cached_count(), len(SOURCES))
+
+    def test_only_changed_files_are_parsed(self):
+        infer_minimum_version(SOURCES)
+        with mock.patch.object(version_inference, 'analyze_source', wraps=version_inference.analyze_source) as analyze:
+            infer_minimum_version(dict(SOURCES, **{'walrus.py': b'x = 1\n'}))
+        analyze.assert_called_once_with(b'x = 1\n')
+
+    def test_size_is_bounded(self):
+        with mock.patch.object(version_inference, 'INFERENCE_CACHE_ENTRIES', 5):
+            for i in range(4):
+                infer_minimum_version({f"module_{i}_{j}.py": f"x = {i}_{j}\n".encode() for j in range(3)})
+            self.assertEqual(self.cached_count(), 5)
+            # The most recent batch survives
+            with mock.patch.object(version_inference, 'analyze_source', side_effect=AssertionError):
+                infer_minimum_version({f"module_3_{j}.py": f"x = 3_{j}\n".encode() for j in range(3)})
+
+    def test_results_of_other_analyzer_versions_are_dropped(self):
+        infer_minimum_version(SOURCES)
+        version_inference._initialized.discard(self.cache_path)
+        with mock.patch.object(version_inference, 'ANALYZER_VERSION', version_inference.ANALYZER_VERSION + 1):
+            version_inference.connect_cache().close()
+        self.assertEqual(self.cached_count(), 0)
+
+    def test_concurrent_inference(self):
+        batches = [{f"module_{i}.py": f"x = {i}\n".encode(), **SOURCES} for i in range(8)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            versions = list(executor.map(infer_minimum_version, batches))
+        self.assertEqual([version for version, _ in versions], ['3.10'] * 8)
+        self.assertEqual(self.cached_count(), len(SOURCES) + 8)
+
+    def test_unavailable_cache(self):
+        with mock.patch.object(version_inference, 'INFERENCE_CACHE', '/dev/null/inference.db'):
+            self.assertEqual(infer_minimum_version(SOURCES)[0], '3.10')
+
+class AnalyzeSourceTests(unittest.TestCase):
+    def features(self, source):
+        return {feature: (major, minor) for major, minor, feature, _ in analyze_source(source.encode())}
+
+    def test_python2_sources_are_not_evidence(self):
+        for source in ('print "hello"\n', 'try:\n    pass\nexcept ValueError, e:\n    pass\n', 'mode = 0755\n'):
+            with self.subTest(source=source):
+                self.assertIsNone(analyze_source(source.encode()))
+
+    @unittest.skipIf(sys.version_info >= (3, 12), "the host parses type statements")
+    def test_syntax_newer_than_the_host(self):
+        [[major, minor, feature, lineno]] = analyze_source(b'x = 1\ntype Point = tuple[float, float]\n')
+        self.assertEqual((major, minor), (sys.version_info.major, sys.version_info.minor + 1))
+        self.assertIn('syntax newer than Python', feature)
+        self.assertEqual(lineno, 2)
+
+    def test_unions_outside_annotations(self):
+        for source in ('IntOrStr = int | str\n', 'Pair = tuple[int, int] | None\n', 'y = cast(str | None, x)\n',
+                       'T = TypeVar("T", bound=Sequence | bytes)\n', 'def f(kind=int | None): pass\n'):
+            with self.subTest(source=source):
+                self.assertEqual(self.features(source).get('X | Y union type'), (3, 10))
+
+    def test_bitwise_or_is_not_a_union(self):
+        for source in ('flags = READ | WRITE\n', 'x = a | b | 4\n', 'merged = left | right\n'):
+            with self.subTest(source=source):
+                self.assertNotIn('X | Y union type', self.features(source))
+
+    def test_postponed_annotations_are_not_evaluated(self):
+        features = self.features('from __future__ import annotations\n'
+                                 'def f(x: int | None) -> list[int] | None: pass\n'
+                                 'y: str | None = None\n')
+        self.assertNotIn('X | Y union type', features)
+
+class LocalInferenceTests(unittest.TestCase):
+    def test_file_limit_applies_before_reading(self):
+        root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        for name, source in (('a.py', 'x = 1\n'), ('b.py', 'y = 2\n'), ('c.py', 'match x:\n    case 1: pass\n')):
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(source)
+        with mock.patch.object(version_inference, 'INFERENCE_CACHE', os.path.join(root, 'inference.db')), \
+                mock.patch.object(github_repo_setup, 'INFERENCE_MAX_FILES', 2), \
+                mock.patch.object(version_inference, 'INFERENCE_MAX_FILES', 2), \
+                mock.patch('builtins.open', wraps=open) as opened:
+            self.assertEqual(github_repo_setup.detect_local_python_version(root), version_inference.MIN_SUPPORTED_VERSION)
+        read = {os.path.basename(call.args[0]) for call in opened.call_args_list}
+        self.assertIn('a.py', read)
+        self.assertNotIn('c.py', read)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import unittest
+
+from job_queue import SqliteQueue, FINAL_STATUSES
+
+FAKE_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_worker.py')
+LEASE_SECONDS = 1.5
+MAX_ATTEMPTS = 2
+
+class WorkerProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='setup-tests-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.runs = os.path.join(self.root, 'runs')
+        os.makedirs(self.runs)
+        self.queue_path = os.path.join(self.root, 'jobs.db')
+        self.queue = SqliteQueue(self.queue_path)
+        self.env = dict(os.environ, FAKE_WORKER_RUNS=self.runs, SETUP_JOB_LEASE=str(LEASE_SECONDS),
+                        SETUP_HEARTBEAT_INTERVAL='0.3', SETUP_POLL_INTERVAL='0.1',
+                        SETUP_JOB_MAX_ATTEMPTS=str(MAX_ATTEMPTS), SETUP_CPU_BUDGET='8',
+                        SETUP_HISTORY_DB=os.path.join(self.root, 'history.db'),
+                        SETUP_PROFILE_DIR=os.path.join(self.root, 'profiles'))
+
+    def start_worker(self, name, concurrency=2, **env):
+        process = subprocess.Popen([sys.executable, FAKE_WORKER, f"sqlite:///{self.queue_path}", name,
+                                    str(concurrency)], cwd=self.root, env=dict(self.env, **env),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.stop_worker, process)
+        return process
+
+    def stop_worker(self, process):
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def wait_for(self, predicate, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = predicate()
+            if value:
+                return value
+            time.sleep(0.05)
+        self.fail(f"Timed out after {timeout}s")
+
+    def wait_until_final(self, job_ids, timeout=30):
+        self.wait_for(lambda: all(self.queue.get(job_id)['status'] in FINAL_STATUSES for job_id in job_ids),
+                      timeout)
+        return [self.queue.get(job_id) for job_id in job_ids]
+
+    def wait_until_running(self, job_id, worker):
+        # Running on that worker, and its setup has started there
+        return self.wait_for(lambda: (job := self.queue.get(job_id))['status'] == 'running'
+                             and job['worker'] == worker and len(self.starts(job_id)) == job['attempts'] and job)
+
+    def starts(self, job_id):
+        return sorted(name for name in os.listdir(self.runs) if name.startswith(f"{job_id}."))
+
+    def test_each_job_runs_once_and_heartbeats_keep_the_lease(self):
+        # Every setup outlasts the lease, so it only stays with its worker through heartbeats
+        job_ids = [self.queue.enqueue({'repo_url': f"sleep:{LEASE_SECONDS * 2}"})['job_id'] for _ in range(6)]
+        workers = [self.start_worker(f"worker-{i}") for i in range(3)]
+        jobs = self.wait_until_final(job_ids)
+        self.assertEqual([job['status'] for job in jobs], ['finished'] * 6)
+        self.assertEqual([job['attempts'] for job in jobs], [1] * 6)
+        self.assertEqual([len(self.starts(job_id)) for job_id in job_ids], [1] * 6)
+        self.assertGreater(len({job['worker'] for job in jobs}), 1)
+        self.assertTrue({job['result']['pid'] for job in jobs} <= {process.pid for process in workers})
+
+    def test_job_that_does_not_fit_goes_to_another_worker(self):
+        # Each setup reserves one CPU: with 1.5, a worker running one has room left, but not enough for another
+        first_id = self.queue.enqueue({'repo_url': 'sleep:3'})['job_id']
+        self.start_worker('first', SETUP_CPU_BUDGET='1.5')
+        self.wait_until_running(first_id, 'first')
+        second_id = self.queue.enqueue({'repo_url': 'sleep:0'})['job_id']
+        # Leased, found not to fit and handed back, without counting as an attempt
+        time.sleep(1)
+        self.assertEqual((self.queue.get(second_id)['status'], self.queue.get(second_id)['attempts']), ('queued', 0))
+        self.start_worker('second', SETUP_CPU_BUDGET='1.5')
+        second = self.wait_until_final([second_id])[0]
+        self.assertEqual((second['worker'], second['attempts']), ('second', 1))
+        self.assertEqual(self.queue.get(first_id)['status'], 'running')
+
+    def test_killed_worker_job_is_redelivered(self):
+        job_id = self.queue.enqueue({'repo_url': 'sleep:2'})['job_id']
+        first = self.start_worker('first')
+        self.wait_until_running(job_id, 'first')
+        first.kill()
+        second = self.start_worker('second')
+        job = self.wait_until_final([job_id])[0]
+        self.assertEqual((job['status'], job['worker'], job['attempts']), ('finished', 'second', 2))
+        self.assertEqual(job['result']['pid'], second.pid)
+
+    def test_job_that_keeps_killing_workers_fails(self):
+        job_id = self.queue.enqueue({'repo_url': 'sleep:60'})['job_id']
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            process = self.start_worker(f"worker-{attempt}")
+            self.assertEqual(self.wait_until_running(job_id, f"worker-{attempt}")['attempts'], attempt)
+            process.kill()
+            process.wait()
+        self.start_worker('last')
+        job = self.wait_until_final([job_id])[0]
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('Worker lost', job['error'])
+        self.assertEqual(len(self.starts(job_id)), MAX_ATTEMPTS)
+
+    def test_cancel_queued_job(self):
+        job_id = self.queue.enqueue({'repo_url': 'sleep:0'})['job_id']
+        self.assertEqual(self.queue.cancel(job_id), 'queued')
+        other = self.queue.enqueue({'repo_url': 'sleep:0'})['job_id']
+        self.start_worker('worker')
+        self.wait_until_final([other])
+        self.assertEqual(self.queue.get(job_id)['status'], 'cancelled')
+        self.assertEqual(self.starts(job_id), [])
+
+    def test_cancel_running_job(self):
+        job_id = self.queue.enqueue({'repo_url': 'sleep:60'})['job_id']
+        self.start_worker('worker')
+        self.wait_until_running(job_id, 'worker')
+        self.assertEqual(self.queue.cancel(job_id), 'running')
+        job = self.wait_until_final([job_id], timeout=10)[0]
+        self.assertEqual((job['status'], job['result']['status']), ('cancelled', 'cancelled'))
+
+    def test_result_of_worker_that_lost_its_lease_is_dropped(self):
+        # The first attempt blocks its worker's loop past the lease, so the job is redelivered meanwhile
+        job_id = self.queue.enqueue({'repo_url': f"block:{LEASE_SECONDS * 3}"})['job_id']
+        first = self.start_worker('first')
+        self.wait_until_running(job_id, 'first')
+        second = self.start_worker('second')
+        job = self.wait_until_final([job_id])[0]
+        self.assertEqual((job['worker'], job['attempts'], job['result']['pid']), ('second', 2, second.pid))
+        # Once the first worker's setup returns, its result must not replace the second one's
+        self.wait_for(lambda: len(self.starts(job_id)) == 2)
+        time.sleep(LEASE_SECONDS * 2)
+        self.assertEqual(first.poll(), None)
+        self.assertEqual(self.queue.get(job_id)['result']['pid'], second.pid)
+
+if __name__ == '__main__':
+    unittest.main()
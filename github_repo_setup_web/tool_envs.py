@@ -0,0 +1,115 @@
+import os
+import sys
+import fcntl
+import shutil
+import hashlib
+import logging
+import subprocess
+import toml
+from contextlib import contextmanager
+
+TOOL_CACHE_DIR = os.getenv('SETUP_TOOL_CACHE', os.path.expanduser("~/github_projects/.tools"))
+WHEELHOUSE_DIR = os.path.join(TOOL_CACHE_DIR, 'wheelhouse')
+# Bootstrapping runs in a worker thread that stage deadlines can't stop, while holding a host-wide lock
+BOOTSTRAP_TIMEOUT = float(os.getenv('SETUP_TOOL_BOOTSTRAP_TIMEOUT', 600))
+
+TOOL_VERSIONS = {
+    'poetry': os.getenv('POETRY_VERSION', '1.8.3'),
+    'pipenv': os.getenv('PIPENV_VERSION', '2024.0.1'),
+    'pdm': os.getenv('PDM_VERSION', '2.18.1'),
+}
+
+BACKEND_INSTALLERS = {
+    'poetry.core.masonry.api': 'poetry',
+    'poetry.masonry.api': 'poetry',
+    'pdm.backend': 'pdm',
+    'pdm.pep517.api': 'pdm',
+}
+
+@contextmanager
+def _host_lock(name):
+    # Serialises bootstrapping across threads, processes and concurrent setups on this host
+    os.makedirs(TOOL_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(TOOL_CACHE_DIR, f".{name}.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def tool_env_path(tool, version=None):
+    version = version or TOOL_VERSIONS[tool]
+    return os.path.join(TOOL_CACHE_DIR, f"{tool}-{version}")
+
+def get_tool(tool, cache_hits=None):
+    version = TOOL_VERSIONS[tool]
+    env_path = tool_env_path(tool, version)
+    tool_path = os.path.join(env_path, 'bin', tool)
+    marker = os.path.join(env_path, '.complete')
+
+    if os.path.exists(marker):
+        if cache_hits is not None:
+            cache_hits.append(f"tool:{tool}")
+        return tool_path
+
+    with _host_lock(f"{tool}-{version}"):
+        if not os.path.exists(marker):
+            logging.info(f"Bootstrapping {tool} {version} into {env_path}")
+            shutil.rmtree(env_path, ignore_errors=True)
+            subprocess.run([sys.executable, '-m', 'venv', env_path], check=True, timeout=BOOTSTRAP_TIMEOUT)
+            subprocess.run([os.path.join(env_path, 'bin', 'pip'), 'install', '--quiet', f"{tool}=={version}"],
+                           check=True, timeout=BOOTSTRAP_TIMEOUT)
+            open(marker, 'w').close()
+        elif cache_hits is not None:
+            cache_hits.append(f"tool:{tool}")
+    return tool_path
+
+def read_build_system(repo_path):
+    pyproject_file = os.path.join(repo_path, 'pyproject.toml')
+    if not os.path.exists(pyproject_file):
+        return None, [], {}
+    try:
+        with open(pyproject_file, 'r') as f:
+            data = toml.load(f)
+    except (OSError, toml.TomlDecodeError) as e:
+        logging.warning(f"Error parsing pyproject.toml: {str(e)}")
+        return None, [], {}
+    build_system = data.get('build-system', {})
+    return build_system.get('build-backend'), build_system.get('requires', []), data
+
+def select_installer(repo_path):
+    if os.path.exists(os.path.join(repo_path, 'poetry.lock')):
+        return 'poetry'
+    if os.path.exists(os.path.join(repo_path, 'Pipfile.lock')) or os.path.exists(os.path.join(repo_path, 'Pipfile')):
+        return 'pipenv'
+    if os.path.exists(os.path.join(repo_path, 'pdm.lock')):
+        return 'pdm'
+    backend, _, data = read_build_system(repo_path)
+    if backend in BACKEND_INSTALLERS:
+        return BACKEND_INSTALLERS[backend]
+    if backend is None and 'poetry' in data.get('tool', {}):
+        return 'poetry'
+    return 'pip'
+
+def prefetch_build_backend(repo_path, cache_hits=None):
+    # Isolated builds download the backend on every install; keep its wheels in a shared wheelhouse instead
+    _, requires, _ = read_build_system(repo_path)
+    if not requires:
+        return None
+    key = hashlib.sha256('\n'.join(sorted(requires)).encode()).hexdigest()[:16]
+    marker = os.path.join(WHEELHOUSE_DIR, f".{key}.complete")
+    if os.path.exists(marker):
+        if cache_hits is not None:
+            cache_hits.append('build-backend')
+        return WHEELHOUSE_DIR
+
+    with _host_lock('wheelhouse'):
+        if not os.path.exists(marker):
+            try:
+                subprocess.run([sys.executable, '-m', 'pip', 'wheel', '--quiet', '--wheel-dir', WHEELHOUSE_DIR]
+                               + list(requires), check=True, timeout=BOOTSTRAP_TIMEOUT)
+                open(marker, 'w').close()
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                logging.warning(f"Failed to prefetch build backend {requires}: {str(e)}")
+                return None
+    return WHEELHOUSE_DIR
@@ -0,0 +1,370 @@
+import os
+import sys
+import ast
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+INFERENCE_CACHE = os.getenv('SETUP_INFERENCE_CACHE', os.path.expanduser("~/github_projects/.version_inference.db"))
+# Per-file results kept; the least recently used are dropped beyond this
+INFERENCE_CACHE_ENTRIES = int(os.getenv('SETUP_INFERENCE_CACHE_ENTRIES', 200000))
+# Floor reported when no file needs anything newer
+MIN_SUPPORTED_VERSION = os.getenv('SETUP_MIN_PYTHON', '3.6')
+INFERENCE_WORKERS = int(os.getenv('SETUP_INFERENCE_WORKERS', os.cpu_count() or 1))
+INFERENCE_MAX_FILES = int(os.getenv('SETUP_INFERENCE_MAX_FILES', 5000))
+MAX_FILE_SIZE = 1024 * 1024
+# Below this many uncached files a process pool costs more than it saves
+PARALLEL_THRESHOLD = 64
+# Bump when the rules change so cached per-file results are recomputed
+ANALYZER_VERSION = 2
+# What this interpreter cannot parse is reported as needing a newer one, so results also depend on it
+HOST_VERSION = sys.version_info[:2]
+
+NEW_MODULES = {
+    'secrets': (3, 6),
+    'contextvars': (3, 7),
+    'dataclasses': (3, 7),
+    'importlib.resources': (3, 7),
+    'importlib.metadata': (3, 8),
+    'zoneinfo': (3, 9),
+    'graphlib': (3, 9),
+    'tomllib': (3, 11),
+    'wsgiref.types': (3, 11),
+}
+
+NEW_NAMES = {
+    ('asyncio', 'run'): (3, 7),
+    ('typing', 'Literal'): (3, 8),
+    ('typing', 'Final'): (3, 8),
+    ('typing', 'Protocol'): (3, 8),
+    ('typing', 'TypedDict'): (3, 8),
+    ('functools', 'cached_property'): (3, 8),
+    ('functools', 'cache'): (3, 9),
+    ('typing', 'Annotated'): (3, 9),
+    ('typing', 'TypeAlias'): (3, 10),
+    ('typing', 'ParamSpec'): (3, 10),
+    ('typing', 'TypeGuard'): (3, 10),
+    ('itertools', 'pairwise'): (3, 10),
+    ('dataclasses', 'KW_ONLY'): (3, 10),
+    ('asyncio', 'TaskGroup'): (3, 11),
+    ('typing', 'Self'): (3, 11),
+    ('typing', 'LiteralString'): (3, 11),
+    ('typing', 'Never'): (3, 11),
+    ('typing', 'override'): (3, 12),
+    ('itertools', 'batched'): (3, 12),
+}
+
+BUILTIN_GENERICS = {'list', 'dict', 'set', 'frozenset', 'tuple', 'type'}
+# Outside annotations `a | b` is usually arithmetic; it is a union when one side is plainly a type
+BUILTIN_TYPES = BUILTIN_GENERICS | {'int', 'float', 'complex', 'str', 'bytes', 'bytearray', 'bool', 'object'}
+IMPORT_ERRORS = {'ImportError', 'ModuleNotFoundError', 'AttributeError'}
+# Messages of the syntax errors Python 3 raises only for Python 2 sources (print and exec statements, old
+# except clauses, old octal literals, tuple parameters)
+PYTHON2_ERRORS = ('Missing parentheses in call to', 'multiple exception types must be parenthesized',
+                  'leading zeros in decimal integer literals', 'Function parameters cannot be parenthesized')
+
+class FeatureVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.features = {}
+        self.future_annotations = False
+        # Unions inside annotations, which check_annotation has already judged
+        self.annotation_unions = set()
+        # Inside "try: ... except ImportError" or "if sys.version_info ..." the code is a fallback
+        self.guarded = 0
+
+    def require(self, version, feature, node):
+        if feature not in self.features:
+            self.features[feature] = (version, getattr(node, 'lineno', 0))
+
+    def visit_guarded(self, nodes):
+        self.guarded += 1
+        for node in nodes:
+            self.visit(node)
+        self.guarded -= 1
+
+    def visit_Try(self, node):
+        caught = set()
+        for handler in node.handlers:
+            types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+            caught.update(t.id for t in types if isinstance(t, ast.Name))
+        if caught & IMPORT_ERRORS:
+            self.visit_guarded(node.body)
+            for child in node.handlers + node.orelse + node.finalbody:
+                self.visit(child)
+        else:
+            self.generic_visit(node)
+
+    def visit_TryStar(self, node):
+        self.require((3, 11), 'except*', node)
+        self.generic_visit(node)
+
+    def visit_If(self, node):
+        if 'version_info' in ast.dump(node.test):
+            self.visit(node.test)
+            self.visit_guarded(node.body + node.orelse)
+        else:
+            self.generic_visit(node)
+
+    def check_module(self, name, node):
+        if self.guarded:
+            return
+        for module, version in NEW_MODULES.items():
+            if name == module or name.startswith(f"{module}."):
+                self.require(version, f"import {module}", node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.check_module(alias.name, node)
+
+    def visit_ImportFrom(self, node):
+        if node.level:
+            return
+        if node.module == '__future__':
+            if any(alias.name == 'annotations' for alias in node.names):
+                self.future_annotations = True
+                self.require((3, 7), 'from __future__ import annotations', node)
+            return
+        self.check_module(node.module, node)
+        for alias in node.names:
+            self.check_module(f"{node.module}.{alias.name}", node)
+            version = NEW_NAMES.get((node.module, alias.name))
+            if version and not self.guarded:
+                self.require(version, f"from {node.module} import {alias.name}", node)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and not self.guarded:
+            version = NEW_NAMES.get((node.value.id, node.attr))
+            if version:
+                self.require(version, f"{node.value.id}.{node.attr}", node)
+        self.generic_visit(node)
+
+    def visit_JoinedStr(self, node):
+        self.require((3, 6), 'f-string', node)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        self.require((3, 6), 'variable annotation', node)
+        self.check_annotation(node.annotation)
+        self.generic_visit(node)
+
+    def visit_NamedExpr(self, node):
+        self.require((3, 8), 'assignment expression (:=)', node)
+        self.generic_visit(node)
+
+    def visit_Match(self, node):
+        self.require((3, 10), 'match statement', node)
+        self.generic_visit(node)
+
+    def visit_TypeAlias(self, node):
+        self.require((3, 12), 'type statement', node)
+        self.generic_visit(node)
+
+    def visit_function(self, node):
+        if node.args.posonlyargs:
+            self.require((3, 8), 'positional-only parameters', node)
+        if getattr(node, 'type_params', None):
+            self.require((3, 12), 'type parameter syntax', node)
+        args = node.args.posonlyargs + node.args.args + node.args.kwonlyargs + \
+            [arg for arg in [node.args.vararg, node.args.kwarg] if arg]
+        for arg in args:
+            if arg.annotation:
+                self.check_annotation(arg.annotation)
+        if node.returns:
+            self.check_annotation(node.returns)
+        self.generic_visit(node)
+
+    visit_FunctionDef = visit_function
+    visit_AsyncFunctionDef = visit_function
+
+    def visit_ClassDef(self, node):
+        if getattr(node, 'type_params', None):
+            self.require((3, 12), 'type parameter syntax', node)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        # isinstance(x, int | str) is evaluated at runtime regardless of __future__ imports
+        if isinstance(node.func, ast.Name) and node.func.id in ('isinstance', 'issubclass') and len(node.args) == 2:
+            if self.is_union(node.args[1]):
+                self.require((3, 10), 'X | Y union type', node)
+        self.generic_visit(node)
+
+    def is_union(self, node):
+        if not (isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr)):
+            return False
+        return all(self.is_union(side) or isinstance(side, (ast.Name, ast.Attribute, ast.Subscript)) or
+                   (isinstance(side, ast.Constant) and side.value is None)
+                   for side in (node.left, node.right))
+
+    def is_type_union(self, node):
+        if not self.is_union(node):
+            return False
+        sides = [node]
+        while sides:
+            side = sides.pop()
+            if isinstance(side, ast.BinOp):
+                sides += [side.left, side.right]
+            elif isinstance(side, ast.Constant) or \
+                    isinstance(side, ast.Name) and side.id in BUILTIN_TYPES or \
+                    isinstance(side, ast.Subscript) and isinstance(side.value, ast.Name) and \
+                    side.value.id in BUILTIN_GENERICS:
+                return True
+        return False
+
+    def visit_BinOp(self, node):
+        # Type aliases, cast() and TypeVar bounds, defaults: anywhere but an annotation the union is evaluated
+        if id(node) not in self.annotation_unions and self.is_type_union(node):
+            self.require((3, 10), 'X | Y union type', node)
+        self.generic_visit(node)
+
+    def check_annotation(self, annotation):
+        self.annotation_unions.update(id(node) for node in ast.walk(annotation) if isinstance(node, ast.BinOp))
+        # With "from __future__ import annotations" annotations are never evaluated
+        if self.future_annotations:
+            return
+        for node in ast.walk(annotation):
+            if self.is_union(node):
+                self.require((3, 10), 'X | Y union type', node)
+            elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and \
+                    node.value.id in BUILTIN_GENERICS:
+                self.require((3, 9), f"{node.value.id}[...] generic", node)
+
+def analyze_source(content):
+    try:
+        tree = ast.parse(content)
+    except SyntaxError as e:
+        if any(marker in str(e.msg) for marker in PYTHON2_ERRORS):
+            # Python 2 sources say nothing about which Python 3 is needed
+            return None
+        # Valid Python 3 that this interpreter cannot parse is newer than it
+        feature = f"syntax newer than Python {HOST_VERSION[0]}.{HOST_VERSION[1]} ({e.msg})"
+        return [[HOST_VERSION[0], HOST_VERSION[1] + 1, feature, e.lineno or 0]]
+    except ValueError:
+        # Null bytes: not a source file
+        return None
+    visitor = FeatureVisitor()
+    visitor.visit(tree)
+    return [[version[0], version[1], feature, lineno] for feature, (version, lineno) in visitor.features.items()]
+
+def _analyze_batch(contents):
+    return [analyze_source(content) for content in contents]
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_results (
+    digest TEXT PRIMARY KEY,
+    analyzer_version INTEGER NOT NULL,
+    result TEXT,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_file_results_used ON file_results(used_at);
+"""
+# Stays under SQLite's limit on bound parameters per statement
+CACHE_QUERY_BATCH = 500
+
+_initialized = set()
+
+def connect_cache(db_path=None):
+    db_path = db_path or INFERENCE_CACHE
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    if db_path not in _initialized:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(CACHE_SCHEMA)
+        with conn:
+            conn.execute("DELETE FROM file_results WHERE analyzer_version != ?", (ANALYZER_VERSION,))
+        _initialized.add(db_path)
+    return conn
+
+def _batches(items):
+    items = list(items)
+    return [items[i:i + CACHE_QUERY_BATCH] for i in range(0, len(items), CACHE_QUERY_BATCH)]
+
+def load_cached(conn, digests):
+    cached = {}
+    now = time.time()
+    with conn:
+        for batch in _batches(set(digests)):
+            placeholders = ', '.join('?' * len(batch))
+            rows = conn.execute(f"SELECT digest, result FROM file_results WHERE digest IN ({placeholders})", batch)
+            cached.update((digest, json.loads(result)) for digest, result in rows)
+            conn.execute(f"UPDATE file_results SET used_at = ? WHERE digest IN ({placeholders})", [now] + batch)
+    return cached
+
+def save_cached(conn, results):
+    now = time.time()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO file_results (digest, analyzer_version, result, used_at) "
+                         "VALUES (?, ?, ?, ?)",
+                         [(digest, ANALYZER_VERSION, json.dumps(result), now) for digest, result in results.items()])
+        excess = conn.execute("SELECT COUNT(*) FROM file_results").fetchone()[0] - INFERENCE_CACHE_ENTRIES
+        if excess > 0:
+            conn.execute("DELETE FROM file_results WHERE digest IN "
+                         "(SELECT digest FROM file_results ORDER BY used_at LIMIT ?)", (excess,))
+
+def analyze_sources(sources):
+    # Per-file results are cached by content hash, so only new or edited files are parsed again
+    host = f"{HOST_VERSION[0]}.{HOST_VERSION[1]}\0".encode()
+    digests = {path: hashlib.sha256(host + content).hexdigest() for path, content in sources.items()}
+    conn = None
+    cached = {}
+    try:
+        conn = connect_cache()
+        cached = load_cached(conn, digests.values())
+    except (sqlite3.Error, OSError) as e:
+        # The cache only saves work; inference goes on without it
+        logging.warning(f"Version inference cache unavailable: {str(e)}")
+    results = {path: cached[digest] for path, digest in digests.items() if digest in cached}
+
+    pending = [path for path in sources if path not in results]
+    if pending:
+        contents = [sources[path] for path in pending]
+        if len(pending) < PARALLEL_THRESHOLD or INFERENCE_WORKERS < 2:
+            analyzed = _analyze_batch(contents)
+        else:
+            chunk = max(1, len(pending) // (INFERENCE_WORKERS * 4))
+            batches = [contents[i:i + chunk] for i in range(0, len(contents), chunk)]
+            with ProcessPoolExecutor(max_workers=INFERENCE_WORKERS) as executor:
+                analyzed = [result for batch in executor.map(_analyze_batch, batches) for result in batch]
+        for path, result in zip(pending, analyzed):
+            results[path] = result
+
+        if conn is not None:
+            try:
+                save_cached(conn, {digests[path]: results[path] for path in pending})
+            except (sqlite3.Error, OSError) as e:
+                logging.warning(f"Failed to save version inference cache: {str(e)}")
+    if conn is not None:
+        conn.close()
+    return results
+
+# sources maps paths to file contents; returns (version, reasons), or None if nothing could be parsed
+def infer_minimum_version(sources):
+    sources = {path: content for path, content in sources.items() if len(content) <= MAX_FILE_SIZE}
+    if len(sources) > INFERENCE_MAX_FILES:
+        sources = dict(sorted(sources.items())[:INFERENCE_MAX_FILES])
+    results = analyze_sources(sources)
+
+    parsed = [path for path, result in results.items() if result is not None]
+    if not parsed:
+        return None
+
+    floor = tuple(int(part) for part in MIN_SUPPORTED_VERSION.split('.')[:2])
+    minimum = floor
+    evidence = []
+    for path in sorted(parsed):
+        for major, minor, feature, lineno in results[path]:
+            if (major, minor) > minimum:
+                minimum, evidence = (major, minor), []
+            if (major, minor) == minimum:
+                evidence.append(f"{feature} at {path}:{lineno}")
+
+    version = f"{minimum[0]}.{minimum[1]}"
+    if minimum == floor and not evidence:
+        reasons = [f"no syntax or stdlib usage newer than {version} in {len(parsed)} file(s)"]
+    else:
+        reasons = evidence[:5] + ([f"and {len(evidence) - 5} more"] if len(evidence) > 5 else [])
+    return version, reasons
@@ -0,0 +1,131 @@
+import os
+import sys
+import hmac
+import json
+import uuid
+import hashlib
+import logging
+import argparse
+import threading
+import requests
+from github_repo_setup import repo_directory, update_checkout_async
+from journal import load_journal
+from pipeline import run_setup
+from scheduler import estimated_duration, QUEUE_SIZE
+from job_queue import FINAL_STATUSES
+
+# Shared secret configured on the GitHub webhook; without it every delivery is refused
+WEBHOOK_SECRET = os.getenv('GITHUB_WEBHOOK_SECRET')
+# Repositories whose pushes prewarm their setup, as comma-separated owner/name
+WEBHOOK_REPOS = {name.strip().lower() for name in os.getenv('SETUP_WEBHOOK_REPOS', '').split(',') if name.strip()}
+# Seconds without a further push before a repository is prewarmed, so a burst of pushes costs one setup
+WEBHOOK_DEBOUNCE = float(os.getenv('SETUP_WEBHOOK_DEBOUNCE', 30))
+
+_lock = threading.Lock()
+_pending = {}
+# Last prewarm job enqueued per repository
+_jobs = {}
+
+def sign(body, secret):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def verify_signature(body, signature, secret=None):
+    secret = secret or WEBHOOK_SECRET
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign(body, secret), signature)
+
+def parse_push(payload):
+    # A valid signature only says who sent the body, not that it is a push payload
+    if not isinstance(payload, dict) or not isinstance(payload.get('repository') or {}, dict):
+        raise ValueError("Push payload is not a JSON object")
+    # Only pushes to the default branch change what a setup checks out
+    repository = payload.get('repository') or {}
+    branch = repository.get('default_branch')
+    if payload.get('deleted') or not branch or payload.get('ref') != f"refs/heads/{branch}":
+        return None
+    return {
+        'full_name': str(repository['full_name']).lower(),
+        'repo_url': repository['html_url'],
+        'branch': branch,
+        'after': payload.get('after')
+    }
+
+def is_registered(full_name):
+    return full_name.lower() in WEBHOOK_REPOS
+
+def schedule_prewarm(push, queue, delay=None):
+    delay = WEBHOOK_DEBOUNCE if delay is None else delay
+    name = push['full_name']
+    with _lock:
+        pending = _pending.get(name)
+        if pending:
+            pending['timer'].cancel()
+        timer = threading.Timer(delay, _fire, args=(name, queue))
+        timer.daemon = True
+        _pending[name] = {'timer': timer, 'push': push, 'pushes': pending['pushes'] + 1 if pending else 1}
+        timer.start()
+        return _pending[name]['pushes']
+
+def _fire(name, queue):
+    with _lock:
+        pending = _pending.pop(name, None)
+        if pending is None:
+            return
+    push = pending['push']
+    try:
+        previous = _jobs.get(name) and queue.get(_jobs[name])
+        if previous and previous['status'] not in FINAL_STATUSES:
+            # One prewarm per repository at a time; the latest push is picked up after this one
+            schedule_prewarm(push, queue)
+            return
+        if queue.pending() >= QUEUE_SIZE:
+            # Dropped, not retried: the next push prewarms again
+            logging.warning(f"Skipped prewarm of {push['repo_url']}: setup queue is full")
+            return
+        # Runs on a worker, like any setup, and warms that worker's checkout
+        job = queue.enqueue({'repo_url': push['repo_url'], 'prewarm': push},
+                            duration=estimated_duration(push['repo_url']))
+        _jobs[name] = job['job_id']
+        logging.info(f"Queued prewarm of {push['repo_url']} at {push['after']}", extra={'job_id': job['job_id']})
+    except Exception as e:
+        logging.error(f"Failed to queue prewarm of {push['repo_url']}: {str(e)}")
+
+async def prewarm_async(push, job_id, custom_path=''):
+    repo_url = push['repo_url']
+    repo_path = repo_directory(repo_url, custom_path)
+    resume = os.path.isdir(os.path.join(repo_path, '.git'))
+    if resume:
+        # Only checkouts made by a setup are touched; anything else may be someone's working copy
+        if 'clone' not in load_journal(repo_path, repo_url)['stages']:
+            logging.warning(f"Not prewarming {repo_path}: it was not created by a setup of {repo_url}")
+            return None
+        await update_checkout_async(repo_path, repo_url, push['branch'])
+    logging.info(f"Prewarming {repo_url} at {push['after']}", extra={'job_id': job_id})
+    # Resuming re-runs only what the new commits invalidate: usually the tests, the install if requirements changed
+    result = await run_setup(repo_url, custom_path, job_id=job_id, resume=resume)
+    logging.info(f"Prewarmed {repo_url}: {result['status']}, reused {', '.join(result['skipped_stages']) or 'nothing'}")
+    return result
+
+if __name__ == "__main__":
+    # Usage: python webhooks.py <payload.json> [--event push] [--url URL]
+    # Replays a recorded delivery against a running server, signed with GITHUB_WEBHOOK_SECRET
+    parser = argparse.ArgumentParser(description="Replay a recorded GitHub webhook delivery.")
+    parser.add_argument('payload')
+    parser.add_argument('--event', default='push')
+    parser.add_argument('--url', default='http://localhost:5000/webhook/github')
+    args = parser.parse_args()
+
+    if not WEBHOOK_SECRET:
+        print("GITHUB_WEBHOOK_SECRET is not set", file=sys.stderr)
+        sys.exit(1)
+    with open(args.payload, 'rb') as f:
+        body = f.read()
+    response = requests.post(args.url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': args.event,
+        'X-GitHub-Delivery': str(uuid.uuid4()),
+        'X-Hub-Signature-256': sign(body, WEBHOOK_SECRET)
+    })
+    print(response.status_code, json.dumps(response.json()))
+    sys.exit(0 if response.ok else 1)
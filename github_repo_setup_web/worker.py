@@ -0,0 +1,165 @@
+import os
+import time
+import uuid
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import run_setup
+from webhooks import prewarm_async
+from history import export_setup
+from jobs import job_stage
+from scheduler import estimate_cost, has_room, try_admit, release, releases
+from job_queue import open_queue, LEASE_SECONDS, JOB_QUEUE_URL
+
+# Setups one worker process runs at once; the local admission budgets still apply on top
+WORKER_CONCURRENCY = int(os.getenv('SETUP_WORKER_CONCURRENCY', 2))
+HEARTBEAT_INTERVAL = float(os.getenv('SETUP_HEARTBEAT_INTERVAL', LEASE_SECONDS / 3))
+POLL_INTERVAL = float(os.getenv('SETUP_POLL_INTERVAL', 1.0))
+# Workers on one machine must not rotate the same file; "{pid}" is the worker's process id
+WORKER_LOG_FILE = os.getenv('WORKER_LOG_FILE', 'worker-{pid}.log')
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def publish(queue, job_id, result):
+    # Workers may run on other hosts: the web app reads their profiles and history through the queue
+    try:
+        for path in (result.get('profile') or {}).values():
+            with open(path, 'rb') as f:
+                queue.put_artifact(job_id, os.path.basename(path)[len(job_id) + 1:], f.read())
+        record = export_setup(job_id)
+        if record:
+            queue.add_history(record)
+    except Exception as e:
+        logging.warning(f"Failed to publish the profile and history of job {job_id}: {str(e)}")
+
+async def execute(queue, call, job, worker_id):
+    job_id = job['job_id']
+    request = dict(job['request'])
+    push = request.pop('prewarm', None)
+    if job['attempts'] > 1:
+        # Redelivered after its worker died: continue from whatever that worker journaled
+        request['resume'] = True
+    logging.info(f"Worker {worker_id} running {'prewarm' if push else 'setup'} of {request['repo_url']} "
+                 f"(attempt {job['attempts']})", extra={'job_id': job_id})
+    try:
+        if push:
+            result = await prewarm_async(push, job_id, request.get('custom_path', '')) or {
+                'success': True, 'status': 'skipped', 'job_id': job_id, 'repo_url': request['repo_url'],
+                'message': 'The checkout was not created by a setup'}
+        else:
+            result = await run_setup(**request, job_id=job_id)
+    except asyncio.CancelledError:
+        # run_setup turns a cancellation into its own result; this is one that came before it started
+        result = {'success': False, 'status': 'cancelled', 'job_id': job_id, 'repo_url': request['repo_url'],
+                  'error': 'Setup cancelled'}
+    except Exception as e:
+        logging.error(f"Setup of {request['repo_url']} crashed: {str(e)}")
+        result = {'success': False, 'status': 'failed', 'job_id': job_id, 'repo_url': request['repo_url'],
+                  'error': str(e)}
+    finally:
+        release(job_id)
+    await call(publish, queue, job_id, result)
+    if not await call(queue.complete, job_id, worker_id, result):
+        logging.warning(f"Lost the lease on job {job_id}; its result was dropped")
+
+async def heartbeat(queue, call, running, worker_id):
+    for job_id, task in list(running.items()):
+        try:
+            state = await call(queue.heartbeat, job_id, worker_id, job_stage(job_id))
+        except Exception as e:
+            # The lease outlives a few missed heartbeats
+            logging.warning(f"Heartbeat for job {job_id} failed: {str(e)}")
+            continue
+        if state != 'ok':
+            # Cancelled by a user, or the lease ran out and the job already belongs to another worker
+            logging.info(f"Stopping job {job_id}: {'cancel requested' if state == 'cancel' else 'lease lost'}")
+            task.cancel()
+
+def admit(queue, job, worker_id):
+    if try_admit(job['job_id'], job['request']['repo_url'], estimate_cost(job['request']['repo_url'])):
+        return True
+    if not queue.release(job['job_id'], worker_id):
+        logging.warning(f"Lost the lease on job {job['job_id']} before it started")
+    return False
+
+async def serve(queue, worker_id, concurrency, stop):
+    # Every setup is a task on this one loop, so the per-loop resource semaphores apply across all of them.
+    # Queue calls block; they get their own thread so heartbeats never wait behind setup work.
+    loop = asyncio.get_running_loop()
+    queue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue')
+    def call(func, *args):
+        return loop.run_in_executor(queue_executor, func, *args)
+
+    running = {}
+    # Set when a leased job didn't fit; no more leases until some setup in this process gives back capacity
+    saturated_at = None
+    last_heartbeat = time.monotonic()
+    logging.info(f"Worker {worker_id} started with concurrency {concurrency}")
+    try:
+        # After a stop request no new jobs are leased, but running ones finish and keep their leases alive
+        while running or not stop.is_set():
+            for job_id, task in list(running.items()):
+                if task.done():
+                    del running[job_id]
+            if running and time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                await heartbeat(queue, call, running, worker_id)
+            if not stop.is_set() and len(running) < concurrency and saturated_at != releases() and has_room():
+                try:
+                    job = await call(queue.lease, worker_id)
+                except Exception as e:
+                    logging.warning(f"Worker {worker_id} could not lease a job: {str(e)}")
+                    job = None
+                seen = releases()
+                if job and not await asyncio.to_thread(admit, queue, job, worker_id):
+                    saturated_at = seen
+                elif job:
+                    running[job['job_id']] = asyncio.create_task(execute(queue, call, job, worker_id),
+                                                                 name=f"setup-{job['job_id']}")
+                    continue
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        queue_executor.shutdown(wait=False)
+    logging.info(f"Worker {worker_id} stopped")
+
+def run_worker(queue, worker_id=None, concurrency=WORKER_CONCURRENCY, stop=None):
+    asyncio.run(serve(queue, worker_id or worker_name(), concurrency, stop or threading.Event()))
+
+_local_workers = []
+_local_lock = threading.Lock()
+
+def start_local_workers(count, queue_url=None):
+    # Lets a single web server process its own queue; started on first use so only the serving process runs them
+    with _local_lock:
+        while len(_local_workers) < count:
+            thread = threading.Thread(target=run_worker, args=(open_queue(queue_url),), name='local-worker',
+                                      daemon=True)
+            _local_workers.append(thread)
+            thread.start()
+
+if __name__ == "__main__":
+    # Usage: python worker.py [--queue URL] [--concurrency N] [--id NAME]; run one per build machine
+    from logging_config import configure_logging
+
+    configure_logging(WORKER_LOG_FILE)
+    parser = argparse.ArgumentParser(description="Run repository setups from the shared job queue.")
+    parser.add_argument('--queue', default=JOB_QUEUE_URL)
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    parser.add_argument('--id', help="Worker name shown in job status (default: host:pid:random)")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    # First signal drains: no new jobs, running ones finish. A second one exits right away.
+    def request_stop(signum, frame):
+        if stop.is_set():
+            os._exit(1)
+        logging.info("Stopping after the running setups finish")
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    run_worker(open_queue(args.queue), args.id, args.concurrency, stop)